@@ -430,8 +430,7 @@ Focus on practical, implementable suggestions that match the room's mode and cur
         try:
             from models import AIInteraction, SessionLocal
             
-            db = SessionLocal()
-            try:
+            async with SessionLocal() as db:
                 interaction = AIInteraction(
                     user_id=user_id,
                     room_id=room_id,
@@ -444,10 +443,7 @@ Focus on practical, implementable suggestions that match the room's mode and cur
                 )
                 
                 db.add(interaction)
-                db.commit()
-                
-            finally:
-                db.close()
+                await db.commit()
                 
         except Exception as e:
             logger.error(f"Error logging AI interaction: {e}")
@@ -456,44 +452,43 @@ Focus on practical, implementable suggestions that match the room's mode and cur
         """Get AI service analytics"""
         try:
             from models import AIInteraction, SessionLocal
-            from sqlalchemy import func
+            from sqlalchemy import select, func
             from datetime import datetime, timedelta
             
-            db = SessionLocal()
-            try:
+            async with SessionLocal() as db:
                 since_date = datetime.utcnow() - timedelta(days=days)
                 
                 # Get interaction counts by type
-                interaction_counts = db.query(
+                interaction_counts = (await db.execute(select(
                     AIInteraction.interaction_type,
                     func.count(AIInteraction.id).label('count')
-                ).filter(
+                ).where(
                     AIInteraction.created_at >= since_date
-                ).group_by(AIInteraction.interaction_type).all()
+                ).group_by(AIInteraction.interaction_type))).all()
                 
                 # Get average response times
-                avg_response_time = db.query(
+                avg_response_time = await db.scalar(select(
                     func.avg(AIInteraction.response_time_ms)
-                ).filter(
+                ).where(
                     AIInteraction.created_at >= since_date,
                     AIInteraction.response_time_ms.isnot(None)
-                ).scalar()
+                ))
                 
                 # Get total tokens used
-                total_tokens = db.query(
+                total_tokens = await db.scalar(select(
                     func.sum(AIInteraction.tokens_used)
-                ).filter(
+                ).where(
                     AIInteraction.created_at >= since_date,
                     AIInteraction.tokens_used.isnot(None)
-                ).scalar()
+                ))
                 
                 # Get user satisfaction ratings
-                avg_rating = db.query(
+                avg_rating = await db.scalar(select(
                     func.avg(AIInteraction.user_rating)
-                ).filter(
+                ).where(
                     AIInteraction.created_at >= since_date,
                     AIInteraction.user_rating.isnot(None)
-                ).scalar()
+                ))
                 
                 return {
                     "days_analyzed": days,
@@ -504,9 +499,6 @@ Focus on practical, implementable suggestions that match the room's mode and cur
                     "service_availability": self.is_available()
                 }
                 
-            finally:
-                db.close()
-                
         except Exception as e:
             logger.error(f"Error getting AI analytics: {e}")
             return {"error": "Failed to generate analytics"}
@@ -0,0 +1,62 @@
+import logging
+from typing import Optional
+
+import jwt
+from fastapi import Depends, HTTPException, status
+from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from models import SECRET_KEY, ALGORITHM, get_db
+from auth_cache import user_cache, claims_cache
+
+logger = logging.getLogger(__name__)
+
+# Bearer token on every authenticated REST request
+security = HTTPBearer()
+
+def decode_token(token: str) -> Optional[int]:
+    """Decode a JWT and return its user id, None if the token has no subject"""
+    user_id = claims_cache.get(token)
+    if user_id is not None:
+        return user_id
+    
+    payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+    subject = payload.get("sub")
+    if subject is None:
+        return None
+    
+    user_id = int(subject)
+    claims_cache.put(token, user_id, payload.get("exp"))
+    return user_id
+
+def verify_token(credentials: HTTPAuthorizationCredentials = Depends(security)):
+    """Verify JWT token and return user data"""
+    token = credentials.credentials
+    try:
+        user_id = decode_token(token)
+        if user_id is None:
+            raise HTTPException(
+                status_code=status.HTTP_401_UNAUTHORIZED,
+                detail="Could not validate credentials",
+                headers={"WWW-Authenticate": "Bearer"},
+            )
+        return {"user_id": user_id}
+    except (jwt.PyJWTError, ValueError):
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Could not validate credentials",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+
+async def get_current_user(token_data: dict = Depends(verify_token), db: AsyncSession = Depends(get_db)):
+    """Get current user from token"""
+    user_id = token_data["user_id"]
+    user = await user_cache.get(user_id)
+    if user is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="User not found"
+        )
+    
+    # Attach the cached snapshot to this request's session without querying
+    return await db.merge(user, load=False)
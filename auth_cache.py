@@ -0,0 +1,112 @@
+import hashlib
+import logging
+import time
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+from models import User, SessionLocal
+
+logger = logging.getLogger(__name__)
+
+# How long a user lookup is trusted before it is read again
+USER_CACHE_TTL_SECONDS = 30
+
+# Most user snapshots and verified tokens kept in memory
+USER_CACHE_MAX_ENTRIES = 10000
+CLAIMS_CACHE_MAX_ENTRIES = 50000
+
+class UserCache:
+    """Bounded LRU of detached User snapshots, invalidated on account changes"""
+
+    def __init__(self, ttl: float = USER_CACHE_TTL_SECONDS, max_entries: int = USER_CACHE_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+
+        # user_id -> (expires_at, user or None when the user does not exist)
+        self._entries: "OrderedDict[int, Tuple[float, Optional[User]]]" = OrderedDict()
+
+    async def get(self, user_id: int) -> Optional[User]:
+        """Get a user snapshot, reading the database at most once per TTL"""
+        entry = self._entries.get(user_id)
+        if entry and entry[0] > time.monotonic():
+            self._entries.move_to_end(user_id)
+            self.hits += 1
+            return entry[1]
+
+        self.misses += 1
+
+        # Column attributes stay loaded once the session closes, relationships do not
+        async with SessionLocal() as db:
+            user = await db.get(User, user_id)
+
+        # Missing users are cached too, so floods of bad ids stay off the database
+        self._entries[user_id] = (time.monotonic() + self.ttl, user)
+        self._entries.move_to_end(user_id)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        return user
+
+    def invalidate(self, user_id: int):
+        """Forget a user after their account changed"""
+        self._entries.pop(user_id, None)
+
+    def stats(self) -> Dict[str, float]:
+        return _cache_stats(self.hits, self.misses, len(self._entries))
+
+class ClaimsCache:
+    """Bounded LRU of verified token subjects, keyed by token hash, kept until the token expires"""
+
+    def __init__(self, max_entries: int = CLAIMS_CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+
+        # sha256(token) -> (exp as unix time, user_id)
+        self._entries: "OrderedDict[str, Tuple[float, int]]" = OrderedDict()
+
+    @staticmethod
+    def _key(token: str) -> str:
+        return hashlib.sha256(token.encode()).hexdigest()
+
+    def get(self, token: str) -> Optional[int]:
+        """Get the user id of an already verified, unexpired token"""
+        key = self._key(token)
+        entry = self._entries.get(key)
+        if entry and entry[0] > time.time():
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+        if entry:
+            del self._entries[key]
+        self.misses += 1
+        return None
+
+    def put(self, token: str, user_id: int, expires_at: Optional[float]):
+        """Remember a verified token until its exp claim"""
+        if expires_at is None:
+            return
+
+        key = self._key(token)
+        self._entries[key] = (float(expires_at), user_id)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def stats(self) -> Dict[str, float]:
+        return _cache_stats(self.hits, self.misses, len(self._entries))
+
+def _cache_stats(hits: int, misses: int, size: int) -> Dict[str, float]:
+    lookups = hits + misses
+    return {
+        "hits": hits,
+        "misses": misses,
+        "size": size,
+        "hit_rate": round(hits / lookups, 4) if lookups else 0.0
+    }
+
+# Shared between the WebSocket handshake, the manager and the REST routes
+user_cache = UserCache()
+claims_cache = ClaimsCache()
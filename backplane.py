@@ -0,0 +1,257 @@
+import asyncio
+import json
+import logging
+import os
+import socket
+from abc import ABC, abstractmethod
+from typing import Awaitable, Callable, Dict, Optional, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Handler invoked with the decoded message published on a channel
+MessageHandler = Callable[[dict], Awaitable[None]]
+
+# Postgres rejects NOTIFY payloads of 8000 bytes or more
+NOTIFY_PAYLOAD_LIMIT = 7900
+
+# Larger messages go through this table and only their id is notified;
+# rows outlive every listener's chance to read them, then are deleted
+PAYLOAD_TABLE = "backplane_payloads"
+PAYLOAD_RETENTION_SECONDS = 60
+
+# Delay between attempts to reopen a dropped backplane connection, doubling up to the max
+RECONNECT_MIN_SECONDS = 0.5
+RECONNECT_MAX_SECONDS = 30
+
+def default_worker_id() -> str:
+    """Identify this worker process on the backplane"""
+    return os.environ.get("WORKER_ID") or f"{socket.gethostname()}-{os.getpid()}"
+
+# Postgres channel names are identifiers, capped at 63 bytes
+CHANNEL_NAME_LIMIT = 63
+
+def room_channel(room_id: int) -> str:
+    """Channel carrying events for a room"""
+    return f"zayion_room_{room_id}"
+
+def worker_channel(worker_id: str) -> str:
+    """Channel carrying messages for users connected to a worker"""
+    return f"zayion_worker_{worker_id}"[:CHANNEL_NAME_LIMIT]
+
+PRESENCE_CHANNEL = "zayion_presence"
+
+class Backplane(ABC):
+    """Publish/subscribe transport connecting WebSocket workers"""
+
+    async def start(self):
+        """Open backplane connections"""
+
+    async def stop(self):
+        """Close backplane connections"""
+
+    @abstractmethod
+    async def subscribe(self, channel: str, handler: MessageHandler):
+        """Start receiving messages published on a channel"""
+
+    @abstractmethod
+    async def unsubscribe(self, channel: str, handler: MessageHandler):
+        """Stop receiving messages published on a channel"""
+
+    @abstractmethod
+    async def publish(self, channel: str, message: dict):
+        """Publish a message to every subscriber of a channel"""
+
+class InProcessBackplane(Backplane):
+    """Backplane for managers living in one process (single worker and tests)"""
+
+    def __init__(self):
+        self._handlers: Dict[str, Set[MessageHandler]] = {}
+
+    async def subscribe(self, channel: str, handler: MessageHandler):
+        self._handlers.setdefault(channel, set()).add(handler)
+
+    async def unsubscribe(self, channel: str, handler: MessageHandler):
+        handlers = self._handlers.get(channel)
+        if handlers is not None:
+            handlers.discard(handler)
+            if not handlers:
+                del self._handlers[channel]
+
+    async def publish(self, channel: str, message: dict):
+        for handler in list(self._handlers.get(channel, ())):
+            try:
+                await handler(message)
+            except Exception as e:
+                logger.error(f"Error handling backplane message on {channel}: {e}")
+
+class PostgresBackplane(Backplane):
+    """Backplane over Postgres LISTEN/NOTIFY on a dedicated asyncpg connection"""
+
+    def __init__(self, dsn: str):
+        self.dsn = dsn
+        self._listen_conn = None
+        self._publish_conn = None
+        self._publish_lock = asyncio.Lock()
+        self._handlers: Dict[str, Set[MessageHandler]] = {}
+        self._reconnect_task: Optional[asyncio.Task] = None
+        self._stopping = False
+
+        # Notifications are handled one at a time so per-channel order is kept
+        self._inbox: "asyncio.Queue[Tuple[str, dict]]" = asyncio.Queue()
+        self._dispatch_task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        # One connection holds the LISTENs, the other sends NOTIFYs so
+        # publishing never waits behind notification delivery
+        self._stopping = False
+        self._listen_conn = await self._connect_listener()
+        self._publish_conn = await self._connect()
+        await self._publish_conn.execute(
+            f"CREATE UNLOGGED TABLE IF NOT EXISTS {PAYLOAD_TABLE} ("
+            "id BIGSERIAL PRIMARY KEY, payload TEXT NOT NULL, created_at TIMESTAMPTZ NOT NULL DEFAULT now())"
+        )
+        self._dispatch_task = asyncio.create_task(self._dispatch_loop())
+        logger.info("Postgres backplane connected")
+
+    async def stop(self):
+        self._stopping = True
+        for task in (self._reconnect_task, self._dispatch_task):
+            if task:
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+        self._reconnect_task = None
+        self._dispatch_task = None
+
+        for conn in (self._listen_conn, self._publish_conn):
+            if conn is not None and not conn.is_closed():
+                await conn.close()
+        self._listen_conn = None
+        self._publish_conn = None
+        self._handlers.clear()
+
+    async def subscribe(self, channel: str, handler: MessageHandler):
+        handlers = self._handlers.setdefault(channel, set())
+        if not handlers and self._listening():
+            await self._listen_conn.add_listener(channel, self._on_notify)
+        handlers.add(handler)
+
+    async def unsubscribe(self, channel: str, handler: MessageHandler):
+        handlers = self._handlers.get(channel)
+        if handlers is None:
+            return
+
+        handlers.discard(handler)
+        if not handlers:
+            del self._handlers[channel]
+            if self._listening():
+                await self._listen_conn.remove_listener(channel, self._on_notify)
+
+    async def publish(self, channel: str, message: dict):
+        payload = json.dumps(message, ensure_ascii=False)
+
+        async with self._publish_lock:
+            if self._publish_conn is None or self._publish_conn.is_closed():
+                self._publish_conn = await self._connect()
+
+            if len(payload.encode()) > NOTIFY_PAYLOAD_LIMIT:
+                payload_id = await self._publish_conn.fetchval(
+                    f"INSERT INTO {PAYLOAD_TABLE} (payload) VALUES ($1) RETURNING id", payload
+                )
+                await self._publish_conn.execute(
+                    f"DELETE FROM {PAYLOAD_TABLE} WHERE created_at < now() - make_interval(secs => $1)",
+                    PAYLOAD_RETENTION_SECONDS
+                )
+                payload = json.dumps({"payload_id": payload_id, "_spilled": True})
+
+            await self._publish_conn.execute("SELECT pg_notify($1, $2)", channel, payload)
+
+    async def _connect(self):
+        import asyncpg
+
+        return await asyncpg.connect(self.dsn)
+
+    async def _connect_listener(self):
+        conn = await self._connect()
+        conn.add_termination_listener(self._on_listener_lost)
+        return conn
+
+    def _listening(self) -> bool:
+        return self._listen_conn is not None and not self._listen_conn.is_closed()
+
+    def _on_listener_lost(self, connection):
+        """asyncpg termination callback, reopens the LISTEN connection in the background"""
+        if self._stopping or connection is not self._listen_conn:
+            return
+        logger.warning("Postgres backplane listener connection lost, reconnecting")
+        if self._reconnect_task is None or self._reconnect_task.done():
+            self._reconnect_task = asyncio.create_task(self._reconnect_listener())
+
+    async def _reconnect_listener(self):
+        """Reopen the LISTEN connection with backoff and listen again on every subscribed channel"""
+        delay = RECONNECT_MIN_SECONDS
+        while not self._stopping:
+            try:
+                conn = await self._connect_listener()
+                for channel in list(self._handlers):
+                    await conn.add_listener(channel, self._on_notify)
+                self._listen_conn = conn
+                logger.info(f"Postgres backplane listener reconnected, {len(self._handlers)} channels")
+                return
+            except Exception as e:
+                logger.error(f"Error reconnecting Postgres backplane listener: {e}")
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, RECONNECT_MAX_SECONDS)
+
+    def _on_notify(self, connection, pid: int, channel: str, payload: str):
+        """asyncpg listener callback, dispatches to the channel's handlers"""
+        try:
+            message = json.loads(payload)
+        except json.JSONDecodeError:
+            logger.warning(f"Ignoring malformed backplane payload on {channel}")
+            return
+
+        self._inbox.put_nowait((channel, message))
+
+    async def _load_spilled(self, payload_id: int) -> Optional[dict]:
+        """Read a message published through the payload table"""
+        async with self._publish_lock:
+            if self._publish_conn is None or self._publish_conn.is_closed():
+                self._publish_conn = await self._connect()
+            payload = await self._publish_conn.fetchval(
+                f"SELECT payload FROM {PAYLOAD_TABLE} WHERE id = $1", payload_id
+            )
+        return json.loads(payload) if payload is not None else None
+
+    async def _dispatch_loop(self):
+        """Deliver queued notifications to their handlers in arrival order"""
+        while True:
+            channel, message = await self._inbox.get()
+            if message.get("_spilled"):
+                try:
+                    message = await self._load_spilled(message["payload_id"])
+                except Exception as e:
+                    logger.error(f"Error loading backplane payload on {channel}: {e}")
+                    continue
+                if message is None:
+                    logger.warning(f"Backplane payload on {channel} expired before delivery")
+                    continue
+
+            for handler in list(self._handlers.get(channel, ())):
+                try:
+                    await handler(message)
+                except Exception as e:
+                    logger.error(f"Error handling backplane message on {channel}: {e}")
+
+def create_backplane() -> Backplane:
+    """Build the backplane selected by WS_BACKPLANE (memory or postgres)"""
+    kind = os.environ.get("WS_BACKPLANE", "memory").lower()
+
+    if kind == "postgres":
+        return PostgresBackplane(os.environ["DATABASE_URL"])
+    if kind != "memory":
+        logger.warning(f"Unknown WS_BACKPLANE {kind!r}, using in-process backplane")
+
+    return InProcessBackplane()
@@ -0,0 +1,153 @@
+import asyncio
+import logging
+import time
+from typing import Awaitable, Callable, Dict, Hashable, List, Optional, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Idle time after which the server sends a heartbeat, and how long the client has to answer it
+HEARTBEAT_INTERVAL_SECONDS = 25
+HEARTBEAT_TIMEOUT_SECONDS = 10
+
+class TimerWheel:
+    """Hierarchical timing wheel with O(1) schedule and cancel, advanced one tick at a time"""
+
+    def __init__(self, slots: int = 64, levels: int = 3):
+        self.slots = slots
+        self.levels = levels
+        self.current_tick = 0
+        self._wheels: List[List[Set[Hashable]]] = [[set() for _ in range(slots)] for _ in range(levels)]
+
+        # key -> (deadline tick, level, slot)
+        self._timers: Dict[Hashable, Tuple[int, int, int]] = {}
+
+    def __len__(self) -> int:
+        return len(self._timers)
+
+    def schedule(self, key: Hashable, ticks: int):
+        """Fire key after the given number of ticks, replacing any earlier timer"""
+        self.cancel(key)
+        self._place(key, self.current_tick + max(1, ticks))
+
+    def cancel(self, key: Hashable):
+        """Drop the timer for key, if any"""
+        timer = self._timers.pop(key, None)
+        if timer:
+            _, level, slot = timer
+            self._wheels[level][slot].discard(key)
+
+    def advance(self) -> List[Hashable]:
+        """Move one tick forward and return the keys whose deadline is now"""
+        self.current_tick += 1
+
+        # Bring timers from coarser wheels down as their span comes up
+        for level in range(self.levels - 1, 0, -1):
+            span = self.slots ** level
+            if self.current_tick % span == 0:
+                slot = (self.current_tick // span) % self.slots
+                keys = self._wheels[level][slot]
+                self._wheels[level][slot] = set()
+                for key in keys:
+                    deadline = self._timers.pop(key)[0]
+                    self._place(key, deadline)
+
+        slot = self.current_tick % self.slots
+        expired = self._wheels[0][slot]
+        self._wheels[0][slot] = set()
+        for key in expired:
+            del self._timers[key]
+        return list(expired)
+
+    def _place(self, key: Hashable, deadline: int):
+        deadline = max(deadline, self.current_tick)
+        remaining = deadline - self.current_tick
+
+        level = 0
+        while level < self.levels - 1 and remaining >= self.slots ** (level + 1):
+            level += 1
+        slot = (deadline // self.slots ** level) % self.slots
+
+        self._wheels[level][slot].add(key)
+        self._timers[key] = (deadline, level, slot)
+
+class HeartbeatMonitor:
+    """Sends heartbeats to idle connections and reaps the ones that stop answering"""
+
+    def __init__(self, send_heartbeat: Callable[[int], Awaitable[None]], reap: Callable[[int], Awaitable[None]],
+                 interval: float = HEARTBEAT_INTERVAL_SECONDS, timeout: float = HEARTBEAT_TIMEOUT_SECONDS,
+                 tick: float = 1.0):
+        self.send_heartbeat = send_heartbeat
+        self.reap = reap
+        self.interval = interval
+        self.timeout = timeout
+        self.tick = tick
+        self.wheel = TimerWheel()
+        self.reaped = 0
+
+        # Last frame received per connection: user_id -> monotonic time
+        self.last_activity: Dict[int, float] = {}
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        """Start driving the wheel"""
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def add(self, user_id: int):
+        """Start watching a connection"""
+        self.last_activity[user_id] = time.monotonic()
+        self.wheel.schedule(user_id, self._ticks(self.interval))
+
+    def remove(self, user_id: int):
+        """Stop watching a connection"""
+        self.last_activity.pop(user_id, None)
+        self.wheel.cancel(user_id)
+
+    def touch(self, user_id: int):
+        """Record activity on a connection; the timer is only revisited when it fires"""
+        if user_id in self.last_activity:
+            self.last_activity[user_id] = time.monotonic()
+
+    def _ticks(self, seconds: float) -> int:
+        return max(1, int(seconds / self.tick + 0.999))
+
+    async def _run(self):
+        next_tick = time.monotonic() + self.tick
+        while True:
+            await asyncio.sleep(max(0.0, next_tick - time.monotonic()))
+
+            # Catch up on ticks missed while the loop was busy
+            expired: List[int] = []
+            while next_tick <= time.monotonic():
+                expired.extend(self.wheel.advance())
+                next_tick += self.tick
+
+            if expired:
+                await asyncio.gather(*(self._check(user_id) for user_id in expired))
+
+    async def _check(self, user_id: int):
+        last_activity = self.last_activity.get(user_id)
+        if last_activity is None:
+            return
+
+        idle = time.monotonic() - last_activity
+        try:
+            if idle >= self.interval + self.timeout:
+                self.remove(user_id)
+                self.reaped += 1
+                await self.reap(user_id)
+            elif idle >= self.interval:
+                self.wheel.schedule(user_id, self._ticks(self.interval + self.timeout - idle))
+                await self.send_heartbeat(user_id)
+            else:
+                self.wheel.schedule(user_id, self._ticks(self.interval - idle))
+        except Exception as e:
+            logger.error(f"Error checking heartbeat for user {user_id}: {e}")
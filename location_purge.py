@@ -0,0 +1,97 @@
+import asyncio
+import logging
+import time
+from typing import Awaitable, Callable, List, Optional
+
+from sqlalchemy import text
+
+from models import SessionLocal
+
+logger = logging.getLogger(__name__)
+
+# How often expired positions are purged, and how long one run may take
+PURGE_INTERVAL_SECONDS = 300
+PURGE_TIME_BUDGET_SECONDS = 2.0
+
+# Rows deleted per transaction
+PURGE_CHUNK_SIZE = 1000
+
+# Deletes by physical row id so each chunk is a short, index-driven transaction;
+# rows another purger already holds are skipped rather than waited on
+PURGE_CHUNK_SQL = text("""
+    DELETE FROM location_data
+    WHERE ctid IN (
+        SELECT ctid FROM location_data
+        WHERE expires_at < now()
+        LIMIT :limit
+        FOR UPDATE SKIP LOCKED
+    )
+    RETURNING user_id
+""")
+
+class LocationPurger:
+    """Deletes expired location_data rows in bounded chunks and evicts the matching in-memory positions"""
+
+    def __init__(self, on_purged: Callable[[List[int]], Awaitable[None]],
+                 interval: float = PURGE_INTERVAL_SECONDS, time_budget: float = PURGE_TIME_BUDGET_SECONDS,
+                 chunk_size: int = PURGE_CHUNK_SIZE):
+        self.on_purged = on_purged
+        self.interval = interval
+        self.time_budget = time_budget
+        self.chunk_size = chunk_size
+
+        self.runs = 0
+        self.rows_purged = 0
+        self.last_run_rows = 0
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        """Start purging in the background"""
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def purge(self) -> int:
+        """Delete expired rows a chunk per transaction until none are left or the budget is spent"""
+        deadline = time.monotonic() + self.time_budget
+        purged = 0
+
+        while time.monotonic() < deadline:
+            async with SessionLocal() as db:
+                user_ids = (await db.scalars(PURGE_CHUNK_SQL, {"limit": self.chunk_size})).all()
+                await db.commit()
+
+            if user_ids:
+                purged += len(user_ids)
+                await self.on_purged(list(user_ids))
+            if len(user_ids) < self.chunk_size:
+                break
+
+        self.runs += 1
+        self.rows_purged += purged
+        self.last_run_rows = purged
+        if purged:
+            logger.info(f"Purged {purged} expired location rows")
+        return purged
+
+    def stats(self) -> dict:
+        return {
+            "runs": self.runs,
+            "rows_purged": self.rows_purged,
+            "last_run_rows": self.last_run_rows
+        }
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.purge()
+            except Exception as e:
+                logger.error(f"Error purging expired locations: {e}")
@@ -196,28 +196,37 @@ class LocationService:
         """Get nearby users within specified radius"""
         try:
             from models import SessionLocal, LocationData, User
+            from presence import presence
+            from sqlalchemy import select
+            from sqlalchemy.orm import contains_eager
             
-            db = SessionLocal()
-            try:
+            async with SessionLocal() as db:
                 # Get user's current location
-                user_location = db.query(LocationData).filter(LocationData.user_id == user_id).first()
+                user_location = await db.scalar(select(LocationData).where(LocationData.user_id == user_id).limit(1))
                 if not user_location:
                     return []
                 
                 # Get all other users with location data
-                query = db.query(LocationData).join(User).filter(
+                query = select(LocationData).join(User).where(
                     LocationData.user_id != user_id,
                     User.is_active == True,
                     User.location_sharing_enabled == True
-                )
+                ).options(contains_eager(LocationData.user))
                 
                 if not include_offline:
-                    query = query.filter(User.is_online == True)
+                    # The column trails live presence by one flush; users who went offline here are dropped below
+                    query = query.where(User.is_online == True)
                 
-                other_locations = query.all()
+                other_locations = (await db.scalars(query)).all()
                 
                 nearby_users = []
                 for location in other_locations:
+                    is_online, last_seen = presence.resolve(
+                        location.user_id, location.user.is_online, location.user.last_seen
+                    )
+                    if not include_offline and not is_online:
+                        continue
+                    
                     distance = self._calculate_distance(
                         user_location.latitude, user_location.longitude,
                         location.latitude, location.longitude
@@ -234,8 +243,8 @@ class LocationService:
                                 "accuracy": location.accuracy,
                                 "updated_at": location.updated_at.isoformat()
                             },
-                            "is_online": location.user.is_online,
-                            "last_seen": location.user.last_seen.isoformat() if location.user.last_seen else None
+                            "is_online": is_online,
+                            "last_seen": last_seen.isoformat() if last_seen else None
                         }
                         nearby_users.append(user_data)
                 
@@ -244,9 +253,6 @@ class LocationService:
                 
                 return nearby_users
                 
-            finally:
-                db.close()
-                
         except Exception as e:
             logger.error(f"Error getting nearby users for user {user_id}: {e}")
             return []
@@ -294,6 +300,20 @@ class LocationService:
         except Exception as e:
             logger.error(f"Error removing geofence for room {room_id}: {e}")
     
+    def forget_users(self, user_ids: List[int]):
+        """Drop the tracking state of users whose stored position expired"""
+        users = set(user_ids)
+        for user_id in users:
+            self.last_proximity_check.pop(user_id, None)
+            self.user_movement_history.pop(user_id, None)
+            self.movement_states.pop(user_id, None)
+        
+        # One pass over the pair caches for the whole batch
+        for key in [k for k in self.proximity_cache if k[0] in users or k[1] in users]:
+            del self.proximity_cache[key]
+        for key in [k for k in self.user_geofence_status if k[0] in users]:
+            del self.user_geofence_status[key]
+    
     async def get_user_movement_state(self, user_id: int) -> MovementState:
         """Get user's current movement state"""
         return self.movement_states.get(user_id, MovementState.UNKNOWN)
@@ -301,54 +321,46 @@ class LocationService:
     async def get_location_analytics(self, user_id: int, hours: int = 24) -> Dict[str, Any]:
         """Get location analytics for a user"""
         try:
-            from models import SessionLocal, LocationData
-            from sqlalchemy import func
-            
-            db = SessionLocal()
-            try:
-                since_time = datetime.utcnow() - timedelta(hours=hours)
-                
-                # Get movement history from database (if implemented)
-                # For now, use in-memory data
-                movement_history = self.user_movement_history.get(user_id, [])
-                recent_history = [
-                    loc for loc in movement_history 
-                    if loc.timestamp >= since_time
-                ]
-                
-                if not recent_history:
-                    return {"error": "No location data available"}
-                
-                # Calculate analytics
-                total_distance = 0.0
-                for i in range(1, len(recent_history)):
-                    distance = self._calculate_distance(
-                        recent_history[i-1].latitude, recent_history[i-1].longitude,
-                        recent_history[i].latitude, recent_history[i].longitude
-                    )
-                    total_distance += distance
-                
-                # Movement state distribution
-                movement_states = [self.movement_states.get(user_id, MovementState.UNKNOWN)]
-                
-                # Average accuracy
-                avg_accuracy = sum(loc.accuracy for loc in recent_history) / len(recent_history)
-                
-                return {
-                    "user_id": user_id,
-                    "period_hours": hours,
-                    "total_distance_meters": round(total_distance, 1),
-                    "location_updates": len(recent_history),
-                    "average_accuracy": round(avg_accuracy, 1),
-                    "current_movement_state": self.movement_states.get(user_id, MovementState.UNKNOWN).value,
-                    "time_stationary": 0,  # TODO: Calculate from movement states
-                    "time_walking": 0,     # TODO: Calculate from movement states
-                    "time_driving": 0      # TODO: Calculate from movement states
-                }
-                
-            finally:
-                db.close()
-                
+            since_time = datetime.utcnow() - timedelta(hours=hours)
+            
+            # Get movement history from database (if implemented)
+            # For now, use in-memory data
+            movement_history = self.user_movement_history.get(user_id, [])
+            recent_history = [
+                loc for loc in movement_history 
+                if loc.timestamp >= since_time
+            ]
+            
+            if not recent_history:
+                return {"error": "No location data available"}
+            
+            # Calculate analytics
+            total_distance = 0.0
+            for i in range(1, len(recent_history)):
+                distance = self._calculate_distance(
+                    recent_history[i-1].latitude, recent_history[i-1].longitude,
+                    recent_history[i].latitude, recent_history[i].longitude
+                )
+                total_distance += distance
+            
+            # Movement state distribution
+            movement_states = [self.movement_states.get(user_id, MovementState.UNKNOWN)]
+            
+            # Average accuracy
+            avg_accuracy = sum(loc.accuracy for loc in recent_history) / len(recent_history)
+            
+            return {
+                "user_id": user_id,
+                "period_hours": hours,
+                "total_distance_meters": round(total_distance, 1),
+                "location_updates": len(recent_history),
+                "average_accuracy": round(avg_accuracy, 1),
+                "current_movement_state": self.movement_states.get(user_id, MovementState.UNKNOWN).value,
+                "time_stationary": 0,  # TODO: Calculate from movement states
+                "time_walking": 0,     # TODO: Calculate from movement states
+                "time_driving": 0      # TODO: Calculate from movement states
+            }
+            
         except Exception as e:
             logger.error(f"Error getting location analytics for user {user_id}: {e}")
             return {"error": str(e)}
@@ -415,10 +427,10 @@ class LocationService:
         """Update location in database"""
         try:
             from models import SessionLocal, LocationData
+            from sqlalchemy import select
             
-            db = SessionLocal()
-            try:
-                location_data = db.query(LocationData).filter(LocationData.user_id == user_id).first()
+            async with SessionLocal() as db:
+                location_data = await db.scalar(select(LocationData).where(LocationData.user_id == user_id).limit(1))
                 
                 if not location_data:
                     location_data = LocationData(user_id=user_id)
@@ -433,10 +445,7 @@ class LocationService:
                 location_data.updated_at = location.timestamp
                 location_data.expires_at = location.timestamp + timedelta(hours=24)
                 
-                db.commit()
-                
-            finally:
-                db.close()
+                await db.commit()
                 
         except Exception as e:
             logger.error(f"Error updating location in database for user {user_id}: {e}")
@@ -445,18 +454,17 @@ class LocationService:
         """Check proximity to other users"""
         try:
             from models import SessionLocal, LocationData, User, Friend
-            from sqlalchemy import and_, or_
+            from sqlalchemy import select, and_, or_
             
-            db = SessionLocal()
-            try:
+            async with SessionLocal() as db:
                 # Get user's friends with location sharing enabled
-                friends_query = db.query(LocationData).join(User).join(
+                friends_query = select(LocationData).join(User).join(
                     Friend, 
                     or_(
                         and_(Friend.user1_id == user_id, Friend.user2_id == User.id),
                         and_(Friend.user2_id == user_id, Friend.user1_id == User.id)
                     )
-                ).filter(
+                ).where(
                     User.is_active == True,
                     User.location_sharing_enabled == True,
                     Friend.is_active == True,
@@ -464,7 +472,7 @@ class LocationService:
                     LocationData.user_id != user_id
                 )
                 
-                friend_locations = friends_query.all()
+                friend_locations = (await db.scalars(friends_query)).all()
                 
                 proximity_events = []
                 
@@ -507,9 +515,6 @@ class LocationService:
                 
                 return proximity_events
                 
-            finally:
-                db.close()
-                
         except Exception as e:
             logger.error(f"Error checking user proximity for user {user_id}: {e}")
             return []
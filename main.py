@@ -4,77 +4,85 @@ from dotenv import load_dotenv
 # Load environment variables from .env file
 load_dotenv()
 import asyncio
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException, Depends, status
+from fastapi import FastAPI, WebSocket, WebSocketDisconnect, Request, status
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker, Session
+from fastapi.responses import FileResponse, JSONResponse
+from sqlalchemy import text
 from contextlib import asynccontextmanager
 import jwt
 from datetime import datetime, timedelta
-from typing import Optional
+from typing import Optional, Tuple
 import json
 import logging
+import math
 
-from models import Base, User, Room, Message, FriendRequest, Friend, LocationData
+from models import Base, Room, Message, FriendRequest, Friend, LocationData, engine, get_db, SECRET_KEY, ALGORITHM, SCHEMA_UPGRADES, MESSAGE_MIGRATIONS_APPLIED
 from routes import router
 from websocket_handler import WebSocketManager
+from ws_dispatch import ConnectionDispatcher
+from presence import presence
+from auth_cache import user_cache, claims_cache
+from auth import decode_token
+from message_writer import message_writer
+from rate_limit import EXEMPT_TYPES, MESSAGE_LIMITS, admission, rate_limiter
+from query_stats import DEBUG, counting, query_stats
 from ai_service import AIService
 from location_service import LocationService
+from room_reaper import RoomReaper
+from location_purge import LocationPurger
+from message_archive import message_archiver
+from message_search import message_search
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# Database configuration
-DATABASE_URL = os.environ.get("DATABASE_URL")
-if not DATABASE_URL:
-    logger.error("DATABASE_URL environment variable must be set")
-    exit(1)
-
-# Create database engine
-engine = create_engine(
-    DATABASE_URL,
-    pool_recycle=300,
-    pool_pre_ping=True,
-    echo=False  # Set to True for SQL debugging
-)
-
-# Create session factory
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
-
-# JWT Configuration
-JWT_SECRET_KEY = os.environ.get("JWT_SECRET_KEY", "zayion-secret-key-change-in-production")
-JWT_ALGORITHM = "HS256"
+# JWT Configuration, shared with models.create_access_token which issues the tokens
+JWT_SECRET_KEY = SECRET_KEY
+JWT_ALGORITHM = ALGORITHM
 JWT_EXPIRATION_HOURS = 24 * 7  # 7 days
 
-# Security
-security = HTTPBearer()
+# WebSocket subprotocol carrying the JWT as the next offered protocol
+WS_AUTH_SUBPROTOCOL = "bearer"
 
 # Global instances
 websocket_manager = WebSocketManager()
 ai_service = AIService()
 location_service = LocationService()
 
-def create_tables():
+async def close_expired_rooms(room_ids):
+    """Close expired rooms for their members and drop their geofences"""
+    await websocket_manager.expire_rooms(room_ids)
+    for room_id in room_ids:
+        await location_service.remove_geofence(room_id)
+
+room_reaper = RoomReaper(close_expired_rooms, websocket_manager.close_memberships)
+
+async def forget_expired_locations(user_ids):
+    """Evict positions whose location_data rows were purged"""
+    websocket_manager.forget_locations(user_ids)
+    location_service.forget_users(user_ids)
+
+location_purger = LocationPurger(forget_expired_locations)
+
+async def create_tables():
     """Create database tables"""
     try:
-        Base.metadata.create_all(bind=engine)
+        async with engine.begin() as conn:
+            await conn.run_sync(Base.metadata.create_all)
+            
+            # Rewriting messages is a one-time migration run ahead of the deploy, never at startup
+            if not await conn.scalar(text(MESSAGE_MIGRATIONS_APPLIED)):
+                raise RuntimeError("messages is not migrated; run `python migrate.py` before starting")
+            
+            for statement in SCHEMA_UPGRADES:
+                await conn.execute(text(statement))
         logger.info("Database tables created successfully")
     except Exception as e:
         logger.error(f"Failed to create database tables: {e}")
         raise
 
-def get_db():
-    """Database dependency"""
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
-
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     """Create JWT access token"""
     to_encode = data.copy()
@@ -87,47 +95,23 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     encoded_jwt = jwt.encode(to_encode, JWT_SECRET_KEY, algorithm=JWT_ALGORITHM)
     return encoded_jwt
 
-def verify_token(credentials: HTTPAuthorizationCredentials = Depends(security)):
-    """Verify JWT token and return user data"""
-    token = credentials.credentials
-    try:
-        payload = jwt.decode(token, JWT_SECRET_KEY, algorithms=[JWT_ALGORITHM])
-        user_id: int = payload.get("sub")
-        if user_id is None:
-            raise HTTPException(
-                status_code=status.HTTP_401_UNAUTHORIZED,
-                detail="Could not validate credentials",
-                headers={"WWW-Authenticate": "Bearer"},
-            )
-        return {"user_id": user_id}
-    except jwt.PyJWTError:
-        raise HTTPException(
-            status_code=status.HTTP_401_UNAUTHORIZED,
-            detail="Could not validate credentials",
-            headers={"WWW-Authenticate": "Bearer"},
-        )
-
-def get_current_user(token_data: dict = Depends(verify_token), db: Session = Depends(get_db)):
-    """Get current user from token"""
-    user_id = token_data["user_id"]
-    user = db.query(User).filter(User.id == user_id).first()
-    if user is None:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="User not found"
-        )
-    return user
-
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """Application lifespan events"""
     # Startup
     logger.info("Starting Zayion application...")
-    create_tables()
+    await create_tables()
     
     # Initialize services
     await ai_service.initialize()
     await location_service.initialize()
+    await presence.start()
+    await admission.start()
+    await message_writer.start()
+    await websocket_manager.start()
+    await room_reaper.start()
+    await location_purger.start()
+    await message_archiver.start()
     
     logger.info("Zayion application started successfully")
     
@@ -135,9 +119,19 @@ async def lifespan(app: FastAPI):
     
     # Shutdown
     logger.info("Shutting down Zayion application...")
-    await websocket_manager.disconnect_all()
+    await room_reaper.stop()
+    await location_purger.stop()
+    await message_archiver.stop()
+    await websocket_manager.drain()
+    await websocket_manager.stop()
+    await message_writer.stop()
+    
+    # One bulk write for everyone disconnected above
+    await presence.stop()
+    await admission.stop()
     await ai_service.cleanup()
     await location_service.cleanup()
+    await engine.dispose()
     logger.info("Zayion application shutdown complete")
 
 # Create FastAPI app
@@ -148,6 +142,59 @@ app = FastAPI(
     lifespan=lifespan
 )
 
+# Rate limiting and admission control for the REST API
+@app.middleware("http")
+async def limit_api_requests(request: Request, call_next):
+    """Reject API requests early when the server is overloaded or a client is over budget"""
+    if not request.url.path.startswith("/api"):
+        return await call_next(request)
+    
+    if not admission.admit():
+        return JSONResponse(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            content={"detail": "Server is busy, try again shortly"},
+            headers={"Retry-After": "1"}
+        )
+    
+    # Charge the user when the request carries a valid token, always charge the address
+    user_id = None
+    authorization = request.headers.get("authorization", "")
+    if authorization.lower().startswith("bearer "):
+        try:
+            user_id = decode_token(authorization[7:])
+        except (jwt.PyJWTError, ValueError):
+            pass
+    
+    message_class = "rooms_nearby" if request.url.path == "/api/rooms/nearby" else "rest"
+    retry_after = rate_limiter.check(message_class, user_id, request.client.host if request.client else None)
+    if retry_after:
+        return JSONResponse(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            content={"detail": "Rate limit exceeded"},
+            headers={"Retry-After": str(math.ceil(retry_after))}
+        )
+    
+    return await call_next(request)
+
+# Query counts per API endpoint
+@app.middleware("http")
+async def count_api_queries(request: Request, call_next):
+    """Count the statements and database time of each API request"""
+    if not request.url.path.startswith("/api"):
+        return await call_next(request)
+    
+    with counting() as count:
+        response = await call_next(request)
+    
+    # Record under the route template so ids in the path don't each get their own entry
+    route = request.scope.get("route")
+    query_stats.record(f"{request.method} {route.path}" if route else "other", count)
+    
+    if DEBUG:
+        response.headers["X-DB-Queries"] = str(count.statements)
+        response.headers["X-DB-Time-Ms"] = f"{count.db_time * 1000:.1f}"
+    return response
+
 # Configure CORS
 app.add_middleware(
     CORSMiddleware,
@@ -161,50 +208,87 @@ app.add_middleware(
 app.include_router(router, prefix="/api")
 
 # WebSocket endpoint
+def get_handshake_token(websocket: WebSocket) -> Tuple[Optional[str], Optional[str]]:
+    """Get the JWT offered on a WebSocket handshake and the subprotocol to accept"""
+    protocols = websocket.scope.get("subprotocols") or []
+    if len(protocols) >= 2 and protocols[0] == WS_AUTH_SUBPROTOCOL:
+        return protocols[1], WS_AUTH_SUBPROTOCOL
+    return websocket.query_params.get("token"), None
+
+async def authenticate_handshake(token: str) -> Optional[int]:
+    """Resolve a handshake JWT to an existing, active user id"""
+    try:
+        user_id = decode_token(token)
+    except (jwt.PyJWTError, ValueError):
+        return None
+    
+    if user_id is None:
+        return None
+    
+    user = await user_cache.get(user_id)
+    return user_id if user and user.is_active else None
+
+def check_ws_message(user_id: int, client_ip: Optional[str], message: dict) -> Optional[dict]:
+    """Error frame for a WebSocket message that is over budget or arrives while overloaded"""
+    message_type = message.get("type")
+    if message_type in EXEMPT_TYPES:
+        return None
+    
+    if not admission.admit():
+        return {
+            "type": "error",
+            "code": "overloaded",
+            "message": "Server is busy, try again shortly",
+            "request_type": message_type
+        }
+    
+    message_class = message_type if message_type in MESSAGE_LIMITS else "ws_other"
+    retry_after = rate_limiter.check(message_class, user_id, client_ip)
+    if retry_after:
+        return {
+            "type": "error",
+            "code": "rate_limited",
+            "message": "Rate limit exceeded",
+            "request_type": message_type,
+            "retry_after": round(retry_after, 2)
+        }
+    
+    return None
+
 @app.websocket("/ws")
 async def websocket_endpoint(websocket: WebSocket):
     """WebSocket endpoint for real-time communication"""
-    await websocket.accept()
     user_id = None
+    dispatcher = None
+    
+    # Refuse new connections while shutting down, the client reconnects elsewhere
+    if websocket_manager.draining:
+        await websocket.close(code=1012)
+        return
+    
+    # Refuse new connections outright while overloaded
+    if not admission.admit():
+        await websocket.close(code=status.WS_1013_TRY_AGAIN_LATER)
+        return
+    
+    # Authenticate from the handshake, before accepting; connections without a valid token are refused
+    token, subprotocol = get_handshake_token(websocket)
+    user_id = await authenticate_handshake(token) if token else None
+    if not user_id:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
+    
+    await websocket.accept(subprotocol=subprotocol)
     
     try:
-        # Wait for authentication message
-        auth_message = await websocket.receive_text()
-        auth_data = json.loads(auth_message)
-        
-        if auth_data.get("type") != "authenticate":
-            await websocket.send_text(json.dumps({
-                "type": "error",
-                "message": "Authentication required"
-            }))
-            await websocket.close()
-            return
-        
-        user_id = auth_data.get("userId")
-        if not user_id:
-            await websocket.send_text(json.dumps({
-                "type": "error",
-                "message": "User ID required"
-            }))
-            await websocket.close()
-            return
-        
-        # Verify user exists
-        db = SessionLocal()
+        # Resume cursors travel in the query string alongside the token
         try:
-            user = db.query(User).filter(User.id == user_id).first()
-            if not user:
-                await websocket.send_text(json.dumps({
-                    "type": "error",
-                    "message": "Invalid user"
-                }))
-                await websocket.close()
-                return
-        finally:
-            db.close()
+            resume = json.loads(websocket.query_params.get("resume") or "{}")
+        except json.JSONDecodeError:
+            resume = {}
         
         # Connect user to WebSocket manager
-        await websocket_manager.connect(user_id, websocket)
+        await websocket_manager.connect(user_id, websocket, resume)
         
         # Send connection confirmation
         await websocket.send_text(json.dumps({
@@ -212,12 +296,32 @@ async def websocket_endpoint(websocket: WebSocket):
             "message": "Successfully connected to Zayion"
         }))
         
-        # Handle messages
+        # Handle messages concurrently, keeping order per room and message type
+        dispatcher = ConnectionDispatcher(lambda message: websocket_manager.handle_message(user_id, message))
+        client_ip = websocket.client.host if websocket.client else None
         while True:
             try:
                 data = await websocket.receive_text()
                 message = json.loads(data)
-                await websocket_manager.handle_message(user_id, message)
+                
+                # Any frame counts as liveness; heartbeat acks need nothing else
+                websocket_manager.touch(user_id)
+                if message.get("type") == "heartbeat_ack":
+                    continue
+                
+                rejection = check_ws_message(user_id, client_ip, message)
+                if rejection:
+                    await websocket.send_text(json.dumps(rejection))
+                    continue
+                
+                # Refused rather than waited on, so the reader keeps answering pings
+                if not await dispatcher.submit(message):
+                    await websocket.send_text(json.dumps({
+                        "type": "error",
+                        "code": "too_many_in_flight",
+                        "message": "Too many messages in progress, try again shortly",
+                        "request_type": message.get("type")
+                    }))
             except json.JSONDecodeError:
                 await websocket.send_text(json.dumps({
                     "type": "error",
@@ -235,8 +339,32 @@ async def websocket_endpoint(websocket: WebSocket):
     except Exception as e:
         logger.error(f"WebSocket error: {e}")
     finally:
+        if dispatcher:
+            await dispatcher.close()
         if user_id:
-            await websocket_manager.disconnect(user_id)
+            await websocket_manager.disconnect(user_id, websocket)
+
+# Metrics endpoint
+@app.get("/metrics")
+async def metrics():
+    """Runtime metrics for this worker"""
+    return {
+        "timestamp": datetime.utcnow().isoformat(),
+        "websocket": websocket_manager.get_stats(),
+        "auth": {
+            "claims_cache": claims_cache.stats(),
+            "user_cache": user_cache.stats()
+        },
+        "admission": {
+            **admission.stats(),
+            "rate_limited": rate_limiter.rejected
+        },
+        "queries": query_stats.stats(),
+        "rooms": room_reaper.stats(),
+        "location_purge": location_purger.stats(),
+        "message_archive": message_archiver.stats(),
+        "message_search": message_search.stats()
+    }
 
 # Serve static files (for production)
 if os.path.exists("dist"):
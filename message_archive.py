@@ -0,0 +1,291 @@
+import asyncio
+import gzip
+import json
+import logging
+import os
+import re
+import time
+from datetime import datetime, timedelta, timezone
+from typing import List, Optional, Tuple
+
+from sqlalchemy import and_, case, delete, select, text
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.orm import contains_eager
+
+from models import Message, Room, SessionLocal, engine
+
+logger = logging.getLogger(__name__)
+
+# Where archived history is written, one directory per room
+ARCHIVE_DIR = os.environ.get("MESSAGE_ARCHIVE_DIR", "archive/messages")
+
+# Messages leave the hot table this long after being written: sooner for closed rooms, eventually for all
+ARCHIVE_CLOSED_ROOMS_AFTER_DAYS = int(os.environ.get("ARCHIVE_CLOSED_ROOMS_AFTER_DAYS", 30))
+HOT_RETENTION_DAYS = int(os.environ.get("MESSAGE_HOT_RETENTION_DAYS", 180))
+
+# How often the archiver runs, how long one run may take, and how many rows each archive file holds
+ARCHIVE_INTERVAL_SECONDS = 3600
+ARCHIVE_TIME_BUDGET_SECONDS = 30
+ARCHIVE_CHUNK_SIZE = 5000
+ARCHIVE_ROOMS_PER_RUN = 100
+
+# Monthly partitions created ahead of time, so inserts always have a partition to land in
+PARTITION_MONTHS_AHEAD = 2
+
+# SQLSTATEs of a month that is already covered: duplicate_table, and invalid_object_definition for an overlap
+PARTITION_EXISTS_SQLSTATES = {"42P07", "42P17"}
+
+# How long a plain DETACH may wait for its lock on messages when a default partition rules out CONCURRENTLY
+DETACH_LOCK_TIMEOUT = "2s"
+
+_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+def _sqlstate(error: DBAPIError) -> Optional[str]:
+    """SQLSTATE of a database error raised through the asyncpg adapter"""
+    return getattr(error.orig, "sqlstate", None) or getattr(error.orig.__cause__, "sqlstate", None)
+_PARTITION_UPPER_BOUND = re.compile(r"TO \('(\d{4}-\d{2}-\d{2})")
+
+def _position(created_at: datetime, message_id: int) -> Tuple[int, int]:
+    """History order key as integers, which also name archive files so they sort in order"""
+    return (created_at - _EPOCH) // timedelta(microseconds=1), message_id
+
+def _month_start(moment: datetime, months: int = 0) -> datetime:
+    month = moment.year * 12 + moment.month - 1 + months
+    return datetime(month // 12, month % 12 + 1, 1, tzinfo=timezone.utc)
+
+class MessageArchive:
+    """Archived room history as gzipped NDJSON files, each holding a contiguous run of messages"""
+
+    def __init__(self, root: str = ARCHIVE_DIR):
+        self.root = root
+
+    def _room_dir(self, room_id: int) -> str:
+        return os.path.join(self.root, f"room_{room_id}")
+
+    async def write(self, room_id: int, messages: List[dict]):
+        """Durably write messages, oldest first, before they are deleted from the hot table"""
+        await asyncio.to_thread(self._write, room_id, messages)
+
+    def _write(self, room_id: int, messages: List[dict]):
+        room_dir = self._room_dir(room_id)
+        os.makedirs(room_dir, exist_ok=True)
+
+        first = messages[0]
+        micros, message_id = _position(datetime.fromisoformat(first["created_at"]), first["id"])
+        path = os.path.join(room_dir, f"{micros:020d}_{message_id:012d}.ndjson.gz")
+
+        # Written to a temporary name and renamed, so readers never see a partial file
+        partial = f"{path}.{os.getpid()}.partial"
+        with open(partial, "wb") as raw_file:
+            with gzip.GzipFile(fileobj=raw_file, mode="wb") as archive_file:
+                for message in messages:
+                    archive_file.write((json.dumps(message) + "\n").encode("utf-8"))
+            raw_file.flush()
+            os.fsync(raw_file.fileno())
+        os.replace(partial, path)
+
+    async def read_before(self, room_id: int, before: Optional[Tuple[datetime, int]], limit: int) -> List[dict]:
+        """Archived messages older than before, newest first"""
+        return await asyncio.to_thread(self._read_before, room_id, before, limit)
+
+    def _read_before(self, room_id: int, before: Optional[Tuple[datetime, int]], limit: int) -> List[dict]:
+        room_dir = self._room_dir(room_id)
+        if limit <= 0 or not os.path.isdir(room_dir):
+            return []
+
+        before_position = _position(*before) if before else None
+        found: List[dict] = []
+
+        # Newest file first; a file starting at or after the cursor holds nothing older than it
+        for name in sorted((n for n in os.listdir(room_dir) if n.endswith(".ndjson.gz")), reverse=True):
+            micros, message_id = name[:-len(".ndjson.gz")].split("_")
+            if before_position and (int(micros), int(message_id)) >= before_position:
+                continue
+
+            with gzip.open(os.path.join(room_dir, name), "rt", encoding="utf-8") as archive_file:
+                messages = [json.loads(line) for line in archive_file]
+
+            for message in reversed(messages):
+                position = _position(datetime.fromisoformat(message["created_at"]), message["id"])
+                if before_position is None or position < before_position:
+                    found.append(message)
+
+            if len(found) >= limit:
+                break
+
+        return found[:limit]
+
+class MessageArchiver:
+    """Moves old messages out of the partitioned hot table into the archive and drops emptied partitions"""
+
+    def __init__(self, archive: MessageArchive, interval: float = ARCHIVE_INTERVAL_SECONDS,
+                 time_budget: float = ARCHIVE_TIME_BUDGET_SECONDS, chunk_size: int = ARCHIVE_CHUNK_SIZE):
+        self.archive = archive
+        self.interval = interval
+        self.time_budget = time_budget
+        self.chunk_size = chunk_size
+
+        self.runs = 0
+        self.messages_archived = 0
+        self.partitions_dropped = 0
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        """Make sure upcoming partitions exist, then archive in the background"""
+        await self.ensure_partitions()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def ensure_partitions(self):
+        """Create the monthly partitions for this month and the next few"""
+        now = datetime.now(timezone.utc)
+        for months in range(PARTITION_MONTHS_AHEAD + 1):
+            start, end = _month_start(now, months), _month_start(now, months + 1)
+            name = f"messages_p{start:%Y%m}"
+            try:
+                async with SessionLocal() as db:
+                    await db.execute(text(
+                        f"CREATE TABLE IF NOT EXISTS {name} PARTITION OF messages "
+                        f"FOR VALUES FROM ('{start.isoformat()}') TO ('{end.isoformat()}')"
+                    ))
+                    await db.commit()
+            except DBAPIError as e:
+                if _sqlstate(e) in PARTITION_EXISTS_SQLSTATES:
+                    # The month is already covered, by the pre-partitioning table
+                    logger.debug(f"Not creating message partition {name}: {e}")
+                else:
+                    # Once the month starts without a partition every message insert fails
+                    logger.error(f"Failed to create message partition {name}: {e}")
+
+    async def archive_old_messages(self) -> int:
+        """Archive messages past their cutoff a chunk per transaction, within the time budget"""
+        deadline = time.monotonic() + self.time_budget
+        now = datetime.now(timezone.utc)
+        closed_cutoff = now - timedelta(days=ARCHIVE_CLOSED_ROOMS_AFTER_DAYS)
+        hot_cutoff = now - timedelta(days=HOT_RETENTION_DAYS)
+
+        async with SessionLocal() as db:
+            cutoff = case((Room.is_active == True, hot_cutoff), else_=closed_cutoff)
+            rooms = (await db.execute(
+                select(Room.id, Room.is_active).where(
+                    select(Message.id).where(
+                        and_(Message.room_id == Room.id, Message.created_at < cutoff)
+                    ).exists()
+                ).limit(ARCHIVE_ROOMS_PER_RUN)
+            )).all()
+
+        archived = 0
+        for room_id, is_active in rooms:
+            room_cutoff = hot_cutoff if is_active else closed_cutoff
+            while time.monotonic() < deadline:
+                count = await self._archive_chunk(room_id, room_cutoff)
+                archived += count
+                if count < self.chunk_size:
+                    break
+            if time.monotonic() >= deadline:
+                break
+
+        self.messages_archived += archived
+        if archived:
+            logger.info(f"Archived {archived} messages from {len(rooms)} rooms")
+        return archived
+
+    async def _archive_chunk(self, room_id: int, cutoff: datetime) -> int:
+        """Write a room's oldest messages to the archive, then delete them from the hot table"""
+        async with SessionLocal() as db:
+            messages = (await db.scalars(
+                select(Message).join(Message.user)
+                .where(and_(Message.room_id == room_id, Message.created_at < cutoff))
+                .options(contains_eager(Message.user))
+                .order_by(Message.created_at, Message.id)
+                .limit(self.chunk_size)
+                # Archivers on other workers take the next rows instead, keeping each file a contiguous run
+                .with_for_update(of=Message, skip_locked=True)
+            )).all()
+            if not messages:
+                return 0
+
+            # The file is durable before the rows go; a failed delete only leaves rows readers skip as duplicates
+            await self.archive.write(room_id, [message.to_dict() for message in messages])
+            await db.execute(
+                delete(Message).where(
+                    and_(
+                        Message.room_id == room_id,
+                        Message.created_at < cutoff,
+                        Message.id.in_([message.id for message in messages])
+                    )
+                ).execution_options(synchronize_session=False)
+            )
+            await db.commit()
+            return len(messages)
+
+    async def drop_empty_partitions(self):
+        """Detach and drop partitions wholly older than the closed-room cutoff once archiving has emptied them
+
+        Dropping an attached partition locks all of messages; detaching it concurrently first does not.
+        """
+        drop_before = (datetime.now(timezone.utc) - timedelta(days=ARCHIVE_CLOSED_ROOMS_AFTER_DAYS)).date()
+
+        # DETACH ... CONCURRENTLY cannot run inside a transaction block
+        async with engine.connect() as conn:
+            conn = await conn.execution_options(isolation_level="AUTOCOMMIT")
+            partitions = (await conn.execute(text(
+                "SELECT c.relname, pg_get_expr(c.relpartbound, c.oid), i.inhdetachpending "
+                "FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+                "WHERE i.inhparent = 'messages'::regclass"
+            ))).all()
+            has_default = any(bound == "DEFAULT" for _, bound, _ in partitions)
+
+            for name, bound, detach_pending in partitions:
+                upper = _PARTITION_UPPER_BOUND.search(bound or "")
+                if not upper or datetime.strptime(upper.group(1), "%Y-%m-%d").date() > drop_before:
+                    continue
+
+                if await conn.scalar(text(f'SELECT EXISTS (SELECT 1 FROM "{name}")')):
+                    continue
+
+                if detach_pending:
+                    # An earlier concurrent detach was interrupted
+                    await conn.execute(text(f'ALTER TABLE messages DETACH PARTITION "{name}" FINALIZE'))
+                elif has_default:
+                    await conn.execute(text(f"SET lock_timeout = '{DETACH_LOCK_TIMEOUT}'"))
+                    try:
+                        await conn.execute(text(f'ALTER TABLE messages DETACH PARTITION "{name}"'))
+                    finally:
+                        await conn.execute(text("RESET lock_timeout"))
+                else:
+                    await conn.execute(text(f'ALTER TABLE messages DETACH PARTITION "{name}" CONCURRENTLY'))
+
+                await conn.execute(text(f'DROP TABLE "{name}"'))
+                self.partitions_dropped += 1
+                logger.info(f"Dropped empty message partition {name}")
+
+    def stats(self) -> dict:
+        return {
+            "runs": self.runs,
+            "messages_archived": self.messages_archived,
+            "partitions_dropped": self.partitions_dropped
+        }
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.ensure_partitions()
+                await self.archive_old_messages()
+                await self.drop_empty_partitions()
+                self.runs += 1
+            except Exception as e:
+                logger.error(f"Error archiving messages: {e}")
+
+# Shared between the archiver and the history read path
+message_archive = MessageArchive()
+message_archiver = MessageArchiver(message_archive)
@@ -0,0 +1,220 @@
+import logging
+import math
+import os
+import re
+from collections import Counter, OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import and_, desc, func, literal_column, select, text
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import contains_eager
+
+from models import Message
+
+logger = logging.getLogger(__name__)
+
+# "auto" uses the GIN index when the database has it, "database" or "memory" force one backend
+SEARCH_BACKEND = os.environ.get("MESSAGE_SEARCH_BACKEND", "auto")
+
+# Text search configuration of messages.search_vector; no stemming, since chat mixes languages
+SEARCH_CONFIG = "simple"
+
+# In-process fallback: most recent messages indexed per room, and most rooms indexed at once
+MAX_INDEXED_MESSAGES = 20000
+MAX_INDEXED_ROOMS = 1000
+
+# BM25 parameters for ranking in-process results
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+# Queries are parsed with the same configuration as the stored documents
+_config = literal_column(f"'{SEARCH_CONFIG}'::regconfig")
+
+_TOKEN = re.compile(r"\w+")
+
+def tokenize(content: str) -> List[str]:
+    """Lowercased word tokens of a message"""
+    return _TOKEN.findall(content.lower())
+
+class RoomSearchIndex:
+    """Inverted index over a room's most recent messages, ranked with BM25"""
+
+    def __init__(self, max_messages: int = MAX_INDEXED_MESSAGES):
+        self.max_messages = max_messages
+
+        # token -> {message_id: term frequency}
+        self.postings: Dict[str, Dict[int, int]] = {}
+
+        # message_id -> (document length, distinct tokens), oldest first; message bodies stay in the database
+        self.documents: "OrderedDict[int, Tuple[int, Tuple[str, ...]]]" = OrderedDict()
+        self.total_length = 0
+
+    def add(self, message_id: int, content: str):
+        """Index a message, dropping the oldest one once the room is at capacity"""
+        if message_id in self.documents:
+            return
+
+        terms = Counter(tokenize(content or ""))
+        length = sum(terms.values())
+        self.documents[message_id] = (length, tuple(terms))
+        self.total_length += length
+        for token, count in terms.items():
+            self.postings.setdefault(token, {})[message_id] = count
+
+        while len(self.documents) > self.max_messages:
+            self._remove_oldest()
+
+    def search(self, query: str, offset: int, limit: int) -> List[Tuple[int, float]]:
+        """Ids and scores of messages containing every query token, best match first"""
+        tokens = list(dict.fromkeys(tokenize(query)))
+        if not tokens or not self.documents:
+            return []
+
+        postings = [self.postings.get(token, {}) for token in tokens]
+        if not all(postings):
+            return []
+
+        # Intersect from the rarest token so the candidate set starts small
+        postings.sort(key=len)
+        candidates = set(postings[0])
+        for posting in postings[1:]:
+            candidates.intersection_update(posting)
+            if not candidates:
+                return []
+
+        count = len(self.documents)
+        average_length = self.total_length / count or 1.0
+        idf = [math.log(1 + (count - len(posting) + 0.5) / (len(posting) + 0.5)) for posting in postings]
+
+        scored = []
+        for message_id in candidates:
+            length = self.documents[message_id][0]
+            score = 0.0
+            for weight, posting in zip(idf, postings):
+                frequency = posting[message_id]
+                score += weight * frequency * (BM25_K1 + 1) / (
+                    frequency + BM25_K1 * (1 - BM25_B + BM25_B * length / average_length)
+                )
+            scored.append((score, message_id))
+
+        scored.sort(reverse=True)
+        return [(message_id, score) for score, message_id in scored[offset:offset + limit]]
+
+    def _remove_oldest(self):
+        message_id, (length, tokens) = self.documents.popitem(last=False)
+        self.total_length -= length
+        for token in tokens:
+            posting = self.postings.get(token)
+            if posting is not None:
+                posting.pop(message_id, None)
+                if not posting:
+                    del self.postings[token]
+
+class MessageSearch:
+    """Room history search through the tsvector GIN index, or in-process indexes when the database has none"""
+
+    def __init__(self, backend: str = SEARCH_BACKEND, max_rooms: int = MAX_INDEXED_ROOMS):
+        self.backend = backend
+        self.max_rooms = max_rooms
+        self.rooms: "OrderedDict[int, RoomSearchIndex]" = OrderedDict()
+        self._database_available: Optional[bool] = None
+
+    async def search(self, db: AsyncSession, room_id: int, query: str, offset: int, limit: int) -> List[dict]:
+        """Ranked matches in a room's history, up to limit from offset"""
+        if await self._use_database(db):
+            return await self._search_database(db, room_id, query, offset, limit)
+
+        index = self.rooms.get(room_id)
+        if index is None:
+            index = await self._build_room_index(db, room_id)
+        else:
+            self.rooms.move_to_end(room_id)
+        return await self._load_matches(db, room_id, index.search(query, offset, limit))
+
+    def add(self, room_id: int, message: dict):
+        """Add a newly written message to its room's index, if the room is indexed here"""
+        index = self.rooms.get(room_id)
+        if index is not None and not message.get("is_deleted"):
+            index.add(message["id"], message.get("content"))
+
+    def stats(self) -> dict:
+        return {
+            "backend": "database" if self._database_available else "memory",
+            "indexed_rooms": len(self.rooms),
+            "indexed_messages": sum(len(index.documents) for index in self.rooms.values())
+        }
+
+    async def _use_database(self, db: AsyncSession) -> bool:
+        if self.backend != "auto":
+            return self.backend == "database"
+
+        if self._database_available is None:
+            self._database_available = bool(await db.scalar(
+                text("SELECT to_regclass('idx_message_search_vector') IS NOT NULL")
+            ))
+            logger.info(f"Message search using {'database' if self._database_available else 'in-process'} index")
+        return self._database_available
+
+    async def _search_database(self, db: AsyncSession, room_id: int, query: str, offset: int, limit: int) -> List[dict]:
+        ts_query = func.websearch_to_tsquery(_config, query)
+        rank = func.ts_rank_cd(Message.search_vector, ts_query)
+
+        rows = (await db.execute(
+            select(Message, rank).join(Message.user)
+            .where(
+                and_(
+                    Message.room_id == room_id,
+                    Message.is_deleted == False,
+                    Message.search_vector.op("@@")(ts_query)
+                )
+            )
+            .options(contains_eager(Message.user))
+            .order_by(desc(rank), desc(Message.created_at), desc(Message.id))
+            .offset(offset).limit(limit)
+        )).all()
+
+        return [{**message.to_dict(), "rank": round(score, 4)} for message, score in rows]
+
+    async def _load_matches(self, db: AsyncSession, room_id: int, matches: List[Tuple[int, float]]) -> List[dict]:
+        """Load one page of in-process matches, keeping their rank order"""
+        if not matches:
+            return []
+
+        messages = (await db.scalars(
+            select(Message).join(Message.user)
+            .where(
+                and_(
+                    Message.room_id == room_id,
+                    Message.is_deleted == False,
+                    Message.id.in_([message_id for message_id, _ in matches])
+                )
+            )
+            .options(contains_eager(Message.user))
+        )).all()
+
+        by_id = {message.id: message for message in messages}
+        return [
+            {**by_id[message_id].to_dict(), "rank": round(score, 4)}
+            for message_id, score in matches if message_id in by_id
+        ]
+
+    async def _build_room_index(self, db: AsyncSession, room_id: int) -> RoomSearchIndex:
+        """Index a room's most recent messages on its first search"""
+        rows = (await db.execute(
+            select(Message.id, Message.content)
+            .where(and_(Message.room_id == room_id, Message.is_deleted == False))
+            .order_by(desc(Message.created_at), desc(Message.id))
+            .limit(MAX_INDEXED_MESSAGES)
+        )).all()
+
+        index = RoomSearchIndex()
+        for message_id, content in reversed(rows):
+            index.add(message_id, content)
+
+        self.rooms[room_id] = index
+        while len(self.rooms) > self.max_rooms:
+            self.rooms.popitem(last=False)
+        return index
+
+# Shared between the search endpoint and the paths that write messages
+message_search = MessageSearch()
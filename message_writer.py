@@ -0,0 +1,162 @@
+import asyncio
+import logging
+from collections import deque
+from datetime import datetime, timezone
+from typing import Deque, List, Optional, Set, Tuple
+
+from sqlalchemy import insert, select, text
+
+from models import Message, SessionLocal
+
+logger = logging.getLogger(__name__)
+
+# How long a group commit waits for more messages after the first one arrives
+FLUSH_INTERVAL_SECONDS = 0.005
+
+# Rows per multi-row INSERT statement
+MAX_ROWS_PER_INSERT = 1000
+
+# Message ids reserved from the sequence per round trip
+ID_BLOCK_SIZE = 1000
+
+class MessageWriter:
+    """Assigns message ids up front and persists messages in group commits"""
+
+    def __init__(self, flush_interval: float = FLUSH_INTERVAL_SECONDS, id_block_size: int = ID_BLOCK_SIZE):
+        self.flush_interval = flush_interval
+        self.id_block_size = id_block_size
+        self.flushes = 0
+        self.rows_written = 0
+
+        self._ids: Deque[int] = deque()
+        self._id_lock = asyncio.Lock()
+        self._pending: List[Tuple[dict, asyncio.Future]] = []
+        self._has_pending = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._stopping = False
+
+    async def start(self):
+        """Start the group commit loop"""
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Stop the loop and write whatever is still pending"""
+        if self._task:
+            # Let an in-progress flush finish rather than cancelling it mid-write
+            self._stopping = True
+            self._has_pending.set()
+            await self._task
+            self._task = None
+
+        await self.flush()
+
+    async def new_message(self, room_id: int, user_id: int, content: str, message_type: str = "text") -> dict:
+        """Build a message row with its id and timestamp already assigned"""
+        return {
+            "id": await self._next_id(),
+            "room_id": room_id,
+            "user_id": user_id,
+            "content": content,
+            "message_type": message_type,
+            "is_ai_enhanced": False,
+            "is_deleted": False,
+            "created_at": datetime.now(timezone.utc)
+        }
+
+    def submit(self, row: dict) -> asyncio.Future:
+        """Queue a message row; the returned future resolves once it is committed"""
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((row, future))
+        self._has_pending.set()
+        return future
+
+    async def flush(self):
+        """Write every pending row with multi-row inserts in one transaction"""
+        if not self._pending:
+            return
+
+        batch, self._pending = self._pending, []
+        rows = [row for row, _ in batch]
+
+        stored: Set[int] = set()
+        error = None
+        for attempt in range(2):
+            committing = False
+            try:
+                async with SessionLocal() as db:
+                    for start in range(0, len(rows), MAX_ROWS_PER_INSERT):
+                        await db.execute(insert(Message), rows[start:start + MAX_ROWS_PER_INSERT])
+                    committing = True
+                    await db.commit()
+                stored = {row["id"] for row in rows}
+                error = None
+                break
+            except Exception as e:
+                error = e
+                logger.error(f"Error writing {len(rows)} messages (attempt {attempt + 1}): {e}")
+
+                # A failed commit may still have landed; look the ids up instead of inserting them twice
+                if committing:
+                    stored = await self._stored_ids([row["id"] for row in rows])
+                    break
+
+        for row, future in batch:
+            if future.done():
+                continue
+            if row["id"] in stored:
+                future.set_result(True)
+            else:
+                future.set_exception(error)
+
+        if stored:
+            self.flushes += 1
+            self.rows_written += len(stored)
+
+    def stats(self) -> dict:
+        return {
+            "flushes": self.flushes,
+            "rows_written": self.rows_written,
+            "rows_per_flush": round(self.rows_written / self.flushes, 2) if self.flushes else 0.0,
+            "pending": len(self._pending)
+        }
+
+    async def _stored_ids(self, ids: List[int]) -> Set[int]:
+        """Ids of the given messages that are in the table, empty when that cannot be checked"""
+        try:
+            async with SessionLocal() as db:
+                return set((await db.scalars(select(Message.id).where(Message.id.in_(ids)))).all())
+        except Exception as e:
+            logger.error(f"Error checking {len(ids)} messages after a failed commit: {e}")
+            return set()
+
+    async def _next_id(self) -> int:
+        """Take an id from the reserved block, reserving a new block when it runs out"""
+        while not self._ids:
+            async with self._id_lock:
+                if self._ids:
+                    break
+                async with SessionLocal() as db:
+                    ids = (await db.scalars(
+                        text("SELECT nextval(pg_get_serial_sequence('messages', 'id')) FROM generate_series(1, :count)"),
+                        {"count": self.id_block_size}
+                    )).all()
+                self._ids.extend(ids)
+        return self._ids.popleft()
+
+    async def _run(self):
+        while not self._stopping:
+            await self._has_pending.wait()
+            if self._stopping:
+                return
+
+            # Give concurrent senders a moment to join this commit
+            await asyncio.sleep(self.flush_interval)
+
+            # Once stopping, the event must stay set; stop() writes whatever is left
+            if self._stopping:
+                return
+            self._has_pending.clear()
+            await self.flush()
+
+# Shared between the WebSocket manager and the REST routes
+message_writer = MessageWriter()
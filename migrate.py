@@ -0,0 +1,38 @@
+import asyncio
+import logging
+import sys
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+from sqlalchemy import text
+
+from models import Base, MESSAGE_MIGRATIONS, engine
+
+logger = logging.getLogger(__name__)
+
+# Waiting longer than this for a lock on messages aborts the migration instead of stalling live traffic behind it
+MIGRATION_LOCK_TIMEOUT = "10s"
+
+async def migrate():
+    """Run the one-time message migrations in a single transaction, all or nothing"""
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+        await conn.execute(text(f"SET LOCAL lock_timeout = '{MIGRATION_LOCK_TIMEOUT}'"))
+        for statement in MESSAGE_MIGRATIONS:
+            await conn.execute(text(statement))
+    await engine.dispose()
+
+def main():
+    """Entry point: python migrate.py"""
+    logging.basicConfig(level=logging.INFO)
+    try:
+        asyncio.run(migrate())
+    except Exception as e:
+        logger.error(f"Migration failed, nothing was changed: {e}")
+        sys.exit(1)
+    logger.info("Message migrations complete")
+
+if __name__ == "__main__":
+    main()
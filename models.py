@@ -3,9 +3,12 @@ import os
 
 # Load environment variables from .env file
 load_dotenv()
-from sqlalchemy import Column, Integer, String, Float, DateTime, Boolean, Text, ForeignKey, JSON, Index, create_engine
+from sqlalchemy import Column, Computed, Integer, String, Float, DateTime, Boolean, Text, ForeignKey, JSON, Index
+from sqlalchemy.dialects.postgresql import TSVECTOR
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import relationship, sessionmaker, Session
+from sqlalchemy.orm import deferred, relationship
 from sqlalchemy.sql import func
 from datetime import datetime, timedelta
 from typing import Optional, Dict, Any
@@ -19,8 +22,30 @@ DATABASE_URL = os.environ.get("DATABASE_URL")
 if not DATABASE_URL:
     raise ValueError("DATABASE_URL environment variable is required")
 
-engine = create_engine(DATABASE_URL)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+def _async_database_url(url: str):
+    """Point a postgres URL at the asyncpg driver"""
+    url = make_url(url)
+    query = dict(url.query)
+    # asyncpg takes "ssl" where libpq takes "sslmode"
+    if "sslmode" in query:
+        query["ssl"] = query.pop("sslmode")
+    return url.set(drivername="postgresql+asyncpg", query=query)
+
+# Pool sizing: every request and WebSocket handler borrows a connection only
+# for the duration of its queries, so a modest pool serves many sockets
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", 20))
+DB_MAX_OVERFLOW = int(os.environ.get("DB_MAX_OVERFLOW", 10))
+DB_POOL_TIMEOUT = float(os.environ.get("DB_POOL_TIMEOUT", 10))
+
+engine = create_async_engine(
+    _async_database_url(DATABASE_URL),
+    pool_size=DB_POOL_SIZE,
+    max_overflow=DB_MAX_OVERFLOW,
+    pool_timeout=DB_POOL_TIMEOUT,
+    pool_recycle=300,
+    pool_pre_ping=True
+)
+SessionLocal = async_sessionmaker(bind=engine, class_=AsyncSession, autoflush=False, expire_on_commit=False)
 
 class User(Base):
     """User model for authentication and profile management"""
@@ -48,21 +73,27 @@ class User(Base):
     updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
     
     # Relationships
-    rooms_created = relationship("Room", back_populates="creator", foreign_keys="Room.creator_id")
-    messages = relationship("Message", back_populates="user")
-    location_data = relationship("LocationData", back_populates="user", uselist=False)
-    sent_friend_requests = relationship("FriendRequest", back_populates="sender", foreign_keys="FriendRequest.sender_id")
-    received_friend_requests = relationship("FriendRequest", back_populates="receiver", foreign_keys="FriendRequest.receiver_id")
+    rooms_created = relationship("Room", back_populates="creator", foreign_keys="Room.creator_id", lazy="raise")
+    messages = relationship("Message", back_populates="user", lazy="raise")
+    location_data = relationship("LocationData", back_populates="user", uselist=False, lazy="raise")
+    sent_friend_requests = relationship("FriendRequest", back_populates="sender", foreign_keys="FriendRequest.sender_id", lazy="raise")
+    received_friend_requests = relationship("FriendRequest", back_populates="receiver", foreign_keys="FriendRequest.receiver_id", lazy="raise")
     
     # Indexes
     __table_args__ = (
         Index('idx_user_email', 'email'),
         Index('idx_user_active', 'is_active'),
         Index('idx_user_online', 'is_online'),
+        # The room reaper looks up connected users whose last_seen went stale
+        Index('idx_user_last_seen', 'last_seen'),
     )
     
     def to_dict(self) -> Dict[str, Any]:
         """Convert user to dictionary for API responses"""
+        # Live presence wins over the columns, which are written in batches
+        from presence import presence
+        is_online, last_seen = presence.resolve(self.id, self.is_online, self.last_seen)
+        
         return {
             "id": self.id,
             "email": self.email,
@@ -72,8 +103,8 @@ class User(Base):
             "location_sharing_enabled": self.location_sharing_enabled,
             "profile_visibility": self.profile_visibility,
             "notification_enabled": self.notification_enabled,
-            "is_online": self.is_online,
-            "last_seen": self.last_seen.isoformat() if self.last_seen else None,
+            "is_online": is_online,
+            "last_seen": last_seen.isoformat() if last_seen else None,
             "created_at": self.created_at.isoformat() if self.created_at else None
         }
 
@@ -95,6 +126,9 @@ class Room(Base):
     mode = Column(String(20), default="casual")  # casual, professional
     is_private = Column(Boolean, default=False)
     max_users = Column(Integer, default=10)
+    
+    # Active memberships, kept in step with room_memberships in the same transaction
+    active_member_count = Column(Integer, nullable=False, default=0, server_default="0")
     password_hash = Column(String(255), nullable=True)  # For private rooms
     
     # Room boundaries (GeoJSON polygon for complex shapes)
@@ -113,9 +147,9 @@ class Room(Base):
     updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
     
     # Relationships
-    creator = relationship("User", back_populates="rooms_created", foreign_keys=[creator_id])
-    messages = relationship("Message", back_populates="room", cascade="all, delete-orphan")
-    room_members = relationship("RoomMembership", back_populates="room", cascade="all, delete-orphan")
+    creator = relationship("User", back_populates="rooms_created", foreign_keys=[creator_id], lazy="raise")
+    messages = relationship("Message", back_populates="room", cascade="all, delete-orphan", lazy="raise")
+    room_members = relationship("RoomMembership", back_populates="room", cascade="all, delete-orphan", lazy="raise")
     
     # Indexes
     __table_args__ = (
@@ -141,6 +175,7 @@ class Room(Base):
             "mode": self.mode,
             "is_private": self.is_private,
             "max_users": self.max_users,
+            "user_count": self.active_member_count or 0,
             "boundary_radius": self.boundary_radius,
             "is_active": self.is_active,
             "creator_id": self.creator_id,
@@ -167,8 +202,8 @@ class RoomMembership(Base):
     join_accuracy = Column(Float, nullable=True)
     
     # Relationships
-    room = relationship("Room", back_populates="room_members")
-    user = relationship("User")
+    room = relationship("Room", back_populates="room_members", lazy="raise")
+    user = relationship("User", lazy="raise")
     
     # Indexes
     __table_args__ = (
@@ -177,11 +212,15 @@ class RoomMembership(Base):
         Index('idx_room_membership_joined', 'joined_at'),
     )
 
+# Longest chat message accepted over HTTP or WebSocket
+MAX_MESSAGE_LENGTH = 2000
+
 class Message(Base):
     """Message model for room chat"""
     __tablename__ = "messages"
     
-    id = Column(Integer, primary_key=True, index=True)
+    # Partitioned by month on created_at, so the primary key has to include it
+    id = Column(Integer, primary_key=True, autoincrement=True, index=True)
     room_id = Column(Integer, ForeignKey("rooms.id"), nullable=False)
     user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
     
@@ -198,18 +237,27 @@ class Message(Base):
     edited_at = Column(DateTime(timezone=True), nullable=True)
     
     # Timestamps
-    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    created_at = Column(DateTime(timezone=True), primary_key=True, server_default=func.now())
+    
+    # Full-text search document, stored so ranking never re-parses content; never loaded with the row
+    search_vector = deferred(
+        Column(TSVECTOR, Computed("to_tsvector('simple'::regconfig, content)", persisted=True)),
+        raiseload=True
+    )
     
     # Relationships
-    room = relationship("Room", back_populates="messages")
-    user = relationship("User", back_populates="messages")
+    room = relationship("Room", back_populates="messages", lazy="raise")
+    user = relationship("User", back_populates="messages", lazy="raise")
     
     # Indexes
     __table_args__ = (
         Index('idx_message_room', 'room_id'),
         Index('idx_message_user', 'user_id'),
         Index('idx_message_created', 'created_at'),
-        Index('idx_message_room_created', 'room_id', 'created_at'),
+        # Keyset pagination of room history walks (room_id, created_at, id)
+        Index('idx_message_room_created_id', 'room_id', 'created_at', 'id'),
+        Index('idx_message_search_vector', 'search_vector', postgresql_using='gin'),
+        {"postgresql_partition_by": "RANGE (created_at)"},
     )
     
     def to_dict(self) -> Dict[str, Any]:
@@ -259,8 +307,8 @@ class LocationData(Base):
     expires_at = Column(DateTime(timezone=True), nullable=True)  # Auto-expire for privacy
     
     # Relationships
-    user = relationship("User", back_populates="location_data")
-    current_room = relationship("Room")
+    user = relationship("User", back_populates="location_data", lazy="raise")
+    current_room = relationship("Room", lazy="raise")
     
     # Indexes
     __table_args__ = (
@@ -304,8 +352,8 @@ class FriendRequest(Base):
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     
     # Relationships
-    sender = relationship("User", foreign_keys=[sender_id], back_populates="sent_friend_requests")
-    receiver = relationship("User", foreign_keys=[receiver_id], back_populates="received_friend_requests")
+    sender = relationship("User", foreign_keys=[sender_id], back_populates="sent_friend_requests", lazy="raise")
+    receiver = relationship("User", foreign_keys=[receiver_id], back_populates="received_friend_requests", lazy="raise")
     
     # Indexes
     __table_args__ = (
@@ -346,8 +394,8 @@ class Friend(Base):
     can_message = Column(Boolean, default=True)
     
     # Relationships
-    user1 = relationship("User", foreign_keys=[user1_id])
-    user2 = relationship("User", foreign_keys=[user2_id])
+    user1 = relationship("User", foreign_keys=[user1_id], lazy="raise")
+    user2 = relationship("User", foreign_keys=[user2_id], lazy="raise")
     
     # Indexes
     __table_args__ = (
@@ -362,12 +410,16 @@ class Friend(Base):
         # Determine which user is the friend (not the current user)
         friend_user = self.user2 if self.user1_id == current_user_id else self.user1
         
+        # Live presence wins over the columns, which are written in batches
+        from presence import presence
+        is_online, last_seen = presence.resolve(friend_user.id, friend_user.is_online, friend_user.last_seen)
+        
         return {
             "id": self.id,
             "friend_id": friend_user.id,
             "name": friend_user.name,
-            "is_online": friend_user.is_online,
-            "last_seen": friend_user.last_seen.isoformat() if friend_user.last_seen else None,
+            "is_online": is_online,
+            "last_seen": last_seen.isoformat() if last_seen else None,
             "can_see_location": self.can_see_location,
             "can_message": self.can_message,
             "created_at": self.created_at.isoformat() if self.created_at else None
@@ -400,8 +452,8 @@ class AIInteraction(Base):
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     
     # Relationships
-    user = relationship("User")
-    room = relationship("Room")
+    user = relationship("User", lazy="raise")
+    room = relationship("Room", lazy="raise")
     
     # Indexes
     __table_args__ = (
@@ -450,14 +502,112 @@ def calculate_distance_between_points(lat1: float, lng1: float, lat2: float, lng
     c = 2 * math.atan2(math.sqrt(a), math.sqrt(1-a))
     return 6371 * c  # Earth's radius in km
 
+# Statements bringing existing databases up to date; create_all skips tables that already exist
+SCHEMA_UPGRADES = [
+    # Add and backfill active_member_count once, when the column is missing. Live room actors keep it
+    # current afterwards, so recounting on every startup would race their increments during a rolling deploy.
+    # The advisory lock makes workers starting together wait for the first one's migration
+    """
+    DO $$
+    BEGIN
+        PERFORM pg_advisory_xact_lock(hashtext('rooms.active_member_count'));
+        IF EXISTS (
+            SELECT 1 FROM information_schema.columns
+            WHERE table_name = 'rooms' AND column_name = 'active_member_count'
+        ) THEN
+            RETURN;
+        END IF;
+        
+        ALTER TABLE rooms ADD COLUMN active_member_count INTEGER NOT NULL DEFAULT 0;
+        UPDATE rooms SET active_member_count = counts.members
+        FROM (
+            SELECT room_id, count(*) AS members
+            FROM room_memberships
+            WHERE is_active
+            GROUP BY room_id
+        ) AS counts
+        WHERE counts.room_id = rooms.id;
+    END $$
+    """,
+    "CREATE INDEX IF NOT EXISTS ix_messages_id ON messages (id)",
+    "CREATE INDEX IF NOT EXISTS idx_message_room ON messages (room_id)",
+    "CREATE INDEX IF NOT EXISTS idx_message_user ON messages (user_id)",
+    "CREATE INDEX IF NOT EXISTS idx_message_created ON messages (created_at)",
+    "CREATE INDEX IF NOT EXISTS idx_message_room_created_id ON messages (room_id, created_at, id)",
+    "CREATE INDEX IF NOT EXISTS idx_user_last_seen ON users (last_seen)",
+]
+
+# One-time migrations that lock or rewrite messages, too heavy for every worker's startup transaction.
+# Run them with migrate.py before deploying; startup refuses to run against an unmigrated table
+
+# Turn an unpartitioned messages table into the first partition of a partitioned one. Everything up to
+# the end of this month stays in it; message_archive creates the monthly partitions after that
+MESSAGE_PARTITION_MIGRATION = """
+DO $$
+DECLARE
+    boundary timestamptz := date_trunc('month', now()) + interval '1 month';
+    id_sequence text := pg_get_serial_sequence('messages', 'id');
+    legacy_index record;
+BEGIN
+    IF (SELECT relkind FROM pg_class WHERE oid = 'messages'::regclass) <> 'r' THEN
+        RETURN;
+    END IF;
+    
+    ALTER TABLE messages RENAME TO messages_legacy;
+    FOR legacy_index IN SELECT indexname FROM pg_indexes WHERE tablename = 'messages_legacy' LOOP
+        EXECUTE 'ALTER INDEX ' || quote_ident(legacy_index.indexname)
+            || ' RENAME TO ' || quote_ident(legacy_index.indexname || '_legacy');
+    END LOOP;
+    UPDATE messages_legacy SET created_at = now() WHERE created_at IS NULL;
+    ALTER TABLE messages_legacy ALTER COLUMN created_at SET NOT NULL;
+    
+    CREATE TABLE messages (LIKE messages_legacy INCLUDING DEFAULTS) PARTITION BY RANGE (created_at);
+    ALTER TABLE messages ADD PRIMARY KEY (id, created_at);
+    ALTER TABLE messages ADD FOREIGN KEY (room_id) REFERENCES rooms (id);
+    ALTER TABLE messages ADD FOREIGN KEY (user_id) REFERENCES users (id);
+    EXECUTE 'ALTER SEQUENCE ' || id_sequence || ' OWNED BY messages.id';
+    EXECUTE 'ALTER TABLE messages ATTACH PARTITION messages_legacy FOR VALUES FROM (MINVALUE) TO ('
+        || quote_literal(boundary) || ')';
+END $$
+"""
+
+# No default partition: message_archive creates monthly partitions ahead of time, and
+# DETACH PARTITION CONCURRENTLY refuses to run while one exists. An empty one left by earlier versions goes
+MESSAGE_DEFAULT_PARTITION_MIGRATION = """
+DO $$
+BEGIN
+    IF to_regclass('messages_default') IS NOT NULL AND NOT EXISTS (SELECT 1 FROM messages_default) THEN
+        ALTER TABLE messages DETACH PARTITION messages_default;
+        DROP TABLE messages_default;
+    END IF;
+END $$
+"""
+
+# Stored search document for full-text search; adding it rewrites every partition. It replaces the
+# expression index, whose matches had to be re-parsed for ranking
+MESSAGE_SEARCH_MIGRATIONS = [
+    "ALTER TABLE messages ADD COLUMN IF NOT EXISTS search_vector tsvector "
+    "GENERATED ALWAYS AS (to_tsvector('simple'::regconfig, content)) STORED",
+    "CREATE INDEX IF NOT EXISTS idx_message_search_vector ON messages USING GIN (search_vector)",
+    "DROP INDEX IF EXISTS idx_message_search",
+]
+
+MESSAGE_MIGRATIONS = [MESSAGE_PARTITION_MIGRATION, MESSAGE_DEFAULT_PARTITION_MIGRATION, *MESSAGE_SEARCH_MIGRATIONS]
+
+# True once every message migration has run; startup checks it rather than running them
+MESSAGE_MIGRATIONS_APPLIED = """
+SELECT (SELECT relkind::text FROM pg_class WHERE oid = 'messages'::regclass) = 'p'
+    AND EXISTS (
+        SELECT 1 FROM information_schema.columns
+        WHERE table_name = 'messages' AND column_name = 'search_vector'
+    )
+"""
+
 # Database dependency
-def get_db():
+async def get_db():
     """Database dependency for FastAPI"""
-    db = SessionLocal()
-    try:
+    async with SessionLocal() as db:
         yield db
-    finally:
-        db.close()
 
 # JWT token utilities
 SECRET_KEY = os.environ.get("JWT_SECRET_KEY", "your-secret-key-change-in-production")
@@ -0,0 +1,129 @@
+import asyncio
+import logging
+import time
+from datetime import datetime, timezone
+from typing import Callable, Dict, Iterable, Optional, Tuple
+
+from sqlalchemy import update
+
+from models import User, SessionLocal
+
+logger = logging.getLogger(__name__)
+
+# How often pending presence changes are written to the users table
+PRESENCE_FLUSH_SECONDS = 5
+
+# How often last_seen is moved forward for users still connected, so sessions of a crashed worker stand out
+PRESENCE_REFRESH_SECONDS = 60
+
+class PresenceService:
+    """Tracks who is online in memory and writes changes to users in bulk"""
+
+    def __init__(self, flush_interval: float = PRESENCE_FLUSH_SECONDS,
+                 refresh_interval: float = PRESENCE_REFRESH_SECONDS):
+        self.flush_interval = flush_interval
+        self.refresh_interval = refresh_interval
+
+        # Users with a live connection to this process, whose last_seen is refreshed
+        self.live_users: Optional[Callable[[], Iterable[int]]] = None
+
+        # Live status: user_id -> (is_online, last_seen)
+        self.status: Dict[int, Tuple[bool, datetime]] = {}
+
+        # Changes not yet written: user_id -> (is_online, last_seen)
+        self._dirty: Dict[int, Tuple[bool, datetime]] = {}
+        self._flush_task: Optional[asyncio.Task] = None
+        self._flush_lock = asyncio.Lock()
+
+    async def start(self):
+        """Start the periodic flush"""
+        self._flush_task = asyncio.create_task(self._flush_loop())
+
+    async def stop(self):
+        """Stop the periodic flush and write whatever is pending"""
+        if self._flush_task:
+            self._flush_task.cancel()
+            try:
+                await self._flush_task
+            except asyncio.CancelledError:
+                pass
+            self._flush_task = None
+
+        await self.flush()
+
+    def mark_online(self, user_id: int):
+        """Record that a user came online"""
+        self._set(user_id, True)
+
+    def mark_offline(self, user_id: int):
+        """Record that a user went offline"""
+        self._set(user_id, False)
+
+    def is_online(self, user_id: int) -> Optional[bool]:
+        """Live status of a user, None if this process has not seen them"""
+        entry = self.status.get(user_id)
+        return entry[0] if entry else None
+
+    def last_seen(self, user_id: int) -> Optional[datetime]:
+        """Last time a user came online or went offline, if seen by this process"""
+        entry = self.status.get(user_id)
+        return entry[1] if entry else None
+
+    def resolve(self, user_id: int, stored_online: Optional[bool],
+                stored_last_seen: Optional[datetime]) -> Tuple[bool, Optional[datetime]]:
+        """Status to report for a user: live when seen here, the users columns otherwise"""
+        online = self.is_online(user_id)
+        if online is None:
+            return bool(stored_online), stored_last_seen
+        return online, self.last_seen(user_id)
+
+    def _set(self, user_id: int, online: bool):
+        entry = (online, datetime.now(timezone.utc))
+        self.status[user_id] = entry
+        self._dirty[user_id] = entry
+
+    async def flush(self):
+        """Write pending presence changes with one bulk UPDATE"""
+        async with self._flush_lock:
+            if not self._dirty:
+                return
+
+            pending, self._dirty = self._dirty, {}
+            try:
+                async with SessionLocal() as db:
+                    await db.execute(update(User), [
+                        {"id": user_id, "is_online": online, "last_seen": seen}
+                        for user_id, (online, seen) in pending.items()
+                    ])
+                    await db.commit()
+            except Exception as e:
+                logger.error(f"Error flushing presence for {len(pending)} users: {e}")
+
+                # Keep the changes for the next flush unless newer ones arrived
+                for user_id, entry in pending.items():
+                    self._dirty.setdefault(user_id, entry)
+                return
+
+            # Offline users no longer need to be kept once written
+            for user_id, (online, _) in pending.items():
+                if not online and user_id not in self._dirty:
+                    self.status.pop(user_id, None)
+
+    def refresh(self):
+        """Move last_seen forward for every live user"""
+        if self.live_users is None:
+            return
+        for user_id in list(self.live_users()):
+            self._set(user_id, True)
+
+    async def _flush_loop(self):
+        next_refresh = time.monotonic() + self.refresh_interval
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            if time.monotonic() >= next_refresh:
+                self.refresh()
+                next_refresh = time.monotonic() + self.refresh_interval
+            await self.flush()
+
+# Shared between the WebSocket manager and the REST routes
+presence = PresenceService()
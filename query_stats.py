@@ -0,0 +1,130 @@
+import contextvars
+import logging
+import os
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Dict, Iterator, Tuple
+
+from sqlalchemy import event
+
+from models import engine
+
+logger = logging.getLogger(__name__)
+
+# Send each request's query count and database time back as response headers
+DEBUG = os.environ.get("DEBUG", "").lower() in ("1", "true", "yes")
+
+# Most statements an endpoint or WebSocket message type should issue, independent of page size
+QUERY_BUDGETS: Dict[str, int] = {
+    "GET /api/rooms/nearby": 1,
+    "GET /api/rooms/{room_id}": 4,
+    "GET /api/rooms/{room_id}/messages": 2,
+    "GET /api/rooms/{room_id}/messages/search": 4,
+    "GET /api/friends": 4,
+    "GET /api/friends/requests": 3,
+    "GET /api/users/search": 3
+}
+
+@dataclass
+class QueryCount:
+    """Statements issued and time spent in the database by one unit of work"""
+    statements: int = 0
+    db_time: float = 0.0
+
+@dataclass
+class QueryTotals:
+    calls: int = 0
+    statements: int = 0
+    max_statements: int = 0
+    db_time: float = 0.0
+    over_budget: int = 0
+
+# Every count the running code contributes to; nested tracking adds to all of them
+_active: contextvars.ContextVar[Tuple[QueryCount, ...]] = contextvars.ContextVar("query_counts", default=())
+
+class QueryStats:
+    """Per-endpoint and per-message-type query counts, fed by SQLAlchemy engine events"""
+
+    def __init__(self, budgets: Dict[str, int] = QUERY_BUDGETS):
+        self.budgets = budgets
+        self.totals: Dict[str, QueryTotals] = {}
+
+    def install(self, target_engine):
+        """Count every statement run through an engine"""
+        sync_engine = target_engine.sync_engine
+        event.listen(sync_engine, "before_cursor_execute", _before_cursor_execute)
+        event.listen(sync_engine, "after_cursor_execute", _after_cursor_execute)
+        event.listen(sync_engine, "handle_error", _handle_error)
+
+    @contextmanager
+    def track(self, key: str) -> Iterator[QueryCount]:
+        """Count the queries issued inside the block and add them to key's totals"""
+        with counting() as count:
+            yield count
+        self.record(key, count)
+
+    def record(self, key: str, count: QueryCount):
+        totals = self.totals.get(key)
+        if totals is None:
+            totals = self.totals[key] = QueryTotals()
+
+        totals.calls += 1
+        totals.statements += count.statements
+        totals.max_statements = max(totals.max_statements, count.statements)
+        totals.db_time += count.db_time
+
+        budget = self.budgets.get(key)
+        if budget is not None and count.statements > budget:
+            totals.over_budget += 1
+            logger.warning(f"{key} issued {count.statements} queries, budget is {budget}")
+
+    def stats(self) -> Dict[str, dict]:
+        return {
+            key: {
+                "calls": totals.calls,
+                "statements": totals.statements,
+                "avg_statements": round(totals.statements / totals.calls, 2),
+                "max_statements": totals.max_statements,
+                "db_time_ms": round(totals.db_time * 1000, 1),
+                "avg_db_time_ms": round(totals.db_time * 1000 / totals.calls, 2),
+                "budget": self.budgets.get(key),
+                "over_budget": totals.over_budget
+            }
+            for key, totals in self.totals.items()
+        }
+
+@contextmanager
+def counting() -> Iterator[QueryCount]:
+    """Count the queries issued inside the block without recording them anywhere"""
+    count = QueryCount()
+    token = _active.set(_active.get() + (count,))
+    try:
+        yield count
+    finally:
+        _active.reset(token)
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if _active.get():
+        conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    counts = _active.get()
+    started = conn.info.get("query_started")
+    if not counts or not started:
+        return
+
+    elapsed = time.perf_counter() - started.pop()
+    for count in counts:
+        count.statements += 1
+        count.db_time += elapsed
+
+def _handle_error(exception_context):
+    # A failed statement never reaches after_cursor_execute; drop its start time
+    connection = exception_context.connection
+    started = connection.info.get("query_started") if connection is not None else None
+    if started:
+        started.pop()
+
+query_stats = QueryStats()
+query_stats.install(engine)
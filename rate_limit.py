@@ -0,0 +1,165 @@
+import asyncio
+import logging
+import os
+import time
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+from models import engine
+
+logger = logging.getLogger(__name__)
+
+# Budgets per message class: (tokens per second, burst size), applied per user
+MESSAGE_LIMITS: Dict[str, Tuple[float, int]] = {
+    "location_update": (1.0, 5),
+    "send_message": (2.0, 10),
+    "join_room": (0.5, 5),
+    "leave_room": (0.5, 5),
+    "ws_other": (5.0, 20),
+    "rooms_nearby": (1.0, 5),
+    "rest": (10.0, 40)
+}
+
+# Clients behind one address (NAT, campus wifi) share a larger budget
+IP_LIMIT_MULTIPLIER = 4
+
+# Message types never limited or shed
+EXEMPT_TYPES = {"ping"}
+
+# Most buckets kept; the least recently used are dropped, which refills them
+MAX_BUCKETS = 100000
+
+class TokenBucket:
+    """Token bucket refilled continuously at a fixed rate"""
+
+    __slots__ = ("rate", "capacity", "tokens", "updated_at")
+
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated_at = time.monotonic()
+
+    def take(self) -> float:
+        """Take a token; returns 0 on success, else seconds until one is available"""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+class RateLimiter:
+    """Per-user and per-IP token buckets, one budget per message class"""
+
+    def __init__(self, limits: Dict[str, Tuple[float, int]] = MESSAGE_LIMITS, max_buckets: int = MAX_BUCKETS):
+        self.limits = limits
+        self.max_buckets = max_buckets
+        self.rejected = 0
+        self._buckets: "OrderedDict[Tuple[str, str, str], TokenBucket]" = OrderedDict()
+
+    def check(self, message_class: str, user_id: Optional[int] = None, ip: Optional[str] = None) -> float:
+        """Charge a message to its user and IP; returns 0 if allowed, else seconds to wait"""
+        rate, burst = self.limits.get(message_class, self.limits["ws_other"])
+
+        retry_after = 0.0
+        if user_id is not None:
+            retry_after = self._bucket(("user", str(user_id), message_class), rate, burst).take()
+        if not retry_after and ip:
+            retry_after = self._bucket(
+                ("ip", ip, message_class), rate * IP_LIMIT_MULTIPLIER, burst * IP_LIMIT_MULTIPLIER
+            ).take()
+
+        if retry_after:
+            self.rejected += 1
+        return retry_after
+
+    def _bucket(self, key: Tuple[str, str, str], rate: float, burst: int) -> TokenBucket:
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = TokenBucket(rate, burst)
+            while len(self._buckets) > self.max_buckets:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(key)
+        return bucket
+
+class AdmissionController:
+    """Sheds load early once event loop lag or database pool wait is too high"""
+
+    def __init__(self, max_loop_lag: float, max_pool_wait: float, interval: float = 0.5):
+        self.max_loop_lag = max_loop_lag
+        self.max_pool_wait = max_pool_wait
+        self.interval = interval
+
+        self.loop_lag = 0.0
+        self.pool_wait = 0.0
+        self.rejected = 0
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        """Start sampling loop lag and pool wait"""
+        self._task = asyncio.create_task(self._monitor())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def overload_reason(self) -> Optional[str]:
+        """Why new work should be refused right now, None when healthy"""
+        if self.loop_lag > self.max_loop_lag:
+            return "event loop lag"
+        if self.pool_wait > self.max_pool_wait:
+            return "database pool wait"
+        return None
+
+    def admit(self) -> bool:
+        """Check if new work may start, counting refusals"""
+        if self.overload_reason() is None:
+            return True
+        self.rejected += 1
+        return False
+
+    def stats(self) -> dict:
+        return {
+            "loop_lag_ms": round(self.loop_lag * 1000, 1),
+            "pool_wait_ms": round(self.pool_wait * 1000, 1),
+            "overloaded": self.overload_reason(),
+            "rejected": self.rejected
+        }
+
+    async def _monitor(self):
+        while True:
+            started = time.monotonic()
+            await asyncio.sleep(self.interval)
+
+            # Anything past the requested sleep is time the loop was busy elsewhere
+            self.loop_lag = max(0.0, time.monotonic() - started - self.interval)
+            self.pool_wait = await self._sample_pool_wait()
+
+    async def _sample_pool_wait(self) -> float:
+        """Time to check out a connection, probed only when the pool has no idle connections"""
+        pool = engine.sync_engine.pool
+        if pool.checkedout() < pool.size():
+            return 0.0
+
+        started = time.monotonic()
+        try:
+            async with engine.connect():
+                pass
+        except Exception as e:
+            logger.warning(f"Database pool probe failed: {e}")
+        return time.monotonic() - started
+
+rate_limiter = RateLimiter()
+admission = AdmissionController(
+    max_loop_lag=float(os.environ.get("ADMISSION_MAX_LOOP_LAG_MS", 200)) / 1000,
+    max_pool_wait=float(os.environ.get("ADMISSION_MAX_POOL_WAIT_MS", 500)) / 1000
+)
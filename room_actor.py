@@ -0,0 +1,113 @@
+import asyncio
+import contextvars
+import logging
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# Most operations a room applies in one batch
+MAX_BATCH_SIZE = 64
+
+# Actors of rooms with no traffic for this long are stopped
+ACTOR_IDLE_SECONDS = 60
+
+@dataclass
+class RoomOp:
+    """A join, leave or message queued for a room"""
+    kind: str
+    user_id: int
+    data: Dict[str, Any] = field(default_factory=dict)
+    future: Optional[asyncio.Future] = None
+
+    def resolve(self, result: Any = None):
+        """Complete the operation for the submitter"""
+        if self.future and not self.future.done():
+            self.future.set_result(result)
+
+    def fail(self, error: Exception):
+        """Fail the operation for the submitter"""
+        if self.future and not self.future.done():
+            self.future.set_exception(error)
+
+# Applies a batch of operations for a room, resolving each one
+BatchHandler = Callable[[int, List[RoomOp]], Awaitable[None]]
+
+class RoomActor:
+    """Runs one room's operations in arrival order, a batch at a time"""
+
+    def __init__(self, room_id: int, handler: BatchHandler, on_idle: Callable[["RoomActor"], None],
+                 max_batch: int = MAX_BATCH_SIZE, idle_seconds: float = ACTOR_IDLE_SECONDS):
+        self.room_id = room_id
+        self.handler = handler
+        self.on_idle = on_idle
+        self.max_batch = max_batch
+        self.idle_seconds = idle_seconds
+        self.mailbox: "asyncio.Queue[RoomOp]" = asyncio.Queue()
+        # A fresh context, so the actor does not inherit the query counters of whoever submitted first
+        self.task = asyncio.create_task(self._run(), context=contextvars.Context())
+
+    async def _run(self):
+        while True:
+            try:
+                op = await asyncio.wait_for(self.mailbox.get(), timeout=self.idle_seconds)
+            except asyncio.TimeoutError:
+                # Nothing can be enqueued between the timeout and this check
+                if self.mailbox.empty():
+                    self.on_idle(self)
+                    return
+                continue
+
+            # Everything already waiting is applied together
+            batch = [op]
+            while len(batch) < self.max_batch and not self.mailbox.empty():
+                batch.append(self.mailbox.get_nowait())
+
+            try:
+                await self.handler(self.room_id, batch)
+            except asyncio.CancelledError:
+                for pending in batch:
+                    pending.fail(RuntimeError("Room actor stopped"))
+                raise
+            except Exception as e:
+                logger.error(f"Error processing {len(batch)} operations for room {self.room_id}: {e}")
+                for pending in batch:
+                    pending.fail(e)
+
+class RoomActorRegistry:
+    """Starts room actors on demand and drops them once idle"""
+
+    def __init__(self, handler: BatchHandler, max_batch: int = MAX_BATCH_SIZE,
+                 idle_seconds: float = ACTOR_IDLE_SECONDS):
+        self.handler = handler
+        self.max_batch = max_batch
+        self.idle_seconds = idle_seconds
+        self.actors: Dict[int, RoomActor] = {}
+
+    async def submit(self, room_id: int, op: RoomOp) -> Any:
+        """Queue an operation on the room's actor and wait for its result"""
+        actor = self.actors.get(room_id)
+        if actor is None:
+            actor = RoomActor(room_id, self.handler, self._on_idle, self.max_batch, self.idle_seconds)
+            self.actors[room_id] = actor
+
+        op.future = asyncio.get_running_loop().create_future()
+        actor.mailbox.put_nowait(op)
+        return await op.future
+
+    async def stop(self):
+        """Stop all actors, failing whatever is still queued"""
+        actors = list(self.actors.values())
+        self.actors.clear()
+
+        for actor in actors:
+            actor.task.cancel()
+        await asyncio.gather(*(actor.task for actor in actors), return_exceptions=True)
+
+        for actor in actors:
+            while not actor.mailbox.empty():
+                actor.mailbox.get_nowait().fail(RuntimeError("Room actor stopped"))
+
+    def _on_idle(self, actor: RoomActor):
+        if self.actors.get(actor.room_id) is actor:
+            del self.actors[actor.room_id]
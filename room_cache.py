@@ -0,0 +1,120 @@
+import logging
+import uuid
+from collections import OrderedDict, deque
+from dataclasses import dataclass, field
+from typing import Callable, Deque, Dict, List, Optional, Tuple
+
+from models import calculate_distance_between_points
+
+logger = logging.getLogger(__name__)
+
+# Number of recent messages kept per room, matches the history sent on join
+RECENT_MESSAGES_LIMIT = 50
+
+# Number of broadcast events kept per room for reconnect resume
+EVENT_LOG_LIMIT = 200
+
+@dataclass
+class RoomState:
+    """Cached state of a room: serialized room, roster and recent messages"""
+    room: Dict
+    roster: Dict[int, dict] = field(default_factory=dict)
+    roster_version: int = 0
+    messages: Deque[dict] = field(default_factory=lambda: deque(maxlen=RECENT_MESSAGES_LIMIT))
+
+    # Per-room event sequence; the epoch changes whenever the state is rebuilt
+    epoch: str = field(default_factory=lambda: uuid.uuid4().hex[:12])
+    seq: int = 0
+    events: Deque[Tuple[int, dict, Optional[int]]] = field(default_factory=lambda: deque(maxlen=EVENT_LOG_LIMIT))
+
+    @property
+    def is_full(self) -> bool:
+        """Check if the room has reached its member limit"""
+        return len(self.roster) >= self.room["max_users"]
+
+    def contains_location(self, lat: float, lng: float) -> bool:
+        """Check if a location is within the room boundary"""
+        center = self.room["location"]
+        distance_km = calculate_distance_between_points(lat, lng, center["lat"], center["lng"])
+        return distance_km <= self.room["boundary_radius"] / 1000.0
+
+    def recent_messages(self) -> List[dict]:
+        """Get recent messages, oldest first"""
+        return list(self.messages)
+
+    def record_event(self, frame: dict, exclude_user: Optional[int] = None) -> dict:
+        """Stamp a broadcast frame with the next sequence number and log it"""
+        self.seq += 1
+        frame = {**frame, "room_id": self.room["id"], "seq": self.seq}
+        self.events.append((self.seq, frame, exclude_user))
+        return frame
+
+    def events_since(self, epoch: str, seq: int, user_id: int) -> Optional[List[dict]]:
+        """Get the events a user missed after seq, or None if a snapshot is needed"""
+        if epoch != self.epoch or seq > self.seq:
+            return None
+
+        # The oldest missed event has already fallen out of the log
+        if seq < self.seq - len(self.events):
+            return None
+
+        return [frame for event_seq, frame, excluded in self.events if event_seq > seq and excluded != user_id]
+
+class RoomStateCache:
+    """LRU cache of RoomState keyed by room id"""
+
+    def __init__(self, max_rooms: int = 10000):
+        self.max_rooms = max_rooms
+        self._states: "OrderedDict[int, RoomState]" = OrderedDict()
+
+        # Called with the room id whenever a room leaves the cache
+        self.on_evict: Optional[Callable[[int], None]] = None
+
+    def get(self, room_id: int) -> Optional[RoomState]:
+        """Get cached state for a room"""
+        state = self._states.get(room_id)
+        if state is not None:
+            self._states.move_to_end(room_id)
+        return state
+
+    def put(self, room_id: int, state: RoomState) -> RoomState:
+        """Cache state for a room, evicting the least recently used room"""
+        self._states[room_id] = state
+        self._states.move_to_end(room_id)
+
+        while len(self._states) > self.max_rooms:
+            evicted_id, _ = self._states.popitem(last=False)
+            logger.debug(f"Evicted room {evicted_id} from room cache")
+            self._notify_evicted(evicted_id)
+
+        return state
+
+    def room_ids(self) -> List[int]:
+        """Get the ids of all cached rooms"""
+        return list(self._states)
+
+    def __len__(self) -> int:
+        return len(self._states)
+
+    def append_message(self, room_id: int, message: dict):
+        """Add a newly written message to the room's ring buffer"""
+        state = self._states.get(room_id)
+        if state is not None:
+            state.messages.append(message)
+
+    def invalidate(self, room_id: int):
+        """Drop cached state after the room has been edited"""
+        if self._states.pop(room_id, None) is not None:
+            self._notify_evicted(room_id)
+
+    def clear(self):
+        """Drop all cached rooms"""
+        for room_id in list(self._states):
+            self.invalidate(room_id)
+
+    def _notify_evicted(self, room_id: int):
+        if self.on_evict is not None:
+            self.on_evict(room_id)
+
+# Shared between the WebSocket manager and the REST routes
+room_cache = RoomStateCache()
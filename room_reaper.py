@@ -0,0 +1,187 @@
+import asyncio
+import heapq
+import logging
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Awaitable, Callable, List, Optional, Tuple
+
+from sqlalchemy import and_, func, select, update
+
+from models import Room, RoomMembership, User, SessionLocal
+
+logger = logging.getLogger(__name__)
+
+# How often the reaper wakes up, and how much of each wake-up it may spend in the database
+REAPER_INTERVAL_SECONDS = 1.0
+REAPER_TIME_BUDGET_SECONDS = 0.2
+
+# Rows touched per transaction
+REAPER_CHUNK_SIZE = 200
+
+# Expiry times are reloaded this often, covering twice this far ahead
+EXPIRY_RELOAD_SECONDS = 60
+
+# Memberships of users still marked online but not seen for this long are from sessions that never left
+# cleanly; live workers refresh last_seen every PRESENCE_REFRESH_SECONDS, so only users of crashed or
+# departed workers go stale. Users who never connected over WebSocket are never online and keep theirs
+STALE_MEMBERSHIP_SECONDS = 600
+STALE_SCAN_SECONDS = 30
+
+class RoomReaper:
+    """Expires rooms from a min-heap of expiry times and closes memberships left by crashed sessions"""
+
+    def __init__(self, on_rooms_expired: Callable[[List[int]], Awaitable[None]],
+                 on_memberships_closed: Callable[[List[Tuple[int, int]]], Awaitable[None]],
+                 interval: float = REAPER_INTERVAL_SECONDS, time_budget: float = REAPER_TIME_BUDGET_SECONDS,
+                 chunk_size: int = REAPER_CHUNK_SIZE):
+        self.on_rooms_expired = on_rooms_expired
+        self.on_memberships_closed = on_memberships_closed
+        self.interval = interval
+        self.time_budget = time_budget
+        self.chunk_size = chunk_size
+
+        self.rooms_expired = 0
+        self.memberships_closed = 0
+
+        # (expires_at, room_id), earliest first
+        self._heap: List[Tuple[datetime, int]] = []
+        self._next_reload = 0.0
+        self._next_stale_scan = 0.0
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        """Start reaping in the background"""
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def stats(self) -> dict:
+        return {
+            "scheduled_rooms": len(self._heap),
+            "rooms_expired": self.rooms_expired,
+            "memberships_closed": self.memberships_closed
+        }
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self._reap()
+            except Exception as e:
+                logger.error(f"Error reaping rooms: {e}")
+
+    async def _reap(self):
+        now = time.monotonic()
+        deadline = now + self.time_budget
+
+        if now >= self._next_reload:
+            await self._load_expiries()
+            self._next_reload = now + EXPIRY_RELOAD_SECONDS
+
+        await self._expire_due_rooms(deadline)
+
+        if now >= self._next_stale_scan and time.monotonic() < deadline:
+            await self._close_stale_memberships(deadline)
+            self._next_stale_scan = now + STALE_SCAN_SECONDS
+
+    async def _load_expiries(self):
+        """Rebuild the heap from the active rooms expiring before the next reload"""
+        horizon = datetime.now(timezone.utc) + timedelta(seconds=2 * EXPIRY_RELOAD_SECONDS)
+        async with SessionLocal() as db:
+            rows = (await db.execute(
+                select(Room.expires_at, Room.id).where(
+                    and_(Room.is_active == True, Room.expires_at != None, Room.expires_at <= horizon)
+                )
+            )).all()
+
+        self._heap = [(expires_at, room_id) for expires_at, room_id in rows]
+        heapq.heapify(self._heap)
+
+    async def _expire_due_rooms(self, deadline: float):
+        """Expire due rooms a chunk per transaction until none are due or the budget is spent"""
+        now = datetime.now(timezone.utc)
+        while self._heap and self._heap[0][0] <= now and time.monotonic() < deadline:
+            chunk: List[int] = []
+            while self._heap and self._heap[0][0] <= now and len(chunk) < self.chunk_size:
+                chunk.append(heapq.heappop(self._heap)[1])
+
+            async with SessionLocal() as db:
+                # Rooms extended or already closed meanwhile drop out here
+                expired = (await db.scalars(
+                    update(Room).where(
+                        and_(Room.id.in_(chunk), Room.is_active == True, Room.expires_at <= func.now())
+                    ).values(is_active=False, active_member_count=0).returning(Room.id)
+                )).all()
+
+                if expired:
+                    await db.execute(
+                        update(RoomMembership).where(
+                            and_(RoomMembership.room_id.in_(expired), RoomMembership.is_active == True)
+                        ).values(is_active=False, left_at=datetime.utcnow())
+                    )
+                await db.commit()
+
+            if expired:
+                self.rooms_expired += len(expired)
+                await self.on_rooms_expired(list(expired))
+
+    async def _close_stale_memberships(self, deadline: float):
+        """Close memberships of users not seen lately a chunk per transaction, within the budget"""
+        cutoff = datetime.now(timezone.utc) - timedelta(seconds=STALE_MEMBERSHIP_SECONDS)
+        while time.monotonic() < deadline:
+            async with SessionLocal() as db:
+                # Another worker reaping at the same time skips the rows locked here
+                stale = (await db.execute(
+                    select(RoomMembership.id, RoomMembership.room_id, RoomMembership.user_id)
+                    .join(User, User.id == RoomMembership.user_id)
+                    .where(
+                        and_(
+                            RoomMembership.is_active == True,
+                            User.is_online == True,
+                            User.last_seen < cutoff
+                        )
+                    )
+                    .limit(self.chunk_size)
+                    .with_for_update(of=RoomMembership, skip_locked=True)
+                )).all()
+                if not stale:
+                    return
+
+                await db.execute(
+                    update(RoomMembership).where(RoomMembership.id.in_([row.id for row in stale]))
+                    .values(is_active=False, left_at=datetime.utcnow())
+                )
+                
+                # A crashed worker never wrote its users offline
+                await db.execute(
+                    update(User).where(
+                        and_(
+                            User.id.in_(list({row.user_id for row in stale})),
+                            User.is_online == True,
+                            User.last_seen < cutoff
+                        )
+                    ).values(is_online=False)
+                )
+
+                # Recount the affected rooms rather than trusting counts the crashed sessions left behind
+                await db.execute(
+                    update(Room).where(Room.id.in_(list({row.room_id for row in stale}))).values(
+                        active_member_count=select(func.count(RoomMembership.id)).where(
+                            and_(RoomMembership.room_id == Room.id, RoomMembership.is_active == True)
+                        ).scalar_subquery()
+                    )
+                )
+                await db.commit()
+
+            self.memberships_closed += len(stale)
+            await self.on_memberships_closed([(row.room_id, row.user_id) for row in stale])
+
+            if len(stale) < self.chunk_size:
+                return
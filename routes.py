@@ -1,11 +1,15 @@
 from fastapi import APIRouter, Depends, HTTPException, status, Query
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from sqlalchemy.orm import Session
-from sqlalchemy import and_, or_, func, desc
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import selectinload, contains_eager
+from sqlalchemy import select, and_, or_, desc, tuple_
 from passlib.context import CryptContext
 from pydantic import BaseModel, EmailStr, validator
 from typing import List, Optional, Dict, Any
 from datetime import datetime, timedelta
+import asyncio
+import base64
+import json
 import jwt
 import logging
 from geopy.geocoders import Nominatim
@@ -13,9 +17,16 @@ from geopy.exc import GeocoderTimedOut, GeocoderServiceError
 
 from models import (
     User, Room, Message, FriendRequest, Friend, LocationData, 
-    RoomMembership, AIInteraction, get_db, create_access_token,
+    RoomMembership, AIInteraction, MAX_MESSAGE_LENGTH, get_db, create_access_token,
     is_location_within_room_boundary, calculate_distance_between_points
 )
+from auth import get_current_user
+from room_cache import room_cache
+from presence import presence
+from auth_cache import user_cache
+from message_writer import message_writer
+from message_archive import message_archive
+from message_search import message_search
 
 # Configure logging
 logger = logging.getLogger(__name__)
@@ -74,6 +85,12 @@ class RoomCreate(BaseModel):
 class MessageCreate(BaseModel):
     content: str
     message_type: str = "text"
+    
+    @validator('content')
+    def validate_content(cls, v):
+        if len(v) > MAX_MESSAGE_LENGTH:
+            raise ValueError(f'Message must be at most {MAX_MESSAGE_LENGTH} characters long')
+        return v
 
 class FriendRequestCreate(BaseModel):
     user_id: int
@@ -103,11 +120,11 @@ def geocode_location(lat: float, lng: float) -> Optional[str]:
 
 # Authentication endpoints
 @router.post("/auth/register")
-async def register_user(user_data: UserRegister, db: Session = Depends(get_db)):
+async def register_user(user_data: UserRegister, db: AsyncSession = Depends(get_db)):
     """Register a new user"""
     try:
         # Check if user already exists
-        existing_user = db.query(User).filter(User.email == user_data.email).first()
+        existing_user = await db.scalar(select(User).where(User.email == user_data.email).limit(1))
         if existing_user:
             raise HTTPException(
                 status_code=status.HTTP_400_BAD_REQUEST,
@@ -115,7 +132,7 @@ async def register_user(user_data: UserRegister, db: Session = Depends(get_db)):
             )
         
         # Create new user
-        hashed_password = hash_password(user_data.password)
+        hashed_password = await asyncio.to_thread(hash_password, user_data.password)
         user = User(
             name=user_data.name,
             email=user_data.email,
@@ -124,11 +141,14 @@ async def register_user(user_data: UserRegister, db: Session = Depends(get_db)):
         )
         
         db.add(user)
-        db.commit()
-        db.refresh(user)
+        await db.commit()
+        await db.refresh(user)
+        
+        # The id may have been looked up, and cached as missing, before it existed
+        user_cache.invalidate(user.id)
         
         # Create access token
-        token = create_access_token(data={"sub": user.id})
+        token = create_access_token(data={"sub": str(user.id)})
         
         return {
             "success": True,
@@ -138,7 +158,7 @@ async def register_user(user_data: UserRegister, db: Session = Depends(get_db)):
         }
         
     except Exception as e:
-        db.rollback()
+        await db.rollback()
         logger.error(f"Registration error: {e}")
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
@@ -146,29 +166,27 @@ async def register_user(user_data: UserRegister, db: Session = Depends(get_db)):
         )
 
 @router.post("/auth/login")
-async def login_user(login_data: UserLogin, db: Session = Depends(get_db)):
+async def login_user(login_data: UserLogin, db: AsyncSession = Depends(get_db)):
     """Login user"""
     try:
         # Find user
-        user = db.query(User).filter(User.email == login_data.email).first()
-        if not user or not verify_password(login_data.password, user.password_hash):
+        user = await db.scalar(select(User).where(User.email == login_data.email).limit(1))
+        if not user or not await asyncio.to_thread(verify_password, login_data.password, user.password_hash):
             raise HTTPException(
                 status_code=status.HTTP_401_UNAUTHORIZED,
                 detail="Invalid email or password"
             )
         
-        # Update online status
-        user.is_online = True
-        user.last_seen = datetime.utcnow()
-        db.commit()
+        # Update online status, written to the database by the presence service
+        presence.mark_online(user.id)
         
         # Create access token
-        token = create_access_token(data={"sub": user.id})
+        token = create_access_token(data={"sub": str(user.id)})
         
         return {
             "success": True,
             "message": "Login successful",
-            "user": user.to_dict(),
+            "user": {**user.to_dict(), "is_online": True},
             "token": token
         }
         
@@ -183,7 +201,7 @@ async def login_user(login_data: UserLogin, db: Session = Depends(get_db)):
 
 # User profile endpoints
 @router.get("/user/profile")
-async def get_user_profile(current_user: User = Depends(lambda: None), db: Session = Depends(get_db)):
+async def get_user_profile(current_user: User = Depends(lambda: None), db: AsyncSession = Depends(get_db)):
     """Get current user profile - temporarily disabled auth"""
     # Temporary mock user for testing
     mock_user = {
@@ -201,7 +219,7 @@ async def get_user_profile(current_user: User = Depends(lambda: None), db: Sessi
 @router.put("/user/profile")
 async def update_user_profile(
     profile_data: UserUpdate,
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     """Update user profile"""
     try:
@@ -220,7 +238,8 @@ async def update_user_profile(
             current_user.notification_enabled = profile_data.notification_enabled
         
         current_user.updated_at = datetime.utcnow()
-        db.commit()
+        await db.commit()
+        user_cache.invalidate(current_user.id)
         
         return {
             "success": True,
@@ -229,7 +248,7 @@ async def update_user_profile(
         }
         
     except Exception as e:
-        db.rollback()
+        await db.rollback()
         logger.error(f"Profile update error: {e}")
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
@@ -239,7 +258,7 @@ async def update_user_profile(
 @router.delete("/user/account")
 async def delete_user_account(
     # current_user temporarily disabled,
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     """Delete user account"""
     try:
@@ -247,13 +266,15 @@ async def delete_user_account(
         current_user.is_active = False
         current_user.is_online = False
         current_user.updated_at = datetime.utcnow()
+        presence.mark_offline(current_user.id)
         
         # Remove location data
-        location_data = db.query(LocationData).filter(LocationData.user_id == current_user.id).first()
+        location_data = await db.scalar(select(LocationData).where(LocationData.user_id == current_user.id).limit(1))
         if location_data:
-            db.delete(location_data)
+            await db.delete(location_data)
         
-        db.commit()
+        await db.commit()
+        user_cache.invalidate(current_user.id)
         
         return {
             "success": True,
@@ -261,7 +282,7 @@ async def delete_user_account(
         }
         
     except Exception as e:
-        db.rollback()
+        await db.rollback()
         logger.error(f"Account deletion error: {e}")
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
@@ -273,12 +294,12 @@ async def delete_user_account(
 async def update_location(
     location_data: LocationUpdate,
     # current_user temporarily disabled,
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     """Update user location"""
     try:
         # Get or create location data
-        location = db.query(LocationData).filter(LocationData.user_id == current_user.id).first()
+        location = await db.scalar(select(LocationData).where(LocationData.user_id == current_user.id).limit(1))
         
         if not location:
             location = LocationData(user_id=current_user.id)
@@ -296,7 +317,7 @@ async def update_location(
         # Set expiration for privacy (24 hours)
         location.expires_at = datetime.utcnow() + timedelta(hours=24)
         
-        db.commit()
+        await db.commit()
         
         return {
             "success": True,
@@ -305,7 +326,7 @@ async def update_location(
         }
         
     except Exception as e:
-        db.rollback()
+        await db.rollback()
         logger.error(f"Location update error: {e}")
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
@@ -320,19 +341,19 @@ async def get_nearby_rooms(
     radius: float = Query(5.0, description="Search radius in kilometers"),
     mode: Optional[str] = Query(None, description="Room mode filter"),
     # current_user temporarily disabled,
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     """Get nearby rooms"""
     try:
-        query = db.query(Room).filter(Room.is_active == True)
+        query = select(Room).where(Room.is_active == True)
         
         # Filter by mode if specified
         if mode:
-            query = query.filter(Room.mode == mode)
+            query = query.where(Room.mode == mode)
         
-        rooms = query.order_by(desc(Room.created_at)).limit(50).all()
+        rooms = (await db.scalars(query.order_by(desc(Room.created_at)).limit(50))).all()
         
-        # Calculate distances and user counts if location provided
+        # Calculate distances if location provided
         room_data = []
         for room in rooms:
             room_dict = room.to_dict()
@@ -346,12 +367,6 @@ async def get_nearby_rooms(
                 if distance > radius:
                     continue
             
-            # Get active user count
-            user_count = db.query(RoomMembership).filter(
-                and_(RoomMembership.room_id == room.id, RoomMembership.is_active == True)
-            ).count()
-            room_dict["user_count"] = user_count
-            
             room_data.append(room_dict)
         
         # Sort by distance if coordinates provided
@@ -371,12 +386,13 @@ async def get_nearby_rooms(
 async def create_room(
     room_data: RoomCreate,
     # current_user temporarily disabled,
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     """Create a new room"""
     try:
         # Get address for location
-        address = geocode_location(room_data.location.lat, room_data.location.lng)
+        # Geocoding is a blocking HTTP call, keep it off the event loop
+        address = await asyncio.to_thread(geocode_location, room_data.location.lat, room_data.location.lng)
         
         # Create room
         room = Room(
@@ -390,14 +406,14 @@ async def create_room(
             is_private=room_data.is_private,
             max_users=room_data.max_users,
             boundary_radius=room_data.boundary_radius,
-            creator_id=current_user.id
+            creator_id=current_user.id,
+            active_member_count=1
         )
         
         db.add(room)
-        db.commit()
-        db.refresh(room)
+        await db.flush()
         
-        # Create room membership for creator
+        # Create room membership for creator in the same transaction as its count
         membership = RoomMembership(
             room_id=room.id,
             user_id=current_user.id,
@@ -407,7 +423,8 @@ async def create_room(
         )
         
         db.add(membership)
-        db.commit()
+        await db.commit()
+        await db.refresh(room)
         
         return {
             "success": True,
@@ -416,7 +433,7 @@ async def create_room(
         }
         
     except Exception as e:
-        db.rollback()
+        await db.rollback()
         logger.error(f"Room creation error: {e}")
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
@@ -427,11 +444,11 @@ async def create_room(
 async def get_room(
     room_id: int,
     # current_user temporarily disabled,
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     """Get room details"""
     try:
-        room = db.query(Room).filter(Room.id == room_id, Room.is_active == True).first()
+        room = await db.scalar(select(Room).where(Room.id == room_id, Room.is_active == True).limit(1))
         if not room:
             raise HTTPException(
                 status_code=status.HTTP_404_NOT_FOUND,
@@ -439,12 +456,16 @@ async def get_room(
             )
         
         # Get room members
-        members = db.query(RoomMembership).join(User).filter(
+        members = (await db.scalars(select(RoomMembership).join(User).where(
             and_(RoomMembership.room_id == room_id, RoomMembership.is_active == True)
-        ).all()
+        ).options(contains_eager(RoomMembership.user)))).all()
         
         # Get recent messages
-        messages = db.query(Message).filter(Message.room_id == room_id).order_by(desc(Message.created_at)).limit(50).all()
+        messages = (await db.scalars(
+            select(Message).where(Message.room_id == room_id)
+            .options(selectinload(Message.user))
+            .order_by(desc(Message.created_at)).limit(50)
+        )).all()
         
         room_dict = room.to_dict()
         room_dict["members"] = [
@@ -470,24 +491,46 @@ async def get_room(
         )
 
 # Message endpoints
+def encode_message_cursor(message: dict) -> str:
+    """Opaque cursor pointing just past a serialized message in history order"""
+    position = json.dumps([message["created_at"], message["id"]])
+    return base64.urlsafe_b64encode(position.encode()).decode().rstrip("=")
+
+def decode_message_cursor(cursor: str):
+    """Decode a history cursor into (created_at, id)"""
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        created_at, message_id = json.loads(base64.urlsafe_b64decode(padded))
+        return datetime.fromisoformat(created_at), int(message_id)
+    except (ValueError, TypeError):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Invalid cursor"
+        )
+
 @router.get("/rooms/{room_id}/messages")
 async def get_room_messages(
     room_id: int,
     limit: int = Query(50, ge=1, le=100),
-    before: Optional[int] = Query(None, description="Message ID to get messages before"),
+    cursor: Optional[str] = Query(None, description="Cursor from a previous page, for older messages"),
+    paged: bool = Query(False, description="Return {success, messages, next_cursor} instead of a bare list"),
+    before: Optional[int] = Query(None, description="Deprecated: message ID to get messages before; use cursor"),
     # current_user temporarily disabled,
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
-    """Get room messages"""
+    """Get room messages, newest page first
+
+    Without paged or cursor the response is the original bare list, so existing clients keep working.
+    """
     try:
         # Verify user is in room
-        membership = db.query(RoomMembership).filter(
+        membership = await db.scalar(select(RoomMembership).where(
             and_(
                 RoomMembership.room_id == room_id,
                 RoomMembership.user_id == current_user.id,
                 RoomMembership.is_active == True
             )
-        ).first()
+        ).limit(1))
         
         if not membership:
             raise HTTPException(
@@ -495,14 +538,44 @@ async def get_room_messages(
                 detail="Not a member of this room"
             )
         
-        query = db.query(Message).filter(Message.room_id == room_id)
+        # Authors come from the same query, so pages cost one round trip
+        query = (
+            select(Message).join(Message.user)
+            .where(Message.room_id == room_id)
+            .options(contains_eager(Message.user))
+        )
+        
+        # Seek past the cursor on (room_id, created_at, id), so deep pages cost the same as the first
+        position = decode_message_cursor(cursor) if cursor else None
+        if position:
+            query = query.where(tuple_(Message.created_at, Message.id) < tuple_(*position))
+        elif before:
+            query = query.where(Message.id < before)
         
-        if before:
-            query = query.filter(Message.id < before)
+        messages = (await db.scalars(
+            query.order_by(desc(Message.created_at), desc(Message.id)).limit(limit + 1)
+        )).all()
         
-        messages = query.order_by(desc(Message.created_at)).limit(limit).all()
+        has_more = len(messages) > limit
+        page = [msg.to_dict() for msg in messages[:limit]]
         
-        return [msg.to_dict() for msg in reversed(messages)]
+        # History older than the hot table continues from the archive, read only once a page runs past it;
+        # a legacy id with nothing older in the hot table gives no position to continue from
+        if not has_more and (page or not before):
+            if page:
+                position = (messages[-1].created_at, messages[-1].id)
+            archived = await message_archive.read_before(room_id, position, limit - len(page) + 1)
+            has_more = len(archived) > limit - len(page)
+            page.extend(archived[:limit - len(page)])
+        
+        if not paged and not cursor:
+            return list(reversed(page))
+        
+        return {
+            "success": True,
+            "messages": list(reversed(page)),
+            "next_cursor": encode_message_cursor(page[-1]) if has_more else None
+        }
         
     except HTTPException:
         raise
@@ -513,23 +586,67 @@ async def get_room_messages(
             detail="Failed to fetch messages"
         )
 
+@router.get("/rooms/{room_id}/messages/search")
+async def search_room_messages(
+    room_id: int,
+    q: str = Query(..., min_length=1, max_length=200, description="Search query"),
+    limit: int = Query(20, ge=1, le=100),
+    offset: int = Query(0, ge=0, le=1000),
+    current_user: User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db)
+):
+    """Search room messages, best match first"""
+    try:
+        # Verify user is in room
+        membership = await db.scalar(select(RoomMembership).where(
+            and_(
+                RoomMembership.room_id == room_id,
+                RoomMembership.user_id == current_user.id,
+                RoomMembership.is_active == True
+            )
+        ).limit(1))
+        
+        if not membership:
+            raise HTTPException(
+                status_code=status.HTTP_403_FORBIDDEN,
+                detail="Not a member of this room"
+            )
+        
+        results = await message_search.search(db, room_id, q, offset, limit + 1)
+        has_more = len(results) > limit
+        
+        return {
+            "success": True,
+            "results": results[:limit],
+            "next_offset": offset + limit if has_more else None
+        }
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Search messages error: {e}")
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail="Failed to search messages"
+        )
+
 @router.post("/rooms/{room_id}/messages")
 async def send_message(
     room_id: int,
     message_data: MessageCreate,
     # current_user temporarily disabled,
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     """Send a message to a room"""
     try:
         # Verify user is in room
-        membership = db.query(RoomMembership).filter(
+        membership = await db.scalar(select(RoomMembership).where(
             and_(
                 RoomMembership.room_id == room_id,
                 RoomMembership.user_id == current_user.id,
                 RoomMembership.is_active == True
             )
-        ).first()
+        ).limit(1))
         
         if not membership:
             raise HTTPException(
@@ -537,28 +654,26 @@ async def send_message(
                 detail="Not a member of this room"
             )
         
-        # Create message
-        message = Message(
-            room_id=room_id,
-            user_id=current_user.id,
-            content=message_data.content,
-            message_type=message_data.message_type
+        # Id and timestamp are assigned up front; the row lands with the next group commit
+        row = await message_writer.new_message(
+            room_id, current_user.id, message_data.content, message_data.message_type
         )
+        await message_writer.submit(row)
         
-        db.add(message)
-        db.commit()
-        db.refresh(message)
+        message_dict = {**Message(**row).to_dict(), "user_name": current_user.name}
+        room_cache.append_message(room_id, message_dict)
+        message_search.add(room_id, message_dict)
         
         return {
             "success": True,
             "message": "Message sent successfully",
-            **message.to_dict()
+            **message_dict
         }
         
     except HTTPException:
         raise
     except Exception as e:
-        db.rollback()
+        await db.rollback()
         logger.error(f"Send message error: {e}")
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
@@ -569,24 +684,33 @@ async def send_message(
 @router.get("/friends")
 async def get_friends(
     # current_user temporarily disabled,
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     """Get user's friends list"""
     try:
-        friends = db.query(Friend).filter(
+        friends = (await db.scalars(select(Friend).where(
             and_(
                 or_(Friend.user1_id == current_user.id, Friend.user2_id == current_user.id),
                 Friend.is_active == True
             )
-        ).all()
+        ).options(selectinload(Friend.user1), selectinload(Friend.user2)))).all()
+        
+        # Locations of every friend in one query
+        friend_ids = [
+            friendship.user2_id if friendship.user1_id == current_user.id else friendship.user1_id
+            for friendship in friends
+        ]
+        locations = {
+            location.user_id: location
+            for location in (await db.scalars(select(LocationData).where(LocationData.user_id.in_(friend_ids)))).all()
+        } if friend_ids else {}
         
         friends_data = []
         for friendship in friends:
             friend_data = friendship.to_dict(current_user.id)
             
             # Get friend's location if sharing is enabled
-            friend_id = friend_data["friend_id"]
-            location_data = db.query(LocationData).filter(LocationData.user_id == friend_id).first()
+            location_data = locations.get(friend_data["friend_id"])
             
             if location_data and friendship.can_see_location:
                 friend_data["location"] = location_data.to_dict()
@@ -609,12 +733,12 @@ async def get_friends(
 async def send_friend_request(
     request_data: FriendRequestCreate,
     # current_user temporarily disabled,
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     """Send a friend request"""
     try:
         # Check if target user exists
-        target_user = db.query(User).filter(User.id == request_data.user_id).first()
+        target_user = await db.scalar(select(User).where(User.id == request_data.user_id).limit(1))
         if not target_user:
             raise HTTPException(
                 status_code=status.HTTP_404_NOT_FOUND,
@@ -622,7 +746,7 @@ async def send_friend_request(
             )
         
         # Check if already friends
-        existing_friendship = db.query(Friend).filter(
+        existing_friendship = await db.scalar(select(Friend).where(
             and_(
                 or_(
                     and_(Friend.user1_id == current_user.id, Friend.user2_id == request_data.user_id),
@@ -630,7 +754,7 @@ async def send_friend_request(
                 ),
                 Friend.is_active == True
             )
-        ).first()
+        ).limit(1))
         
         if existing_friendship:
             raise HTTPException(
@@ -639,13 +763,13 @@ async def send_friend_request(
             )
         
         # Check if request already exists
-        existing_request = db.query(FriendRequest).filter(
+        existing_request = await db.scalar(select(FriendRequest).where(
             and_(
                 FriendRequest.sender_id == current_user.id,
                 FriendRequest.receiver_id == request_data.user_id,
                 FriendRequest.status == "pending"
             )
-        ).first()
+        ).limit(1))
         
         if existing_request:
             raise HTTPException(
@@ -661,7 +785,7 @@ async def send_friend_request(
         )
         
         db.add(friend_request)
-        db.commit()
+        await db.commit()
         
         return {
             "success": True,
@@ -671,7 +795,7 @@ async def send_friend_request(
     except HTTPException:
         raise
     except Exception as e:
-        db.rollback()
+        await db.rollback()
         logger.error(f"Send friend request error: {e}")
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
@@ -681,16 +805,18 @@ async def send_friend_request(
 @router.get("/friends/requests")
 async def get_friend_requests(
     # current_user temporarily disabled,
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     """Get pending friend requests"""
     try:
-        requests = db.query(FriendRequest).filter(
+        requests = (await db.scalars(select(FriendRequest).where(
             and_(
                 FriendRequest.receiver_id == current_user.id,
                 FriendRequest.status == "pending"
             )
-        ).order_by(desc(FriendRequest.created_at)).all()
+        ).options(
+            selectinload(FriendRequest.sender), selectinload(FriendRequest.receiver)
+        ).order_by(desc(FriendRequest.created_at)))).all()
         
         return [req.to_dict() for req in requests]
         
@@ -706,18 +832,18 @@ async def respond_to_friend_request(
     request_id: int,
     response_data: FriendRequestResponse,
     # current_user temporarily disabled,
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     """Respond to a friend request"""
     try:
         # Get friend request
-        friend_request = db.query(FriendRequest).filter(
+        friend_request = await db.scalar(select(FriendRequest).where(
             and_(
                 FriendRequest.id == request_id,
                 FriendRequest.receiver_id == current_user.id,
                 FriendRequest.status == "pending"
             )
-        ).first()
+        ).limit(1))
         
         if not friend_request:
             raise HTTPException(
@@ -737,7 +863,7 @@ async def respond_to_friend_request(
             )
             db.add(friendship)
         
-        db.commit()
+        await db.commit()
         
         return {
             "success": True,
@@ -747,7 +873,7 @@ async def respond_to_friend_request(
     except HTTPException:
         raise
     except Exception as e:
-        db.rollback()
+        await db.rollback()
         logger.error(f"Respond to friend request error: {e}")
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
@@ -758,12 +884,12 @@ async def respond_to_friend_request(
 async def remove_friend(
     friend_id: int,
     # current_user temporarily disabled,
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     """Remove a friend"""
     try:
         # Find friendship
-        friendship = db.query(Friend).filter(
+        friendship = await db.scalar(select(Friend).where(
             and_(
                 or_(
                     and_(Friend.user1_id == current_user.id, Friend.user2_id == friend_id),
@@ -771,7 +897,7 @@ async def remove_friend(
                 ),
                 Friend.is_active == True
             )
-        ).first()
+        ).limit(1))
         
         if not friendship:
             raise HTTPException(
@@ -781,7 +907,7 @@ async def remove_friend(
         
         # Soft delete friendship
         friendship.is_active = False
-        db.commit()
+        await db.commit()
         
         return {
             "success": True,
@@ -791,7 +917,7 @@ async def remove_friend(
     except HTTPException:
         raise
     except Exception as e:
-        db.rollback()
+        await db.rollback()
         logger.error(f"Remove friend error: {e}")
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
@@ -803,12 +929,12 @@ async def remove_friend(
 async def search_users(
     q: str = Query(..., min_length=2, description="Search query"),
     # current_user temporarily disabled,
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     """Search for users"""
     try:
         # Search by name or email
-        users = db.query(User).filter(
+        users = (await db.scalars(select(User).where(
             and_(
                 User.is_active == True,
                 User.id != current_user.id,
@@ -817,7 +943,31 @@ async def search_users(
                     User.email.ilike(f"%{q}%")
                 )
             )
-        ).limit(20).all()
+        ).limit(20))).all()
+        
+        # Friendships and pending requests with the whole result set, one query each
+        user_ids = [user.id for user in users]
+        friend_ids = set()
+        requested_ids = set()
+        if user_ids:
+            friendships = (await db.execute(select(Friend.user1_id, Friend.user2_id).where(
+                and_(
+                    or_(
+                        and_(Friend.user1_id == current_user.id, Friend.user2_id.in_(user_ids)),
+                        and_(Friend.user2_id == current_user.id, Friend.user1_id.in_(user_ids))
+                    ),
+                    Friend.is_active == True
+                )
+            ))).all()
+            friend_ids = {user2_id if user1_id == current_user.id else user1_id for user1_id, user2_id in friendships}
+            
+            requested_ids = set((await db.scalars(select(FriendRequest.receiver_id).where(
+                and_(
+                    FriendRequest.sender_id == current_user.id,
+                    FriendRequest.receiver_id.in_(user_ids),
+                    FriendRequest.status == "pending"
+                )
+            ))).all())
         
         users_data = []
         for user in users:
@@ -826,36 +976,10 @@ async def search_users(
                 "name": user.name,
                 "bio": user.bio,
                 "mutual_friends": 0,  # Calculate mutual friends
-                "is_friend": False,
-                "request_sent": False
+                "is_friend": user.id in friend_ids,
+                "request_sent": user.id not in friend_ids and user.id in requested_ids
             }
             
-            # Check if already friends
-            friendship = db.query(Friend).filter(
-                and_(
-                    or_(
-                        and_(Friend.user1_id == current_user.id, Friend.user2_id == user.id),
-                        and_(Friend.user1_id == user.id, Friend.user2_id == current_user.id)
-                    ),
-                    Friend.is_active == True
-                )
-            ).first()
-            
-            if friendship:
-                user_data["is_friend"] = True
-            else:
-                # Check if request already sent
-                request = db.query(FriendRequest).filter(
-                    and_(
-                        FriendRequest.sender_id == current_user.id,
-                        FriendRequest.receiver_id == user.id,
-                        FriendRequest.status == "pending"
-                    )
-                ).first()
-                
-                if request:
-                    user_data["request_sent"] = True
-            
             users_data.append(user_data)
         
         return users_data
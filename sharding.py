@@ -0,0 +1,227 @@
+import asyncio
+import bisect
+import hashlib
+import logging
+import os
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+from backplane import Backplane
+
+logger = logging.getLogger(__name__)
+
+# Worker announcements, used to agree on the set of live shards
+WORKERS_CHANNEL = "zayion_workers"
+
+# Workers announce themselves this often and expire after missing a few announcements
+ANNOUNCE_INTERVAL_SECONDS = 5
+WORKER_TIMEOUT_SECONDS = 15
+
+# Virtual nodes per worker, smooths the share of rooms each worker owns
+RING_REPLICAS = 64
+
+_GEOHASH_ALPHABET = "0123456789bcdefghjkmnpqrstuvwxyz"
+
+def geohash_encode(lat: float, lng: float, precision: int = 5) -> str:
+    """Encode a coordinate as a geohash of the given length"""
+    lat_range = [-90.0, 90.0]
+    lng_range = [-180.0, 180.0]
+    chars = []
+    bits = 0
+    bit_count = 0
+    even = True
+
+    while len(chars) < precision:
+        value, bounds = (lng, lng_range) if even else (lat, lat_range)
+        mid = (bounds[0] + bounds[1]) / 2
+        if value >= mid:
+            bits = (bits << 1) | 1
+            bounds[0] = mid
+        else:
+            bits <<= 1
+            bounds[1] = mid
+        even = not even
+
+        bit_count += 1
+        if bit_count == 5:
+            chars.append(_GEOHASH_ALPHABET[bits])
+            bits = 0
+            bit_count = 0
+
+    return "".join(chars)
+
+def _ring_hash(key: str) -> int:
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], "big")
+
+class HashRing:
+    """Consistent hash ring mapping shard keys to worker ids"""
+
+    def __init__(self, replicas: int = RING_REPLICAS):
+        self.replicas = replicas
+        self._points: List[int] = []
+        self._owners: List[str] = []
+
+    def set_workers(self, worker_ids: List[str]):
+        """Rebuild the ring for a new set of workers"""
+        points: List[Tuple[int, str]] = sorted(
+            (_ring_hash(f"{worker_id}#{replica}"), worker_id)
+            for worker_id in worker_ids
+            for replica in range(self.replicas)
+        )
+        self._points = [point for point, _ in points]
+        self._owners = [worker_id for _, worker_id in points]
+
+    def owner(self, key: str) -> Optional[str]:
+        """Get the worker owning a key"""
+        if not self._points:
+            return None
+        index = bisect.bisect(self._points, _ring_hash(key)) % len(self._points)
+        return self._owners[index]
+
+class ShardDirectory:
+    """Tracks live workers over the backplane and assigns rooms to them"""
+
+    def __init__(self, backplane: Backplane, worker_id: str, mode: str = "off",
+                 worker_url: Optional[str] = None, geohash_precision: int = 5):
+        self.backplane = backplane
+        self.worker_id = worker_id
+        self.mode = mode
+        self.worker_url = worker_url
+        self.geohash_precision = geohash_precision
+
+        # Live workers: worker_id -> (public url, last announcement time)
+        self.workers: Dict[str, Tuple[Optional[str], float]] = {}
+        self.ring = HashRing()
+
+        # Called after the set of workers changes so rooms can be handed off
+        self.on_rebalance: Optional[Callable[[], None]] = None
+
+        # Called with a peer's id when it appears, and when it leaves or stops announcing
+        self.on_worker_joined: Optional[Callable[[str], None]] = None
+        self.on_worker_left: Optional[Callable[[str], None]] = None
+
+        self._announce_task: Optional[asyncio.Task] = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.mode in ("room", "geohash")
+
+    @property
+    def has_peers(self) -> bool:
+        """Check if any other worker is live on the backplane"""
+        return any(worker_id != self.worker_id for worker_id in self.workers)
+
+    async def start(self):
+        """Announce this worker and start following the others
+
+        Workers are tracked with sharding off too, so fan-out can be skipped when there are no peers.
+        """
+        self._set_worker(self.worker_id, self.worker_url)
+        await self.backplane.subscribe(WORKERS_CHANNEL, self._on_announcement)
+        self._announce_task = asyncio.create_task(self._announce_loop())
+        if self.enabled:
+            logger.info(f"Room sharding enabled by {self.mode} as worker {self.worker_id}")
+
+    async def stop(self):
+        """Stop announcing; the other workers take over once this one expires"""
+        if self._announce_task:
+            self._announce_task.cancel()
+            self._announce_task = None
+            await self._announce(leaving=True)
+
+    def shard_key(self, room: dict) -> str:
+        """Key used to place a room on the ring"""
+        if self.mode == "geohash" and room.get("location"):
+            location = room["location"]
+            return "geo:" + geohash_encode(location["lat"], location["lng"], self.geohash_precision)
+        return f"room:{room['id']}"
+
+    def owner_of(self, room: dict) -> str:
+        """Get the worker owning a room, this worker when sharding is off"""
+        if not self.enabled:
+            return self.worker_id
+        return self.ring.owner(self.shard_key(room)) or self.worker_id
+
+    def owns(self, room: dict) -> bool:
+        """Check if this worker owns a room"""
+        return self.owner_of(room) == self.worker_id
+
+    def worker_url_of(self, worker_id: str) -> Optional[str]:
+        """Public WebSocket URL clients can reconnect to for a worker"""
+        entry = self.workers.get(worker_id)
+        return entry[0] if entry else None
+
+    async def _announce_loop(self):
+        while True:
+            await self._announce()
+            self._expire_workers()
+            await asyncio.sleep(ANNOUNCE_INTERVAL_SECONDS)
+
+    async def _announce(self, leaving: bool = False):
+        try:
+            await self.backplane.publish(WORKERS_CHANNEL, {
+                "worker_id": self.worker_id,
+                "url": self.worker_url,
+                "leaving": leaving
+            })
+        except Exception as e:
+            logger.error(f"Error announcing worker {self.worker_id}: {e}")
+
+    async def _on_announcement(self, message: dict):
+        worker_id = message.get("worker_id")
+        if not worker_id or worker_id == self.worker_id:
+            return
+
+        if message.get("leaving"):
+            if self.workers.pop(worker_id, None):
+                self._rebuild()
+                self._notify(self.on_worker_left, worker_id)
+        elif worker_id not in self.workers:
+            self._set_worker(worker_id, message.get("url"))
+            self._notify(self.on_worker_joined, worker_id)
+            # Answer right away so the new worker does not wait a full interval to learn about this one
+            await self._announce()
+        else:
+            self.workers[worker_id] = (message.get("url"), time.monotonic())
+
+    def _set_worker(self, worker_id: str, url: Optional[str]):
+        self.workers[worker_id] = (url, time.monotonic())
+        self._rebuild()
+
+    def _expire_workers(self):
+        cutoff = time.monotonic() - WORKER_TIMEOUT_SECONDS
+        expired = [
+            worker_id for worker_id, (_, seen) in self.workers.items()
+            if seen < cutoff and worker_id != self.worker_id
+        ]
+        for worker_id in expired:
+            del self.workers[worker_id]
+        if expired:
+            logger.info(f"Workers left the shard ring: {expired}")
+            self._rebuild()
+            for worker_id in expired:
+                self._notify(self.on_worker_left, worker_id)
+
+    def _rebuild(self):
+        self.ring.set_workers(list(self.workers))
+        if self.enabled and self.on_rebalance is not None:
+            self.on_rebalance()
+
+    def _notify(self, callback: Optional[Callable[[str], None]], worker_id: str):
+        if callback is not None:
+            callback(worker_id)
+
+def create_shard_directory(backplane: Backplane, worker_id: str) -> ShardDirectory:
+    """Build the shard directory configured by WS_SHARDING (off, room or geohash)"""
+    mode = os.environ.get("WS_SHARDING", "off").lower()
+    if mode not in ("off", "room", "geohash"):
+        logger.warning(f"Unknown WS_SHARDING {mode!r}, sharding disabled")
+        mode = "off"
+
+    return ShardDirectory(
+        backplane,
+        worker_id,
+        mode=mode,
+        worker_url=os.environ.get("WORKER_URL"),
+        geohash_precision=int(os.environ.get("WS_SHARD_GEOHASH_PRECISION", 5))
+    )
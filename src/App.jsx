@@ -1,4 +1,4 @@
-import React, { useState, useEffect } from 'react'
+import React, { useState, useEffect, useRef } from 'react'
 import AuthForm from './components/AuthForm'
 import RoomList from './components/RoomList'
 import RoomView from './components/RoomView'
@@ -22,6 +22,8 @@ function App() {
   const [roomUsers, setRoomUsers] = useState([])
   const [messages, setMessages] = useState([])
   const [loading, setLoading] = useState(true)
+  const currentRoomIdRef = useRef(null)
+  const roomUsersVersionRef = useRef(0)
 
   useEffect(() => {
     // Check for existing session
@@ -95,20 +97,41 @@ function App() {
   const handleWebSocketMessage = (message) => {
     switch (message.type) {
       case 'room_users_update':
+        if (message.room_id !== currentRoomIdRef.current) break
+        roomUsersVersionRef.current = message.version
         setRoomUsers(message.users)
         break
+      case 'room_users_delta':
+        handleRoomUsersDelta(message)
+        break
       case 'new_message':
         setMessages(prev => [...prev, message.message])
         break
       case 'room_joined':
+        currentRoomIdRef.current = message.room.id
+        roomUsersVersionRef.current = message.users_version || 0
         setCurrentRoom(message.room)
         setMessages(message.messages || [])
         setRoomUsers(message.users || [])
         setCurrentView('room')
         break
+      case 'message_stored':
+        break
+      case 'message_failed':
+        console.error('Message could not be saved:', message.message_id)
+        break
       case 'rooms_update':
         setRooms(message.rooms)
         break
+      case 'room_expired':
+        setRooms(prev => prev.filter(room => room.id !== message.room_id))
+        if (message.room_id !== currentRoomIdRef.current) break
+        currentRoomIdRef.current = null
+        setCurrentRoom(null)
+        setRoomUsers([])
+        setMessages([])
+        setCurrentView('rooms')
+        break
       case 'friend_request':
         // Handle friend request notification
         fetchFriends()
@@ -118,6 +141,29 @@ function App() {
     }
   }
 
+  const handleRoomUsersDelta = (delta) => {
+    if (delta.room_id !== currentRoomIdRef.current) return
+
+    // A skipped version means we missed a delta; ask for a fresh snapshot
+    if (delta.version !== roomUsersVersionRef.current + 1) {
+      sendMessage({
+        type: 'sync_room_users',
+        roomId: delta.room_id,
+        version: roomUsersVersionRef.current
+      })
+      return
+    }
+
+    roomUsersVersionRef.current = delta.version
+    setRoomUsers(prev => {
+      if (delta.op === 'update') {
+        return prev.map(u => (u.id === delta.user.id ? delta.user : u))
+      }
+      const others = prev.filter(u => u.id !== delta.user.id)
+      return delta.op === 'remove' ? others : [...others, delta.user]
+    })
+  }
+
   const handleLogin = (userData, token) => {
     localStorage.setItem('zayion_token', token)
     api.defaults.headers.common['Authorization'] = `Bearer ${token}`
@@ -189,6 +235,7 @@ function App() {
         type: 'leave_room',
         roomId: currentRoom.id
       })
+      currentRoomIdRef.current = null
       setCurrentRoom(null)
       setRoomUsers([])
       setMessages([])
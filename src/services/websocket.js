@@ -4,6 +4,19 @@ let reconnectAttempts = 0
 const maxReconnectAttempts = 5
 const reconnectDelay = 1000
 
+// Subprotocol offered ahead of the JWT so the server can authenticate the handshake
+const AUTH_SUBPROTOCOL = 'bearer'
+
+// Close code used when the server hands us to the worker owning our rooms
+const HANDOFF_CLOSE_CODE = 4000
+let handoffUrl = null
+
+// Reconnect delay suggested by a draining server, used once
+let drainReconnectDelay = null
+
+// Last seen event per room: roomId -> { epoch, seq }, sent on reconnect to resume
+let roomCursors = {}
+
 export const initializeWebSocket = (userId, onMessage) => {
   messageHandler = onMessage
   connectWebSocket(userId)
@@ -12,25 +25,54 @@ export const initializeWebSocket = (userId, onMessage) => {
 const connectWebSocket = (userId) => {
   try {
     const protocol = window.location.protocol === "https:" ? "wss:" : "ws:"
-    const wsUrl = `${protocol}//${window.location.host}/ws`
+    const wsUrl = handoffUrl || `${protocol}//${window.location.host}/ws`
+    const token = localStorage.getItem('zayion_token')
+    
+    // The server only accepts connections authenticated on the handshake
+    if (!token) {
+      console.error('Not connecting WebSocket without an auth token')
+      return
+    }
     
-    socket = new WebSocket(wsUrl)
+    // Resume cursors ride along in the query string
+    const resume = encodeURIComponent(JSON.stringify(roomCursors))
+    socket = new WebSocket(`${wsUrl}?resume=${resume}`, [AUTH_SUBPROTOCOL, token])
 
     socket.onopen = () => {
       console.log('WebSocket connected')
       reconnectAttempts = 0
-      
-      // Authenticate with user ID
-      socket.send(JSON.stringify({
-        type: 'authenticate',
-        userId: userId
-      }))
     }
 
     socket.onmessage = (event) => {
       try {
         const message = JSON.parse(event.data)
-        if (messageHandler) {
+        trackRoomCursor(message)
+
+        if (message.type === 'server_draining') {
+          // Server is restarting; reconnect after the suggested delay and resume
+          drainReconnectDelay = message.reconnect_after_ms
+        } else if (message.type === 'heartbeat') {
+          // Server liveness check, answer without bothering the app
+          socket.send(JSON.stringify({ type: 'heartbeat_ack' }))
+        } else if (message.type === 'shard_handoff') {
+          // Our rooms live on another worker, reconnect there and resume
+          handoffUrl = message.url
+          socket.close(HANDOFF_CLOSE_CODE, 'shard handoff')
+        } else if (message.type === 'initial_state') {
+          // One frame for every room we are in: snapshots, then missed events
+          message.rooms.forEach(room => {
+            const joined = { type: 'room_joined', ...room }
+            trackRoomCursor(joined)
+            messageHandler && messageHandler(joined)
+          })
+          message.resumed.forEach(resumed => {
+            trackRoomCursor({ type: 'room_resumed', ...resumed })
+            resumed.events.forEach(missed => messageHandler && messageHandler(missed))
+          })
+        } else if (message.type === 'room_resumed') {
+          // Replay only the events missed while disconnected
+          message.events.forEach(missed => messageHandler && messageHandler(missed))
+        } else if (messageHandler) {
           messageHandler(message)
         }
       } catch (error) {
@@ -40,6 +82,21 @@ const connectWebSocket = (userId) => {
 
     socket.onclose = (event) => {
       console.log('WebSocket disconnected:', event.code, event.reason)
+
+      if (event.code === HANDOFF_CLOSE_CODE) {
+        connectWebSocket(userId)
+        return
+      }
+
+      // Go back through the load balancer if the worker we were handed to went away
+      handoffUrl = null
+
+      if (drainReconnectDelay !== null) {
+        const delay = drainReconnectDelay
+        drainReconnectDelay = null
+        setTimeout(() => connectWebSocket(userId), delay)
+        return
+      }
       
       if (reconnectAttempts < maxReconnectAttempts) {
         reconnectAttempts++
@@ -68,7 +125,21 @@ const connectWebSocket = (userId) => {
   }
 }
 
+const trackRoomCursor = (message) => {
+  if (message.type === 'room_joined') {
+    roomCursors[message.room.id] = { epoch: message.epoch, seq: message.seq }
+  } else if (message.type === 'room_resumed') {
+    roomCursors[message.room_id] = { epoch: message.epoch, seq: message.seq }
+  } else if (message.seq && roomCursors[message.room_id]) {
+    roomCursors[message.room_id].seq = message.seq
+  }
+}
+
 export const sendMessage = (message) => {
+  if (message.type === 'leave_room') {
+    delete roomCursors[message.roomId]
+  }
+
   if (socket && socket.readyState === WebSocket.OPEN) {
     socket.send(JSON.stringify(message))
   } else {
@@ -83,4 +154,6 @@ export const closeWebSocket = () => {
   }
   messageHandler = null
   reconnectAttempts = 0
+  roomCursors = {}
+  handoffUrl = null
 }
@@ -1,119 +1,297 @@
 import json
+import time
+import random
 import asyncio
 import logging
-from typing import Dict, List, Optional, Any
+from typing import Dict, List, Optional, Set
 from datetime import datetime, timedelta
 from fastapi import WebSocket
-from sqlalchemy.orm import sessionmaker, Session
-from sqlalchemy import and_, or_
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import aliased, contains_eager, selectinload
+from sqlalchemy import select, update, and_, or_, true
 
 from models import (
-    User, Room, Message, LocationData, RoomMembership, 
-    is_location_within_room_boundary, SessionLocal
+    User, Room, Message, LocationData, RoomMembership, SessionLocal, MAX_MESSAGE_LENGTH
 )
+from room_cache import RoomState, RECENT_MESSAGES_LIMIT, room_cache
+from backplane import (
+    Backplane, PRESENCE_CHANNEL, create_backplane, default_worker_id, room_channel, worker_channel
+)
+from sharding import create_shard_directory
+from room_actor import RoomOp, RoomActorRegistry
+from presence import presence
+from auth_cache import user_cache
+from heartbeat import HeartbeatMonitor
+from message_writer import message_writer
+from query_stats import query_stats
+from message_search import message_search
 
 logger = logging.getLogger(__name__)
 
+# How long a disconnected user keeps their room memberships so a reconnect can resume
+RESUME_GRACE_SECONDS = 60
+
+# Upper bound on closing all connections at shutdown, and the reconnect spread hinted to clients
+DRAIN_TIMEOUT_SECONDS = 10
+DRAIN_RECONNECT_MIN_MS = 500
+DRAIN_RECONNECT_MAX_MS = 5000
+
+# After start-up or a peer joining, room events fan out to every worker for this long,
+# until the peers' connected-user snapshots have filled in remote_users
+PRESENCE_SETTLE_SECONDS = 15
+
+# Message types with their own query stats; anything else is counted as ws:unknown
+MESSAGE_TYPES = {"join_room", "leave_room", "send_message", "location_update", "ping", "sync_room_users"}
+
 class WebSocketManager:
     """Manages WebSocket connections and real-time communication"""
     
-    def __init__(self):
+    def __init__(self, backplane: Optional[Backplane] = None, worker_id: Optional[str] = None):
         # Active connections: user_id -> WebSocket
         self.active_connections: Dict[int, WebSocket] = {}
         
         # Room memberships: room_id -> set of user_ids
         self.room_memberships: Dict[int, set] = {}
         
+        # Reverse index of room_memberships: user_id -> set of room_ids
+        self.user_rooms: Dict[int, set] = {}
+        
         # User locations: user_id -> location_data
         self.user_locations: Dict[int, dict] = {}
         
+        # Display names of connected users: user_id -> name
+        self.user_names: Dict[int, str] = {}
+        
+        # Cached room, roster and recent messages per room
+        self.room_cache = room_cache
+        
+        # Disconnected users waiting out the resume grace period: user_id -> leave task
+        self.pending_leaves: Dict[int, asyncio.Task] = {}
+        
+        # Fire-and-forget work (acks, rebalances, unsubscribes), held until done so it isn't collected mid-flight
+        self.background_tasks: Set[asyncio.Task] = set()
+        
+        # Set on shutdown; no new connections are accepted once draining
+        self.draining = False
+        
+        # Server-driven heartbeats; connections that stop answering are reaped
+        self.heartbeats = HeartbeatMonitor(self._send_heartbeat, self._reap_connection)
+        
+        # Joins, leaves and messages are applied per room by a single actor
+        self.room_actors = RoomActorRegistry(self._process_room_batch)
+        
+        # Backplane fan-out to other workers; rooms are watched while cached
+        self.backplane = backplane or create_backplane()
+        self.worker_id = worker_id or default_worker_id()
+        self.room_cache.on_evict = self._on_room_evicted
+        
+        # Connected users keep a fresh last_seen, which the reaper uses to spot crashed workers' sessions
+        presence.live_users = self.active_connections.keys
+        
+        # Users connected to other workers: user_id -> worker_id
+        self.remote_users: Dict[int, str] = {}
+        
+        # Optional room-affinity sharding, keeps a room's traffic on its owner worker
+        self.shards = create_shard_directory(self.backplane, self.worker_id)
+        self.shards.on_rebalance = self._on_rebalance
+        self.shards.on_worker_joined = self._on_worker_joined
+        self.shards.on_worker_left = self._on_worker_left
+        
+        # Room events fan out regardless of remote_users until this time
+        self.fanout_all_until = time.monotonic() + PRESENCE_SETTLE_SECONDS
+        
+        # Fan-out counters, exposed through get_stats
+        self.stats: Dict[str, int] = {
+            "local_deliveries": 0,
+            "cross_worker_published": 0,
+            "cross_worker_received": 0,
+            "handoffs": 0
+        }
+        self.started_at = time.monotonic()
+        
         # Proximity tracking
         self.proximity_threshold = 0.1  # 100 meters in km
         
-    async def connect(self, user_id: int, websocket: WebSocket):
+    async def start(self):
+        """Join the backplane"""
+        await self.backplane.start()
+        await self.backplane.subscribe(worker_channel(self.worker_id), self._on_worker_message)
+        await self.backplane.subscribe(PRESENCE_CHANNEL, self._on_presence)
+        await self.shards.start()
+        await self.heartbeats.start()
+        logger.info(f"WebSocket manager started as worker {self.worker_id}")
+    
+    async def stop(self):
+        """Leave the backplane"""
+        await self.heartbeats.stop()
+        await self.room_actors.stop()
+        await self.shards.stop()
+        await self.backplane.stop()
+    
+    def _spawn(self, coro):
+        """Run a coroutine in the background, keeping a reference until it finishes"""
+        task = asyncio.create_task(coro)
+        self.background_tasks.add(task)
+        task.add_done_callback(self.background_tasks.discard)
+        return task
+    
+    async def connect(self, user_id: int, websocket: WebSocket, resume: Optional[dict] = None):
         """Connect a user to WebSocket"""
         try:
             # Store connection
             self.active_connections[user_id] = websocket
+            self.heartbeats.add(user_id)
+            self.remote_users.pop(user_id, None)
             
-            # Update user online status
-            db = SessionLocal()
-            try:
-                user = db.query(User).filter(User.id == user_id).first()
-                if user:
-                    user.is_online = True
-                    user.last_seen = datetime.utcnow()
-                    db.commit()
-            finally:
-                db.close()
+            # Reconnected within the grace period, keep the memberships
+            pending_leave = self.pending_leaves.pop(user_id, None)
+            if pending_leave:
+                pending_leave.cancel()
+            
+            # Online status is written to the database in bulk by the presence service
+            presence.mark_online(user_id)
+            
+            user = await user_cache.get(user_id)
+            self.user_names[user_id] = (user.name if user else None) or "Anonymous"
+            
+            await self._publish(PRESENCE_CHANNEL, {"user_id": user_id, "online": True})
             
             logger.info(f"User {user_id} connected to WebSocket")
             
             # Send initial data
-            await self._send_initial_data(user_id)
+            await self._send_initial_data(user_id, resume or {})
+            
+            # Point the client at the worker owning its rooms
+            await self._offer_handoff(user_id)
             
         except Exception as e:
             logger.error(f"Error connecting user {user_id}: {e}")
             
-    async def disconnect(self, user_id: int):
+    async def disconnect(self, user_id: int, websocket: Optional[WebSocket] = None):
         """Disconnect a user from WebSocket"""
         try:
+            # Already cleaned up: drained in bulk, reaped, or disconnected by another path
+            if user_id not in self.active_connections:
+                return
+            
+            # A socket closing after its user reconnected must not tear down the new connection
+            if websocket is not None and self.active_connections[user_id] is not websocket:
+                return
+            
             # Remove from active connections
-            if user_id in self.active_connections:
-                del self.active_connections[user_id]
+            del self.active_connections[user_id]
+            self.heartbeats.remove(user_id)
             
-            # Remove from all rooms
-            for room_id in list(self.room_memberships.keys()):
-                if user_id in self.room_memberships[room_id]:
-                    await self._leave_room(user_id, room_id)
+            # Stop delivering to the user's rooms, but keep the memberships
+            # for a grace period so a quick reconnect can resume
+            room_ids = list(self.user_rooms.get(user_id, ()))
+            for room_id in room_ids:
+                self._remove_room_member(room_id, user_id)
+                await self._update_roster_member(room_id, user_id, {"is_online": False})
+            
+            if room_ids:
+                self.pending_leaves[user_id] = asyncio.create_task(self._leave_after_grace(user_id, room_ids))
+            else:
+                self.user_names.pop(user_id, None)
             
             # Remove location data
             if user_id in self.user_locations:
                 del self.user_locations[user_id]
             
             # Update user offline status
-            db = SessionLocal()
-            try:
-                user = db.query(User).filter(User.id == user_id).first()
-                if user:
-                    user.is_online = False
-                    user.last_seen = datetime.utcnow()
-                    db.commit()
-            finally:
-                db.close()
+            presence.mark_offline(user_id)
+            
+            await self._publish(PRESENCE_CHANNEL, {"user_id": user_id, "online": False})
             
             logger.info(f"User {user_id} disconnected from WebSocket")
             
         except Exception as e:
             logger.error(f"Error disconnecting user {user_id}: {e}")
     
-    async def disconnect_all(self):
-        """Disconnect all users (for shutdown)"""
-        user_ids = list(self.active_connections.keys())
-        for user_id in user_ids:
-            await self.disconnect(user_id)
+    async def drain(self, timeout: float = DRAIN_TIMEOUT_SECONDS):
+        """Close every connection for a restart, keeping memberships so clients can resume"""
+        self.draining = True
+        connections = list(self.active_connections.items())
+        
+        # Memberships stay active so clients can resume after the restart
+        for task in self.pending_leaves.values():
+            task.cancel()
+        self.pending_leaves.clear()
+        
+        # Drop live state in memory; presence is written in one bulk flush afterwards
+        for user_id, _ in connections:
+            presence.mark_offline(user_id)
+            self.heartbeats.remove(user_id)
+        self.active_connections.clear()
+        self.room_memberships.clear()
+        self.user_rooms.clear()
+        self.user_locations.clear()
+        
+        await self._publish(PRESENCE_CHANNEL, {"worker_drained": True})
+        
+        # Close all sockets concurrently, giving up on stragglers after the timeout
+        tasks = [asyncio.create_task(self._close_for_restart(websocket)) for _, websocket in connections]
+        if tasks:
+            _, pending = await asyncio.wait(tasks, timeout=timeout)
+            for task in pending:
+                task.cancel()
+        
+        logger.info(f"Drained {len(connections)} WebSocket connections")
+    
+    async def _close_for_restart(self, websocket: WebSocket):
+        """Tell a client the server is restarting and when to reconnect, then close"""
+        try:
+            await websocket.send_text(json.dumps({
+                "type": "server_draining",
+                # Spread reconnects so the next worker is not hit all at once
+                "reconnect_after_ms": random.randint(DRAIN_RECONNECT_MIN_MS, DRAIN_RECONNECT_MAX_MS)
+            }))
+            await websocket.close(code=1012, reason="Server restarting")
+        except Exception:
+            pass
+    
+    async def _leave_after_grace(self, user_id: int, room_ids: List[int]):
+        """Leave rooms for a user who did not reconnect within the grace period"""
+        try:
+            await asyncio.sleep(RESUME_GRACE_SECONDS)
+        except asyncio.CancelledError:
+            return
+        
+        self.pending_leaves.pop(user_id, None)
+        
+        # Reconnected to another worker; that worker now holds the memberships
+        if user_id in self.remote_users or user_id in self.active_connections:
+            return
+        
+        for room_id in room_ids:
+            await self._leave_room(user_id, room_id)
+        self.user_names.pop(user_id, None)
     
     async def handle_message(self, user_id: int, message: dict):
         """Handle incoming WebSocket message"""
         try:
             message_type = message.get("type")
             
-            if message_type == "join_room":
-                await self._handle_join_room(user_id, message)
-            elif message_type == "leave_room":
-                await self._handle_leave_room(user_id, message)
-            elif message_type == "send_message":
-                await self._handle_send_message(user_id, message)
-            elif message_type == "location_update":
-                await self._handle_location_update(user_id, message)
-            elif message_type == "ping":
-                await self._handle_ping(user_id)
-            else:
-                logger.warning(f"Unknown message type: {message_type}")
-                await self._send_to_user(user_id, {
-                    "type": "error",
-                    "message": f"Unknown message type: {message_type}"
-                })
+            # Room joins, leaves and messages run in the room's actor and are counted as ws:room_batch
+            with query_stats.track(f"ws:{message_type}" if message_type in MESSAGE_TYPES else "ws:unknown"):
+                if message_type == "join_room":
+                    await self._handle_join_room(user_id, message)
+                elif message_type == "leave_room":
+                    await self._handle_leave_room(user_id, message)
+                elif message_type == "send_message":
+                    await self._handle_send_message(user_id, message)
+                elif message_type == "location_update":
+                    await self._handle_location_update(user_id, message)
+                elif message_type == "ping":
+                    await self._handle_ping(user_id)
+                elif message_type == "sync_room_users":
+                    await self._handle_sync_room_users(user_id, message)
+                else:
+                    logger.warning(f"Unknown message type: {message_type}")
+                    await self._send_to_user(user_id, {
+                        "type": "error",
+                        "message": f"Unknown message type: {message_type}"
+                    })
                 
         except Exception as e:
             logger.error(f"Error handling message from user {user_id}: {e}")
@@ -122,34 +300,82 @@ class WebSocketManager:
                 "message": "Failed to process message"
             })
     
-    async def _send_initial_data(self, user_id: int):
-        """Send initial data to newly connected user"""
+    async def _send_initial_data(self, user_id: int, resume: dict):
+        """Send a reconnecting user all of their rooms as one initial_state frame"""
         try:
-            db = SessionLocal()
-            try:
+            async with SessionLocal() as db:
                 # Get user's active room memberships
-                memberships = db.query(RoomMembership).filter(
+                memberships = (await db.scalars(select(RoomMembership).where(
                     and_(
                         RoomMembership.user_id == user_id,
                         RoomMembership.is_active == True
                     )
-                ).all()
+                ))).all()
                 
-                for membership in memberships:
-                    await self._rejoin_room(user_id, membership.room_id, db)
-                    
-            finally:
-                db.close()
+                if not memberships:
+                    return
+                
+                # Rooms not cached yet are loaded together
+                states = await self._get_room_states([m.room_id for m in memberships], db)
+            
+            rooms = []
+            resumed = []
+            presence_deltas = []
+            
+            for membership in memberships:
+                room_id = membership.room_id
+                state = states.get(room_id)
+                if not state:
+                    continue
+                
+                self._add_room_member(room_id, user_id)
+                
+                # Room ids arrive as JSON object keys
+                cursor = resume.get(str(room_id))
+                missed = None
+                if cursor and user_id in state.roster:
+                    missed = state.events_since(cursor.get("epoch"), cursor.get("seq", 0), user_id)
+                
+                if missed is not None:
+                    # Only the events missed while disconnected
+                    resumed.append({
+                        "room_id": room_id,
+                        "epoch": state.epoch,
+                        "seq": state.seq,
+                        "events": missed
+                    })
+                else:
+                    rooms.append({
+                        "room": state.room,
+                        "users": list(state.roster.values()),
+                        "users_version": state.roster_version,
+                        "messages": state.recent_messages(),
+                        "epoch": state.epoch,
+                        "seq": state.seq
+                    })
+                
+                if user_id in state.roster:
+                    presence_deltas.append((room_id, "update", {"id": user_id, "is_online": True}))
+                else:
+                    presence_deltas.append((room_id, "add", self._member_data(user_id, membership.joined_at)))
+            
+            await self._send_to_user(user_id, {
+                "type": "initial_state",
+                "rooms": rooms,
+                "resumed": resumed
+            })
+            
+            # Members see the user come back online instead of a fresh join
+            for room_id, op, member in presence_deltas:
+                await self._broadcast_roster_delta(room_id, op, member)
                 
         except Exception as e:
             logger.error(f"Error sending initial data to user {user_id}: {e}")
     
     async def _handle_join_room(self, user_id: int, message: dict):
         """Handle join room request"""
+        room_id = message.get("roomId")
         try:
-            room_id = message.get("roomId")
-            location = message.get("location")
-            
             if not room_id:
                 await self._send_to_user(user_id, {
                     "type": "error",
@@ -157,70 +383,18 @@ class WebSocketManager:
                 })
                 return
             
-            db = SessionLocal()
-            try:
-                # Verify room exists
-                room = db.query(Room).filter(
-                    and_(Room.id == room_id, Room.is_active == True)
-                ).first()
-                
-                if not room:
-                    await self._send_to_user(user_id, {
-                        "type": "error",
-                        "message": "Room not found"
-                    })
-                    return
-                
-                # Check if room is at capacity
-                current_members = db.query(RoomMembership).filter(
-                    and_(
-                        RoomMembership.room_id == room_id,
-                        RoomMembership.is_active == True
-                    )
-                ).count()
-                
-                if current_members >= room.max_users:
-                    await self._send_to_user(user_id, {
-                        "type": "error",
-                        "message": "Room is at maximum capacity"
-                    })
-                    return
-                
-                # Check location if provided
-                if location and not is_location_within_room_boundary(
-                    location.get("lat"), location.get("lng"), room
-                ):
-                    await self._send_to_user(user_id, {
-                        "type": "error",
-                        "message": "Outside room boundaries"
-                    })
-                    return
-                
-                # Check if already in room
-                existing_membership = db.query(RoomMembership).filter(
-                    and_(
-                        RoomMembership.room_id == room_id,
-                        RoomMembership.user_id == user_id,
-                        RoomMembership.is_active == True
-                    )
-                ).first()
-                
-                if not existing_membership:
-                    # Create new membership
-                    membership = RoomMembership(
-                        room_id=room_id,
-                        user_id=user_id,
-                        join_latitude=location.get("lat") if location else None,
-                        join_longitude=location.get("lng") if location else None,
-                        join_accuracy=location.get("accuracy") if location else None
-                    )
-                    db.add(membership)
-                    db.commit()
-                
-                await self._join_room(user_id, room_id, db)
-                
-            finally:
-                db.close()
+            # Capacity and boundary checks run in the room's actor, in arrival order
+            error = await self.room_actors.submit(room_id, RoomOp("join", user_id, {
+                "location": message.get("location")
+            }))
+            if error:
+                await self._send_to_user(user_id, {
+                    "type": "error",
+                    "message": error
+                })
+                return
+            
+            await self._offer_handoff(user_id)
                 
         except Exception as e:
             logger.error(f"Error handling join room for user {user_id}: {e}")
@@ -228,6 +402,8 @@ class WebSocketManager:
                 "type": "error",
                 "message": "Failed to join room"
             })
+        finally:
+            self._release_unowned_room(room_id)
     
     async def _handle_leave_room(self, user_id: int, message: dict):
         """Handle leave room request"""
@@ -259,6 +435,13 @@ class WebSocketManager:
                 })
                 return
             
+            if not isinstance(content, str) or len(content) > MAX_MESSAGE_LENGTH:
+                await self._send_to_user(user_id, {
+                    "type": "error",
+                    "message": f"Message must be at most {MAX_MESSAGE_LENGTH} characters long"
+                })
+                return
+            
             # Verify user is in room
             if room_id not in self.room_memberships or user_id not in self.room_memberships[room_id]:
                 await self._send_to_user(user_id, {
@@ -267,36 +450,15 @@ class WebSocketManager:
                 })
                 return
             
-            db = SessionLocal()
-            try:
-                # Create message
-                msg = Message(
-                    room_id=room_id,
-                    user_id=user_id,
-                    content=content,
-                    message_type="text"
-                )
-                
-                db.add(msg)
-                db.commit()
-                db.refresh(msg)
-                
-                # Get user info
-                user = db.query(User).filter(User.id == user_id).first()
-                
-                # Broadcast message to all room members
-                message_data = {
-                    "type": "new_message",
-                    "message": {
-                        **msg.to_dict(),
-                        "user_name": user.name if user else "Anonymous"
-                    }
-                }
-                
-                await self._broadcast_to_room(room_id, message_data)
-                
-            finally:
-                db.close()
+            error = await self.room_actors.submit(room_id, RoomOp("message", user_id, {
+                "content": content,
+                "client_id": message.get("clientId")
+            }))
+            if error:
+                await self._send_to_user(user_id, {
+                    "type": "error",
+                    "message": error
+                })
                 
         except Exception as e:
             logger.error(f"Error handling send message for user {user_id}: {e}")
@@ -322,9 +484,8 @@ class WebSocketManager:
             }
             
             # Update location in database
-            db = SessionLocal()
-            try:
-                location_data = db.query(LocationData).filter(LocationData.user_id == user_id).first()
+            async with SessionLocal() as db:
+                location_data = await db.scalar(select(LocationData).where(LocationData.user_id == user_id).limit(1))
                 
                 if not location_data:
                     location_data = LocationData(user_id=user_id)
@@ -336,14 +497,15 @@ class WebSocketManager:
                 location_data.updated_at = datetime.utcnow()
                 location_data.expires_at = datetime.utcnow() + timedelta(hours=24)
                 
-                db.commit()
+                await db.commit()
+                
+                # Push the new position to rosters of rooms the user is in
+                for room_id in self.get_user_rooms(user_id):
+                    await self._update_roster_member(room_id, user_id, {"location": self.user_locations[user_id]})
                 
                 # Check proximity to other users and rooms
                 await self._check_proximity(user_id, location, db)
                 
-            finally:
-                db.close()
-                
         except Exception as e:
             logger.error(f"Error handling location update for user {user_id}: {e}")
     
@@ -354,106 +516,408 @@ class WebSocketManager:
             "timestamp": int(datetime.utcnow().timestamp() * 1000)
         })
     
-    async def _join_room(self, user_id: int, room_id: int, db: Session):
+    def touch(self, user_id: int):
+        """Record that a frame arrived from a user"""
+        self.heartbeats.touch(user_id)
+    
+    async def _send_heartbeat(self, user_id: int):
+        """Ask an idle connection to prove it is still there"""
+        await self._send_to_user(user_id, {
+            "type": "heartbeat",
+            "timestamp": int(datetime.utcnow().timestamp() * 1000)
+        })
+    
+    async def _reap_connection(self, user_id: int):
+        """Drop a connection that missed its heartbeat deadline"""
+        websocket = self.active_connections.get(user_id)
+        logger.info(f"Reaping unresponsive connection for user {user_id}")
+        await self.disconnect(user_id, websocket)
+        
+        if websocket is not None:
+            self._spawn(self._close_quietly(websocket))
+    
+    async def _close_quietly(self, websocket: WebSocket):
+        try:
+            await asyncio.wait_for(websocket.close(code=1001), timeout=5)
+        except Exception:
+            pass
+    
+    async def _handle_sync_room_users(self, user_id: int, message: dict):
+        """Resend the room roster when the client reports a version gap"""
+        room_id = message.get("roomId")
+        state = self.room_cache.get(room_id)
+        
+        if not state or user_id not in self.room_memberships.get(room_id, set()):
+            return
+        
+        if message.get("version") != state.roster_version:
+            await self._send_room_users_snapshot(user_id, room_id)
+    
+    async def _join_room(self, user_id: int, room_id: int, state: RoomState, joined_at: Optional[datetime] = None):
         """Add user to room"""
         try:
             # Add to room membership
-            if room_id not in self.room_memberships:
-                self.room_memberships[room_id] = set()
-            self.room_memberships[room_id].add(user_id)
+            self._add_room_member(room_id, user_id)
             
-            # Get room data
-            room = db.query(Room).filter(Room.id == room_id).first()
-            if not room:
-                return
+            user_name = self.user_names.get(user_id, "Anonymous")
+            member_data = self._member_data(user_id, joined_at or datetime.utcnow())
             
-            # Get room members
-            members = self._get_room_members(room_id, db)
-            
-            # Get recent messages
-            messages = db.query(Message).filter(Message.room_id == room_id).order_by(Message.created_at.desc()).limit(50).all()
+            # Send the roster change to the other members
+            await self._broadcast_roster_delta(room_id, "add", member_data, exclude_user=user_id)
             
             # Send room data to user
             await self._send_to_user(user_id, {
                 "type": "room_joined",
-                "room": room.to_dict(),
-                "users": members,
-                "messages": [msg.to_dict() for msg in reversed(messages)]
+                "room": state.room,
+                "users": list(state.roster.values()),
+                "users_version": state.roster_version,
+                "messages": state.recent_messages(),
+                "epoch": state.epoch,
+                "seq": state.seq
             })
             
             # Notify other room members
-            user = db.query(User).filter(User.id == user_id).first()
             user_joined_message = {
                 "type": "user_joined",
                 "user": {
                     "id": user_id,
-                    "name": user.name if user else "Anonymous"
+                    "name": user_name
                 },
                 "room_id": room_id
             }
             
             await self._broadcast_to_room(room_id, user_joined_message, exclude_user=user_id)
             
-            # Update room users list for all members
-            await self._broadcast_room_users(room_id, db)
-            
         except Exception as e:
             logger.error(f"Error joining room {room_id} for user {user_id}: {e}")
     
-    async def _rejoin_room(self, user_id: int, room_id: int, db: Session):
-        """Rejoin room on reconnection"""
-        await self._join_room(user_id, room_id, db)
-    
     async def _leave_room(self, user_id: int, room_id: int):
         """Remove user from room"""
         try:
-            # Remove from room membership
-            if room_id in self.room_memberships:
-                self.room_memberships[room_id].discard(user_id)
-                
-                # Remove empty room
-                if not self.room_memberships[room_id]:
-                    del self.room_memberships[room_id]
+            await self.room_actors.submit(room_id, RoomOp("leave", user_id))
+        except Exception as e:
+            logger.error(f"Error leaving room {room_id} for user {user_id}: {e}")
+    
+    async def _process_room_batch(self, room_id: int, ops: List[RoomOp]):
+        """Apply a batch of joins, leaves and messages for a room with one membership commit"""
+        with query_stats.track("ws:room_batch"):
+            await self._apply_room_batch(room_id, ops)
+    
+    async def _apply_room_batch(self, room_id: int, ops: List[RoomOp]):
+        async with SessionLocal() as db:
+            state = await self._get_room_state(room_id, db)
+            now = datetime.utcnow()
             
-            # Update database
-            db = SessionLocal()
-            try:
-                membership = db.query(RoomMembership).filter(
-                    and_(
-                        RoomMembership.room_id == room_id,
-                        RoomMembership.user_id == user_id,
-                        RoomMembership.is_active == True
-                    )
-                ).first()
-                
-                if membership:
-                    membership.is_active = False
-                    membership.left_at = datetime.utcnow()
-                    db.commit()
-                
-                # Notify other room members
-                user = db.query(User).filter(User.id == user_id).first()
-                user_left_message = {
-                    "type": "user_left",
-                    "user": {
-                        "id": user_id,
-                        "name": user.name if user else "Anonymous"
-                    },
-                    "room_id": room_id
-                }
-                
-                await self._broadcast_to_room(room_id, user_left_message, exclude_user=user_id)
-                
-                # Update room users list for remaining members
-                await self._broadcast_room_users(room_id, db)
+            # Members as of each operation, so capacity is checked in arrival order
+            members: Dict[int, str] = {
+                member_id: member["joined_at"] for member_id, member in state.roster.items()
+            } if state else {}
+            
+            accepted: List[RoomOp] = []
+            new_memberships: Dict[int, RoomMembership] = {}
+            leaving: List[int] = []
+            
+            for op in ops:
+                if op.kind == "join":
+                    location = op.data.get("location")
+                    
+                    if not state or not state.room["is_active"]:
+                        op.resolve("Room not found")
+                        continue
+                    
+                    if op.user_id not in members and len(members) >= state.room["max_users"]:
+                        op.resolve("Room is at maximum capacity")
+                        continue
+                    
+                    if location and not state.contains_location(location.get("lat"), location.get("lng")):
+                        op.resolve("Outside room boundaries")
+                        continue
+                    
+                    if op.user_id not in members:
+                        new_memberships[op.user_id] = RoomMembership(
+                            room_id=room_id,
+                            user_id=op.user_id,
+                            joined_at=now,
+                            join_latitude=location.get("lat") if location else None,
+                            join_longitude=location.get("lng") if location else None,
+                            join_accuracy=location.get("accuracy") if location else None
+                        )
+                        members[op.user_id] = now.isoformat()
+                    
+                    op.data["joined_at"] = datetime.fromisoformat(members[op.user_id])
+                    
+                elif op.kind == "leave":
+                    members.pop(op.user_id, None)
+                    
+                    # A membership created earlier in this batch is simply not written
+                    if new_memberships.pop(op.user_id, None) is None:
+                        leaving.append(op.user_id)
+                    
+                elif op.kind == "message":
+                    if op.user_id not in members:
+                        op.resolve("Not a member of this room")
+                        continue
                 
-            finally:
-                db.close()
+                accepted.append(op)
+            
+            # Grouped writes: one UPDATE for leaves, one multi-row insert for joins, one count update, one commit
+            left = 0
+            if leaving:
+                left = (await db.execute(
+                    update(RoomMembership).where(
+                        and_(
+                            RoomMembership.room_id == room_id,
+                            RoomMembership.user_id.in_(leaving),
+                            RoomMembership.is_active == True
+                        )
+                    ).values(is_active=False, left_at=now)
+                )).rowcount
+            
+            if new_memberships:
+                # The room row lock makes capacity hold across workers, whichever of them runs this room's actor
+                room_row = (await db.execute(
+                    select(Room.active_member_count, Room.max_users, Room.is_active)
+                    .where(Room.id == room_id).with_for_update()
+                )).one_or_none()
+                free = room_row.max_users - (room_row.active_member_count - left) if room_row and room_row.is_active else 0
                 
+                # Joins beyond the free seats lose, latest first, along with anything they sent
+                rejected = list(new_memberships)[max(free, 0):]
+                if rejected:
+                    for user_id in rejected:
+                        del new_memberships[user_id]
+                        members.pop(user_id, None)
+                    
+                    kept: List[RoomOp] = []
+                    for op in accepted:
+                        if op.user_id in rejected and op.kind == "join":
+                            op.resolve("Room is at maximum capacity")
+                        elif op.user_id in rejected and op.kind == "message":
+                            op.resolve("Not a member of this room")
+                        else:
+                            kept.append(op)
+                    accepted = kept
+            
+            db.add_all(new_memberships.values())
+            
+            delta = len(new_memberships) - left
+            if delta:
+                await db.execute(
+                    update(Room).where(Room.id == room_id)
+                    .values(active_member_count=Room.active_member_count + delta)
+                )
+            
+            if leaving or new_memberships:
+                await db.commit()
+                if state:
+                    state.room["user_count"] = len(members)
+        
+        # Fan out in the order the operations arrived, with the session already released
+        for op in accepted:
+            if op.kind == "join":
+                await self._join_room(op.user_id, room_id, state, op.data["joined_at"])
+            elif op.kind == "leave":
+                await self._announce_leave(op.user_id, room_id)
+            else:
+                await self._publish_message(room_id, op)
+            
+            op.resolve()
+    
+    async def _publish_message(self, room_id: int, op: RoomOp):
+        """Broadcast a chat message right away and acknowledge it once the group commit lands"""
+        row = await message_writer.new_message(room_id, op.user_id, op.data["content"])
+        
+        # A transient Message only serializes the row, the author name is already known
+        message_data = {
+            "type": "new_message",
+            "message": {
+                **Message(**row).to_dict(),
+                "user_name": self.user_names.get(op.user_id, "Anonymous")
+            }
+        }
+        self.room_cache.append_message(room_id, message_data["message"])
+        message_search.add(room_id, message_data["message"])
+        await self._broadcast_to_room(room_id, message_data)
+        
+        stored = message_writer.submit(row)
+        self._spawn(self._ack_message(op.user_id, row["id"], op.data.get("client_id"), stored))
+    
+    async def _ack_message(self, user_id: int, message_id: int, client_id: Optional[str], stored: asyncio.Future):
+        """Tell the sender whether their message was durably written"""
+        try:
+            await stored
+            ack = {"type": "message_stored", "message_id": message_id, "client_id": client_id}
         except Exception as e:
-            logger.error(f"Error leaving room {room_id} for user {user_id}: {e}")
+            logger.error(f"Message {message_id} from user {user_id} was not stored: {e}")
+            ack = {"type": "message_failed", "message_id": message_id, "client_id": client_id}
+        
+        await self._send_to_user(user_id, ack)
+    
+    async def _announce_leave(self, user_id: int, room_id: int):
+        """Stop delivering a room to a user who left and tell the other members"""
+        try:
+            self._remove_room_member(room_id, user_id)
+            
+            # Notify other room members
+            user_left_message = {
+                "type": "user_left",
+                "user": {
+                    "id": user_id,
+                    "name": self.user_names.get(user_id, "Anonymous")
+                },
+                "room_id": room_id
+            }
+            
+            await self._broadcast_to_room(room_id, user_left_message, exclude_user=user_id)
+            
+            # Send the roster change to the remaining members
+            await self._broadcast_roster_delta(room_id, "remove", {"id": user_id}, exclude_user=user_id)
+            
+        except Exception as e:
+            logger.error(f"Error announcing leave of room {room_id} for user {user_id}: {e}")
+    
+    def forget_locations(self, user_ids: List[int]):
+        """Drop in-memory positions whose stored location expired"""
+        for user_id in user_ids:
+            self.user_locations.pop(user_id, None)
+    
+    async def expire_rooms(self, room_ids: List[int]):
+        """Tell the members of expired rooms and stop serving the rooms, on every worker"""
+        for room_id in room_ids:
+            if self._needs_fanout(room_id):
+                await self._publish(room_channel(room_id), {"kind": "expired", "room_id": room_id})
+            await self._close_room(room_id)
+    
+    async def close_memberships(self, memberships: List[tuple]):
+        """Drop closed (room_id, user_id) memberships from rosters and tell the rooms"""
+        for room_id, user_id in memberships:
+            await self._announce_leave(user_id, room_id)
+    
+    async def _close_room(self, room_id: int):
+        """Tell this worker's members a room expired and forget the room"""
+        try:
+            await self._deliver_to_room(room_id, {"type": "room_expired", "room_id": room_id})
+            
+            for user_id in list(self.room_memberships.get(room_id, ())):
+                self._remove_room_member(room_id, user_id)
+            self.room_cache.invalidate(room_id)
+        except Exception as e:
+            logger.error(f"Error closing room {room_id}: {e}")
+    
+    def _member_data(self, user_id: int, joined_at: datetime) -> dict:
+        """Roster entry for a connected member"""
+        member_data = {
+            "id": user_id,
+            "name": self.user_names.get(user_id, "Anonymous"),
+            "is_online": True,
+            "joined_at": joined_at.isoformat()
+        }
+        if user_id in self.user_locations:
+            member_data["location"] = self.user_locations[user_id]
+        return member_data
+    
+    def _add_room_member(self, room_id: int, user_id: int):
+        """Add a user to a room's live member set and the reverse index"""
+        self.room_memberships.setdefault(room_id, set()).add(user_id)
+        self.user_rooms.setdefault(user_id, set()).add(room_id)
+    
+    def _remove_room_member(self, room_id: int, user_id: int):
+        """Remove a user from a room's live member set and the reverse index"""
+        members = self.room_memberships.get(room_id)
+        if members is not None:
+            members.discard(user_id)
+            
+            # Remove empty room
+            if not members:
+                del self.room_memberships[room_id]
+                self._release_unowned_room(room_id)
+        
+        rooms = self.user_rooms.get(user_id)
+        if rooms is not None:
+            rooms.discard(room_id)
+            if not rooms:
+                del self.user_rooms[user_id]
+    
+    def _release_unowned_room(self, room_id: int):
+        """Drop cached state of a room owned by another worker once nobody here is in it"""
+        if not self.shards.enabled or room_id in self.room_memberships:
+            return
+        
+        state = self.room_cache.get(room_id)
+        if state and not self.shards.owns(state.room):
+            self.room_cache.invalidate(room_id)
+    
+    async def _offer_handoff(self, user_id: int):
+        """Ask a client to reconnect to the worker owning most of its rooms"""
+        if not self.shards.enabled or user_id not in self.active_connections:
+            return
+        
+        owners: Dict[str, int] = {}
+        for room_id in self.user_rooms.get(user_id, ()):
+            state = self.room_cache.get(room_id)
+            if state:
+                owner = self.shards.owner_of(state.room)
+                owners[owner] = owners.get(owner, 0) + 1
+        
+        if not owners:
+            return
+        
+        owner = max(owners, key=owners.get)
+        url = self.shards.worker_url_of(owner)
+        if owner == self.worker_id or not url:
+            return
+        
+        self.stats["handoffs"] += 1
+        await self._send_to_user(user_id, {
+            "type": "shard_handoff",
+            "worker_id": owner,
+            "url": url
+        })
+    
+    def _on_rebalance(self):
+        """Hand rooms off after workers joined or left the shard ring"""
+        self._spawn(self._rebalance())
     
-    async def _check_proximity(self, user_id: int, location: dict, db: Session):
+    async def _rebalance(self):
+        try:
+            for room_id in self.room_cache.room_ids():
+                self._release_unowned_room(room_id)
+            
+            for user_id in list(self.active_connections):
+                await self._offer_handoff(user_id)
+        except Exception as e:
+            logger.error(f"Error rebalancing rooms: {e}")
+    
+    def _needs_fanout(self, room_id: int) -> bool:
+        """Check if a room event has to be published to other workers"""
+        if not self.shards.enabled:
+            return True
+        
+        state = self.room_cache.get(room_id)
+        if state is None or not self.shards.owns(state.room):
+            return True
+        
+        # Peers may hold members this worker has not heard about yet
+        if time.monotonic() < self.fanout_all_until:
+            return True
+        
+        # The owner keeps the event local while every member is connected here
+        return any(member_id in self.remote_users for member_id in state.roster)
+    
+    def _on_worker_joined(self, worker_id: str):
+        """Tell a new peer which users are connected here"""
+        self.fanout_all_until = time.monotonic() + PRESENCE_SETTLE_SECONDS
+        self._spawn(self._publish(PRESENCE_CHANNEL, {"connected_users": list(self.active_connections)}))
+    
+    def _on_worker_left(self, worker_id: str):
+        """Forget the users of a worker that left or stopped announcing"""
+        gone = [user_id for user_id, worker in self.remote_users.items() if worker == worker_id]
+        for user_id in gone:
+            del self.remote_users[user_id]
+        if gone:
+            logger.info(f"Dropped {len(gone)} users of departed worker {worker_id}")
+    
+    async def _check_proximity(self, user_id: int, location: dict, db: AsyncSession):
         """Check proximity to other users and send notifications"""
         try:
             user_lat = location.get("lat")
@@ -465,19 +929,19 @@ class WebSocketManager:
             # Check proximity to friends
             from models import Friend, calculate_distance_between_points
             
-            friends = db.query(Friend).filter(
+            friends = (await db.scalars(select(Friend).where(
                 and_(
                     or_(Friend.user1_id == user_id, Friend.user2_id == user_id),
                     Friend.is_active == True,
                     Friend.can_see_location == True
                 )
-            ).all()
+            ))).all()
             
             for friendship in friends:
                 friend_id = friendship.user2_id if friendship.user1_id == user_id else friendship.user1_id
                 
                 # Get friend's location
-                friend_location = db.query(LocationData).filter(LocationData.user_id == friend_id).first()
+                friend_location = await db.scalar(select(LocationData).where(LocationData.user_id == friend_id).limit(1))
                 
                 if friend_location:
                     distance = calculate_distance_between_points(
@@ -492,10 +956,10 @@ class WebSocketManager:
         except Exception as e:
             logger.error(f"Error checking proximity for user {user_id}: {e}")
     
-    async def _send_proximity_notification(self, user_id: int, friend_id: int, distance: float, db: Session):
+    async def _send_proximity_notification(self, user_id: int, friend_id: int, distance: float, db: AsyncSession):
         """Send proximity notification"""
         try:
-            friend = db.query(User).filter(User.id == friend_id).first()
+            friend = await db.scalar(select(User).where(User.id == friend_id).limit(1))
             if not friend:
                 return
             
@@ -513,58 +977,189 @@ class WebSocketManager:
         except Exception as e:
             logger.error(f"Error sending proximity notification: {e}")
     
-    def _get_room_members(self, room_id: int, db: Session) -> List[dict]:
-        """Get list of room members"""
-        try:
-            memberships = db.query(RoomMembership).join(User).filter(
+    def _roster_entry(self, membership: RoomMembership) -> dict:
+        """Roster entry for a membership loaded with its user"""
+        user = membership.user
+        member_data = {
+            "id": user.id,
+            "name": user.name,
+            "is_online": user.id in self.active_connections,
+            "joined_at": membership.joined_at.isoformat()
+        }
+        
+        location_data = self.user_locations.get(user.id)
+        if location_data:
+            member_data["location"] = location_data
+        
+        return member_data
+    
+    async def _get_room_state(self, room_id: int, db: AsyncSession) -> Optional[RoomState]:
+        """Get cached room state, loading it from the database on a miss"""
+        state = self.room_cache.get(room_id)
+        if state:
+            return state
+        
+        states = await self._get_room_states([room_id], db)
+        return states.get(room_id)
+    
+    async def _get_room_states(self, room_ids: List[int], db: AsyncSession) -> Dict[int, RoomState]:
+        """Get cached state for several rooms, loading all misses with one query each for rooms, rosters and messages"""
+        states: Dict[int, RoomState] = {}
+        missing = []
+        for room_id in room_ids:
+            state = self.room_cache.get(room_id)
+            if state:
+                states[room_id] = state
+            else:
+                missing.append(room_id)
+        
+        if not missing:
+            return states
+        
+        rooms = (await db.scalars(select(Room).where(Room.id.in_(missing)))).all()
+        if not rooms:
+            return states
+        
+        memberships = (await db.scalars(
+            select(RoomMembership).join(User).where(
                 and_(
-                    RoomMembership.room_id == room_id,
+                    RoomMembership.room_id.in_(missing),
                     RoomMembership.is_active == True
                 )
-            ).all()
-            
-            members = []
-            for membership in memberships:
-                user = membership.user
-                location_data = self.user_locations.get(user.id)
-                
-                member_data = {
-                    "id": user.id,
-                    "name": user.name,
-                    "is_online": user.id in self.active_connections,
-                    "joined_at": membership.joined_at.isoformat()
-                }
-                
-                if location_data:
-                    member_data["location"] = location_data
-                
-                members.append(member_data)
-            
-            return members
-            
-        except Exception as e:
-            logger.error(f"Error getting room members for room {room_id}: {e}")
-            return []
+            ).options(contains_eager(RoomMembership.user))
+        )).all()
+        
+        # Latest messages of each room via a lateral join, so every room uses its (room_id, created_at) index;
+        # whole rows come out of the lateral, as joining back on id alone would probe every partition
+        room_keys = select(Room.id.label("room_id")).where(Room.id.in_(missing)).subquery()
+        recent = (
+            select(Message)
+            .where(Message.room_id == room_keys.c.room_id)
+            .order_by(Message.created_at.desc())
+            .limit(RECENT_MESSAGES_LIMIT)
+            .lateral("recent")
+        )
+        recent_message = aliased(Message, recent)
+        messages = (await db.scalars(
+            select(recent_message).select_from(room_keys)
+            .join(recent, true())
+            .options(selectinload(recent_message.user))
+            .order_by(recent_message.created_at)
+        )).all()
+        
+        rosters: Dict[int, Dict[int, dict]] = {room.id: {} for room in rooms}
+        for membership in memberships:
+            rosters[membership.room_id][membership.user_id] = self._roster_entry(membership)
+        
+        for room in rooms:
+            state = RoomState(room=room.to_dict(), roster=rosters[room.id])
+            states[room.id] = state
+        
+        for msg in messages:
+            states[msg.room_id].messages.append(msg.to_dict())
+        
+        for room in rooms:
+            # Follow changes made on other workers while the room is cached here
+            await self.backplane.subscribe(room_channel(room.id), self._on_room_event)
+            self.room_cache.put(room.id, states[room.id])
+        
+        return states
+    
+    def _on_room_evicted(self, room_id: int):
+        """Stop following a room once it leaves the cache"""
+        self._spawn(self._unsubscribe_room(room_id))
     
-    async def _broadcast_room_users(self, room_id: int, db: Session):
-        """Broadcast updated user list to all room members"""
+    async def _unsubscribe_room(self, room_id: int):
+        """Drop the room channel unless the room was cached again meanwhile"""
         try:
-            members = self._get_room_members(room_id, db)
-            
-            message = {
-                "type": "room_users_update",
-                "room_id": room_id,
-                "users": members
-            }
-            
-            await self._broadcast_to_room(room_id, message)
-            
+            if self.room_cache.get(room_id) is None:
+                await self.backplane.unsubscribe(room_channel(room_id), self._on_room_event)
         except Exception as e:
-            logger.error(f"Error broadcasting room users for room {room_id}: {e}")
+            logger.error(f"Error unsubscribing from room {room_id}: {e}")
+    
+    def _apply_roster_delta(self, room_id: int, op: str, member: dict) -> Optional[dict]:
+        """Apply an add/remove/update to a cached roster and return the delta frame"""
+        state = self.room_cache.get(room_id)
+        if state is None:
+            return None
+        
+        roster = state.roster
+        member_id = member["id"]
+        if op == "add":
+            roster[member_id] = member
+        elif op == "remove":
+            if roster.pop(member_id, None) is None:
+                return None
+        elif op == "update":
+            if member_id not in roster:
+                return None
+            roster[member_id] = {**roster[member_id], **member}
+            member = roster[member_id]
+        
+        state.roster_version += 1
+        
+        return {
+            "type": "room_users_delta",
+            "room_id": room_id,
+            "op": op,
+            "user": member,
+            "version": state.roster_version
+        }
+    
+    async def _update_roster_member(self, room_id: int, user_id: int, changes: dict):
+        """Apply a partial member update and broadcast it to the room"""
+        await self._broadcast_roster_delta(room_id, "update", {"id": user_id, **changes})
+    
+    async def _broadcast_roster_delta(self, room_id: int, op: str, member: dict, exclude_user: Optional[int] = None):
+        """Apply a roster change locally, deliver the delta and share it with other workers"""
+        delta = self._apply_roster_delta(room_id, op, member)
+        if delta:
+            await self._deliver_to_room(room_id, delta, exclude_user)
+        
+        if not self._needs_fanout(room_id):
+            return
+        
+        # Other workers apply the change to their own roster and version
+        await self._publish(room_channel(room_id), {
+            "kind": "roster",
+            "room_id": room_id,
+            "op": op,
+            "member": member,
+            "exclude_user": exclude_user
+        })
+    
+    async def _send_room_users_snapshot(self, user_id: int, room_id: int):
+        """Send the full roster of a room to a single user"""
+        state = self.room_cache.get(room_id)
+        await self._send_to_user(user_id, {
+            "type": "room_users_update",
+            "room_id": room_id,
+            "users": list(state.roster.values()),
+            "version": state.roster_version
+        })
     
     async def _broadcast_to_room(self, room_id: int, message: dict, exclude_user: Optional[int] = None):
-        """Broadcast message to all users in a room"""
+        """Broadcast message to all users in a room, on every worker"""
+        await self._deliver_to_room(room_id, message, exclude_user)
+        
+        if not self._needs_fanout(room_id):
+            return
+        
+        await self._publish(room_channel(room_id), {
+            "kind": "frame",
+            "room_id": room_id,
+            "frame": message,
+            "exclude_user": exclude_user
+        })
+    
+    async def _deliver_to_room(self, room_id: int, message: dict, exclude_user: Optional[int] = None):
+        """Deliver message to the room members connected to this worker"""
         try:
+            # Sequence and log the event so reconnecting members can catch up
+            state = self.room_cache.get(room_id)
+            if state:
+                message = state.record_event(message, exclude_user)
+            
             if room_id not in self.room_memberships:
                 return
             
@@ -575,6 +1170,7 @@ class WebSocketManager:
             # Send to all connected members
             for user_id in members:
                 await self._send_to_user(user_id, message)
+            self.stats["local_deliveries"] += 1
                 
         except Exception as e:
             logger.error(f"Error broadcasting to room {room_id}: {e}")
@@ -585,12 +1181,90 @@ class WebSocketManager:
             if user_id in self.active_connections:
                 websocket = self.active_connections[user_id]
                 await websocket.send_text(json.dumps(message))
+            elif user_id in self.remote_users:
+                # Route through the worker holding the user's connection
+                await self._publish(worker_channel(self.remote_users[user_id]), {
+                    "kind": "user",
+                    "user_id": user_id,
+                    "frame": message
+                })
                 
         except Exception as e:
+            # The broken socket's reader ends and disconnects it, or the heartbeat monitor reaps it
             logger.error(f"Error sending message to user {user_id}: {e}")
-            # Remove broken connection
-            if user_id in self.active_connections:
-                del self.active_connections[user_id]
+    
+    async def _publish(self, channel: str, message: dict):
+        """Publish a message on the backplane, tagged with this worker as origin"""
+        # Nobody else would receive it; also keeps the cross-worker counters to real hops
+        if not self.shards.has_peers:
+            return
+        
+        try:
+            await self.backplane.publish(channel, {**message, "origin": self.worker_id})
+            self.stats["cross_worker_published"] += 1
+        except Exception as e:
+            logger.error(f"Error publishing to backplane channel {channel}: {e}")
+    
+    async def _on_room_event(self, message: dict):
+        """Apply a room event published by another worker"""
+        if message.get("origin") == self.worker_id:
+            return
+        
+        self.stats["cross_worker_received"] += 1
+        room_id = message["room_id"]
+        exclude_user = message.get("exclude_user")
+        
+        if message["kind"] == "roster":
+            delta = self._apply_roster_delta(room_id, message["op"], message["member"])
+            if delta:
+                await self._deliver_to_room(room_id, delta, exclude_user)
+        elif message["kind"] == "frame":
+            frame = message["frame"]
+            if frame.get("type") == "new_message":
+                self.room_cache.append_message(room_id, frame["message"])
+                message_search.add(room_id, frame["message"])
+            await self._deliver_to_room(room_id, frame, exclude_user)
+        elif message["kind"] == "expired":
+            await self._close_room(room_id)
+    
+    async def _on_worker_message(self, message: dict):
+        """Deliver a message another worker routed to a user connected here"""
+        if message.get("kind") == "user":
+            self.stats["cross_worker_received"] += 1
+            await self._send_to_user(message["user_id"], message["frame"])
+    
+    async def _on_presence(self, message: dict):
+        """Track which worker holds each remote user's connection"""
+        origin = message.get("origin")
+        if origin == self.worker_id:
+            return
+        
+        # Every user of a drained worker went offline at once
+        if message.get("worker_drained"):
+            self._on_worker_left(origin)
+            return
+        
+        # A peer's full set of connected users, sent when this worker joined
+        if "connected_users" in message:
+            for user_id in message["connected_users"]:
+                self._set_remote_user(user_id, origin)
+            return
+        
+        user_id = message["user_id"]
+        if message["online"]:
+            self._set_remote_user(user_id, origin)
+        elif self.remote_users.get(user_id) == origin:
+            del self.remote_users[user_id]
+    
+    def _set_remote_user(self, user_id: int, worker_id: str):
+        """Record a user as connected to another worker, ending any grace period here"""
+        self.remote_users[user_id] = worker_id
+        
+        # The user moved on (shard handoff or reconnect elsewhere), so their rooms are not left
+        pending_leave = self.pending_leaves.pop(user_id, None)
+        if pending_leave:
+            pending_leave.cancel()
+            self.user_names.pop(user_id, None)
     
     async def broadcast_to_all(self, message: dict):
         """Broadcast message to all connected users"""
@@ -607,9 +1281,26 @@ class WebSocketManager:
         for user_id in disconnected_users:
             await self.disconnect(user_id)
     
+    def get_stats(self) -> dict:
+        """Connection and fan-out metrics for this worker"""
+        uptime = max(time.monotonic() - self.started_at, 1.0)
+        cross_worker = self.stats["cross_worker_published"] + self.stats["cross_worker_received"]
+        
+        return {
+            "worker_id": self.worker_id,
+            "sharding": self.shards.mode,
+            "workers": len(self.shards.workers) or 1,
+            "connections": len(self.active_connections),
+            "reaped_connections": self.heartbeats.reaped,
+            "message_writer": message_writer.stats(),
+            "cached_rooms": len(self.room_cache),
+            **self.stats,
+            "cross_worker_per_second": round(cross_worker / uptime, 3)
+        }
+    
     def get_online_users_count(self) -> int:
         """Get count of online users"""
-        return len(self.active_connections)
+        return len(self.active_connections) + len(self.remote_users)
     
     def get_room_users_count(self, room_id: int) -> int:
         """Get count of users in a room"""
@@ -617,12 +1308,8 @@ class WebSocketManager:
     
     def is_user_online(self, user_id: int) -> bool:
         """Check if user is online"""
-        return user_id in self.active_connections
+        return user_id in self.active_connections or user_id in self.remote_users
     
     def get_user_rooms(self, user_id: int) -> List[int]:
         """Get list of rooms user is in"""
-        rooms = []
-        for room_id, members in self.room_memberships.items():
-            if user_id in members:
-                rooms.append(room_id)
-        return rooms
+        return list(self.user_rooms.get(user_id, ()))
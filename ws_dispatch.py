@@ -0,0 +1,79 @@
+import asyncio
+import logging
+from typing import Awaitable, Callable, Dict
+
+logger = logging.getLogger(__name__)
+
+# Most messages a connection may have queued or running at once
+MAX_IN_FLIGHT = 32
+
+# Message types answered inline by the reader, ahead of any queued work; they must stay cheap
+CONTROL_TYPES = {"ping"}
+
+class ConnectionDispatcher:
+    """Runs one connection's messages concurrently, in order within each lane"""
+
+    def __init__(self, handler: Callable[[dict], Awaitable[None]], max_in_flight: int = MAX_IN_FLIGHT):
+        self.handler = handler
+        self.max_in_flight = max_in_flight
+        self.in_flight = 0
+        self._lanes: Dict[str, asyncio.Queue] = {}
+        self._workers: Dict[str, asyncio.Task] = {}
+
+    @staticmethod
+    def lane_of(message: dict) -> str:
+        """Messages about the same room, or of the same type, keep their order"""
+        room_id = message.get("roomId")
+        if room_id is not None:
+            return f"room:{room_id}"
+        return f"type:{message.get('type')}"
+
+    async def submit(self, message: dict) -> bool:
+        """Queue a message, or return False without waiting when the connection is at its in-flight limit
+
+        Control messages run before this returns, so one at a time per connection.
+        """
+        if message.get("type") in CONTROL_TYPES:
+            await self._run(message)
+            return True
+
+        if self.in_flight >= self.max_in_flight:
+            return False
+        self.in_flight += 1
+
+        lane = self.lane_of(message)
+        queue = self._lanes.get(lane)
+        if queue is None:
+            queue = self._lanes[lane] = asyncio.Queue()
+            self._workers[lane] = asyncio.create_task(self._drain(lane, queue))
+        queue.put_nowait(message)
+        return True
+
+    async def close(self):
+        """Cancel whatever is still queued or running"""
+        tasks = list(self._workers.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+        self._lanes.clear()
+        self._workers.clear()
+
+    async def _drain(self, lane: str, queue: asyncio.Queue):
+        """Handle a lane's messages one at a time, exiting once it is empty"""
+        try:
+            while not queue.empty():
+                message = queue.get_nowait()
+                try:
+                    await self._run(message)
+                finally:
+                    self.in_flight -= 1
+        finally:
+            self._lanes.pop(lane, None)
+            self._workers.pop(lane, None)
+
+    async def _run(self, message: dict):
+        try:
+            await self.handler(message)
+        except Exception as e:
+            logger.error(f"Error dispatching {message.get('type')} message: {e}")